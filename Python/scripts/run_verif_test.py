@@ -26,11 +26,15 @@ Jordi Fornt <jfornt@bsc.es>
 
 import argparse
 import numpy as np
+import json
+import os
+import pickle
 import sys
 
 sys.path.insert(1, './../')
 
 import src.sauria_lib as slib
+import src.execution_model as ex
 import src.test_helper as th
 import src.hw_versions as hwv
 
@@ -58,6 +62,36 @@ if __name__ == "__main__":
     parser.add_argument('--ones_test', action='store_true', help='Set all tensor elements to 1')
     parser.add_argument('--insert_deadbeef', action='store_true', help='Insert regognizable values (0xDEAD, 0xBEEF, 0xBEBE, 0x0FE0) for easy debugging')
     parser.add_argument('--compute_macs', action='store_true', help='Generate compute cycle-accurate MAC results (SLOW)')
+    parser.add_argument('--macs_workers', default=1, help='Worker processes for --compute_macs (independent output tile chains run in parallel, 0 = all cores)')
+    parser.add_argument('--macs_trace_dir', default=None, help='Stream the --compute_macs partial MAC traces to this directory (one npz shard per tile + index.json) instead of keeping them in memory')
+    parser.add_argument('--auto_tiling', action='store_true', help='Replace the tiling of each test by the best one found by the tile-size optimizer')
+    parser.add_argument('--loop_order', default='heuristic', choices=['heuristic', 'search'], help='Loop order of the tiles: fast heuristic, or search for the minimum DRAM traffic over all orders of the controller')
+    parser.add_argument('--golden_check', default='full', choices=['full', 'sampled', 'none'], help='Cross-check of the golden model: full reference convolution, a random sample of output positions, or none')
+    parser.add_argument('--golden_check_samples', default=1024, help='Number of output positions checked with --golden_check sampled')
+    parser.add_argument('--golden_max_mem_MB', default=None, help='Memory budget for the golden model MVM matrices; large layers are computed in chunks of iterations')
+    parser.add_argument('--golden_mode', default='mvm', choices=['mvm', 'hw'], help='FP golden model: FP32 MVM cast to FP16, or the same FP16 FMA sequence as the PEs (bit-exact, vectorized over the outputs)')
+    parser.add_argument('--golden_sparse', default='auto', choices=['auto', 'dense', 'sparse'], help='Golden model MVM: sparse (scipy CSR) when the density of the A or B tensor is below --golden_sparse_threshold (integer data only), always, or never')
+    parser.add_argument('--golden_sparse_threshold', default=0.2, type=float, help='Density below which --golden_sparse auto uses the sparse MVM')
+    parser.add_argument('--no_golden_cache', action='store_true', help='Always recompute the golden model (no cache of golden results)')
+    parser.add_argument('--golden_cache_dir', default=None, help='On-disk tier of the golden result cache, shared across runs')
+    parser.add_argument('--golden_cache_MB', default=1024, type=float, help='Size cap of --golden_cache_dir; least recently used results are evicted')
+    parser.add_argument('--approx_samples', default=None, help='Approximate arithmetic only: skip the RTL simulation and estimate the error statistics (MRED, NMED, max error) from this many random output positions')
+    parser.add_argument('--approx_confidence', default=0.95, type=float, help='Confidence level of the intervals reported by --approx_samples')
+    parser.add_argument('--golden_approx', default='exact', choices=['exact', 'surrogate'], help='Approximate arithmetic golden: bit-accurate FP_Madd chains (SLOW), or exact convolution + MAC errors drawn from a per-configuration characterization')
+    parser.add_argument('--approx_table_dir', default=None, help='Directory of the cached characterization tables of --golden_approx surrogate (default: <test_dir>/approx_tables)')
+    parser.add_argument('--cycle_model', default=None, help='JSON file with the coefficients of the analytical cycle model (default coefficients if not given or not found)')
+    parser.add_argument('--stats_log', default=None, help='Append (CONV, HW parameters, stats) of every simulation to this pickle file, to calibrate the cycle model')
+    parser.add_argument('--calibrate_cycle_model', action='store_true', help='After the tests, fit the cycle model to all simulations in --stats_log and write it to --cycle_model')
+    parser.add_argument('--toggle_heatmap', default=None, help='With --compute_macs, save the per-PE toggle heatmap of every test (operand-toggle power proxy) to this npz file')
+    parser.add_argument('--pe_utilization', default=None, help='Skip the RTL simulation and report the per-PE utilization of every test from its mapping (spatial underuse, edge tiles, zero-gated MACs); the per-PE heatmaps are saved to this npz file')
+    parser.add_argument('--pe_utilization_stats', action='store_true', help='Also report the per-PE utilization of the mapping (spatial underuse, edge tiles, zero-gated MACs) in the statistics of every simulated test')
+    parser.add_argument('--thres', default=0, type=int, help='Negligence threshold of the zero detectors (o_thres, TH_W bits): MACs with both operands in [-2^thres, 2^thres) (int) or with exponent fields below 2^thres (FP) are skipped. 0 = exact zeros only (the RTL applies it when built with +define+NEGLIGENCE)')
+    parser.add_argument('--zero_skip_stats', action='store_true', help='Also count the MACs skipped on exact zeros (one more convolution per test)')
+    parser.add_argument('--batch', default=1, type=int, help='Number of images per convolution test: weights are staged once in DRAM and all images run in a single simulation')
+    parser.add_argument('--groups', default='1', help='Run every test layer as a grouped convolution with this many groups, or dw for depthwise (groups = C_in). Groups are packed into jobs with the cycle model; layers whose channels are not divisible are skipped')
+    parser.add_argument('--compare_naive', action='store_true', help='With --groups, also simulate the naive mapping (one group per job) and report the speedup')
+    parser.add_argument('--matmul', default=None, help='Run a GEMM / fully-connected test C[M,N] = A[M,K] @ B[K,N] + bias instead of --test_type, given as M,K,N (lowered to the best 1x1 convolution mapping)')
+    parser.add_argument('--golden_backend', default='numpy', choices=['numpy', 'torch'], help='Reference convolution used to cross-check the golden model (torch is only imported if selected)')
 
     parser.add_argument('--gauss_scale', default=1.0, help='Scale used for gaussian data')
     parser.add_argument('--pzero_A', default=0.0, help='Probability of 0s in Tensor A')
@@ -89,6 +123,30 @@ if __name__ == "__main__":
         "ones_test" :           True if (args.ones_test) else False,
         "insert_deadbeef" :     True if (args.insert_deadbeef) else False,
         "compute_macs" :        True if (args.compute_macs) else False,
+        "macs_workers" :        int(args.macs_workers),
+        "macs_trace_dir" :      args.macs_trace_dir,
+        "loop_order" :          args.loop_order,
+        "auto_tiling" :         True if (args.auto_tiling) else False,
+        "golden_mode" :         args.golden_mode,
+        "golden_backend" :      args.golden_backend,
+        "golden_check" :        args.golden_check,
+        "golden_check_samples": int(args.golden_check_samples),
+        "golden_max_mem_MB" :   None if (args.golden_max_mem_MB is None) else float(args.golden_max_mem_MB),
+        "golden_sparse" :       args.golden_sparse,
+        "golden_sparse_threshold" : float(args.golden_sparse_threshold),
+        "approx_samples" :      None if (args.approx_samples is None) else int(args.approx_samples),
+        "approx_confidence" :   args.approx_confidence,
+        "golden_approx" :       args.golden_approx,
+        "approx_table_dir" :    args.approx_table_dir if (args.approx_table_dir is not None) else os.path.join(args.test_dir, 'approx_tables'),
+        "cycle_model" :         args.cycle_model,
+        "stats_log" :           args.stats_log,
+        "batch" :               None if (args.batch <= 1) else args.batch,
+        "thres" :               args.thres,
+        "zero_skip_stats" :     True if (args.zero_skip_stats) else False,
+        "groups" :              args.groups,
+        "compare_naive" :       True if (args.compare_naive) else False,
+        "pe_utilization" :      args.pe_utilization,
+        "pe_utilization_stats" : True if (args.pe_utilization_stats) else False,
         "gauss_scale" :         float(args.gauss_scale),
         "pzero_tensors" :       [float(args.pzero_A),float(args.pzero_B),float(args.pzero_C)]
     }
@@ -100,6 +158,28 @@ if __name__ == "__main__":
     # Prepare configuration dict for systolic array model
     SA = slib.get_sa_dict(HW_PARAMS)
 
+    # Golden result cache (in memory, and on disk if a directory is given)
+    ex.configure_golden_cache(enabled=(not args.no_golden_cache), disk_dir=args.golden_cache_dir, disk_max_MB=args.golden_cache_MB)
+
+    # Coefficients of the analytical cycle model
+    CYCLE_COEFS = None
+    if (TOPTS['cycle_model'] is not None) and os.path.exists(TOPTS['cycle_model']):
+        with open(TOPTS['cycle_model']) as f:
+            CYCLE_COEFS = json.load(f)
+
+    # Simulations logged for the calibration of the cycle model
+    STATS_LOG = []
+    if (TOPTS['stats_log'] is not None) and os.path.exists(TOPTS['stats_log']):
+        with open(TOPTS['stats_log'], 'rb') as f:
+            STATS_LOG = pickle.load(f)
+
+    # Per-PE toggle heatmaps of the power proxy
+    TOGGLE_MAPS = {}
+    assert (args.toggle_heatmap is None) or args.compute_macs, "--toggle_heatmap needs --compute_macs"
+
+    # Per-PE utilization heatmaps of --pe_utilization
+    UTIL_MAPS = {}
+
     # Prepare tests
     TESTS, TILEINFO, LIMITS = th.generate_tests(TOPTS, HW_PARAMS, int(args.n_random_tests))
 
@@ -109,6 +189,11 @@ if __name__ == "__main__":
     if (TOPTS['test_type']=='debug_test'):
         th.run_cfg_test(HW_PARAMS, TOPTS['assert_no_errors'], test_dir=args.test_dir)
 
+    # GEMM test, lowered to a 1x1 convolution
+    elif (args.matmul is not None):
+        M, K, N = [int(dim) for dim in args.matmul.split(',')]
+        slib.generate_and_run_matmul(M, K, N, HW_PARAMS, bias=True, loop_order_mode=TOPTS['loop_order'], golden_mode=TOPTS['golden_mode'], thres=TOPTS['thres'], pzero_tensors=TOPTS['pzero_tensors'], gauss_scale=TOPTS['gauss_scale'], ones_test=TOPTS['ones_test'], assert_no_errors=TOPTS['assert_no_errors'], print_statistics=True, cycle_coefs=CYCLE_COEFS, test_dir=args.test_dir, silent=silent)
+
     # Normal convolution tests
     else:
         # Loop over all tests to be performed
@@ -135,13 +220,63 @@ if __name__ == "__main__":
 
             preload = TESTS[10][i]
 
+            # Automatic tiling: best candidate of the optimizer
+            if TOPTS['auto_tiling']:
+                TILING_DICT = slib.optimize_tiling(tensor_shapes, d, s, HW_PARAMS, top_n=1)[0]
+
             if not silent:
                 print("------------------------------------------------------------------------------------------------------------------------")
                 print("Test number {}".format(i+1))
                 print("PSum size: [{},{},{}] | Weight size: [{},{},{},{}] | Input size: [{},{},{}] | d={}, s={}, p={}".format(tensor_shapes[2][0],tensor_shapes[2][1],tensor_shapes[2][2],tensor_shapes[1][0],tensor_shapes[1][1],tensor_shapes[1][2],tensor_shapes[1][3],tensor_shapes[0][0],tensor_shapes[0][1],tensor_shapes[0][2],d,s,0))
-                print("Tile size: [{},{},{}] | C_in tile size: {} | X_used: {}, Y_used: {} ".format(TILEINFO[1][i],TILEINFO[2][i],TILEINFO[3][i],TILEINFO[0][i],TESTS[8][i],TESTS[9][i]))
+                print("Tile size: [{},{},{}] | C_in tile size: {} | X_used: {}, Y_used: {} ".format(TILING_DICT['C_tile_shape'][0],TILING_DICT['C_tile_shape'][1],TILING_DICT['C_tile_shape'][2],TILING_DICT['tile_cin'],TILING_DICT['X_used'],TILING_DICT['Y_used']))
                 print("------------------------------------------------------------------------------------------------------------------------")
                 
+            # Grouped / depthwise convolution (the tiling is chosen with the group packing)
+            if TOPTS['groups'] != '1':
+                groups = tensor_shapes[0][0] if (TOPTS['groups'] == 'dw') else int(TOPTS['groups'])
+                if (tensor_shapes[0][0]%groups != 0) or (tensor_shapes[2][0]%groups != 0):
+                    if not silent: print("Channels not divisible by {} groups, skipping test".format(groups))
+                    continue
+
+                tensor_shapes[1][1] = tensor_shapes[0][0]//groups
+                slib.generate_and_run_grouped_test(tensor_shapes, groups, d, s, HW_PARAMS, preload=preload, loop_order_mode=TOPTS['loop_order'], golden_mode=TOPTS['golden_mode'], thres=TOPTS['thres'], pzero_tensors=TOPTS['pzero_tensors'], gauss_scale=TOPTS['gauss_scale'], ones_test=TOPTS['ones_test'], compare_naive=TOPTS['compare_naive'], assert_no_errors=TOPTS['assert_no_errors'], print_statistics=TOPTS['print_statistics'], cycle_coefs=CYCLE_COEFS, test_dir=args.test_dir, silent=silent)
+                continue
+
+            # Accuracy study of approximate arithmetic: sampled golden only
+            if TOPTS['approx_samples'] is not None:
+                slib.generate_and_evaluate_approx(tensor_shapes, TILING_DICT, d, s, HW_PARAMS, preload=preload, n_samples=TOPTS['approx_samples'], confidence=TOPTS['approx_confidence'], surrogate=(TOPTS['golden_approx']=='surrogate'), approx_table_dir=TOPTS['approx_table_dir'], thres=TOPTS['thres'], pzero_tensors=TOPTS['pzero_tensors'], gauss_scale=TOPTS['gauss_scale'], ones_test=TOPTS['ones_test'], print_statistics=True, silent=silent)
+                continue
+
+            # Per-PE utilization from the mapping only
+            if TOPTS['pe_utilization'] is not None:
+                UTIL = slib.generate_and_report_utilization(tensor_shapes, TILING_DICT, d, s, HW_PARAMS, preload=preload, thres=TOPTS['thres'], pzero_tensors=TOPTS['pzero_tensors'], gauss_scale=TOPTS['gauss_scale'], ones_test=TOPTS['ones_test'], print_statistics=True, silent=silent)
+                for loss in ['macs', 'gated', 'spatial', 'edge']:
+                    UTIL_MAPS['test_{}_{}'.format(i+1, loss)] = UTIL['heatmap_'+loss]
+                np.savez(TOPTS['pe_utilization'], **UTIL_MAPS)
+                continue
+
             # Generate random values and run convolution
-            slib.generate_and_run_test(tensor_shapes, TILING_DICT, d, s, HW_PARAMS, preload=preload, generate_vcd=False, pzero_tensors=TOPTS['pzero_tensors'], insert_deadbeef=TOPTS['insert_deadbeef'], gauss_scale=TOPTS['gauss_scale'], ones_test=TOPTS['ones_test'], print_statistics=TOPTS['print_statistics'], assert_no_errors=TOPTS['assert_no_errors'], test_dir=args.test_dir, silent=silent)
+            _, stats, _ = slib.generate_and_run_test(tensor_shapes, TILING_DICT, d, s, HW_PARAMS, preload=preload, compute_macs=TOPTS['compute_macs'], macs_workers=TOPTS['macs_workers'], macs_trace_dir=TOPTS['macs_trace_dir'], loop_order_mode=TOPTS['loop_order'], generate_vcd=False, pzero_tensors=TOPTS['pzero_tensors'], insert_deadbeef=TOPTS['insert_deadbeef'], gauss_scale=TOPTS['gauss_scale'], ones_test=TOPTS['ones_test'], print_statistics=TOPTS['print_statistics'], assert_no_errors=TOPTS['assert_no_errors'], golden_mode=TOPTS['golden_mode'], golden_backend=TOPTS['golden_backend'], golden_check=TOPTS['golden_check'], golden_check_samples=TOPTS['golden_check_samples'], golden_max_mem_MB=TOPTS['golden_max_mem_MB'], golden_sparse=TOPTS['golden_sparse'], golden_sparse_threshold=TOPTS['golden_sparse_threshold'], golden_approx=TOPTS['golden_approx'], approx_table_dir=TOPTS['approx_table_dir'], cycle_coefs=CYCLE_COEFS, batch=TOPTS['batch'], thres=TOPTS['thres'], zero_skip_stats=TOPTS['zero_skip_stats'], pe_utilization=TOPTS['pe_utilization_stats'], test_dir=args.test_dir, silent=silent)
+
+            if args.toggle_heatmap is not None:
+                TOGGLE_MAPS['test_{}'.format(i+1)] = stats['pe_toggle_heatmap']
+                np.savez(args.toggle_heatmap, **TOGGLE_MAPS)
+
+            # Only single-image runs are logged (the cycle model predicts one image)
+            if (TOPTS['stats_log'] is not None) and (TOPTS['batch'] is None):
+                STATS_LOG.append((slib.get_conv_dict(tensor_shapes, TILING_DICT, HW_PARAMS, preloads=preload, d=d, s=s, thres=TOPTS['thres']), HW_PARAMS, stats))
+                with open(TOPTS['stats_log'], 'wb') as f:
+                    pickle.dump(STATS_LOG, f)
+
+        # Fit the cycle model to all logged simulations
+        if args.calibrate_cycle_model:
+            assert (TOPTS['stats_log'] is not None) and (TOPTS['cycle_model'] is not None), "--calibrate_cycle_model needs --stats_log and --cycle_model"
+
+            CYCLE_COEFS, REPORT = ex.calibrate_cycle_model(STATS_LOG, loop_order_mode=TOPTS['loop_order'], coefs=CYCLE_COEFS)
+            with open(TOPTS['cycle_model'], 'w') as f:
+                json.dump(CYCLE_COEFS, f, indent=4)
+
+            print("Cycle model calibrated with {} simulations:".format(REPORT['N_samples']))
+            for key in ex.CYCLE_MODEL_TARGETS.values():
+                print("{}:\tmean error {:.2f} % -> {:.2f} % | max error {:.2f} % -> {:.2f} %".format(key, 100*REPORT[key]['before']['mean_rel_error'], 100*REPORT[key]['after']['mean_rel_error'], 100*REPORT[key]['before']['max_rel_error'], 100*REPORT[key]['after']['max_rel_error']))
             
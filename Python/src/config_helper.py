@@ -338,22 +338,74 @@ def get_sauria_regs(CONV, HYPER, silent=True):
     return register_config, TOTAL_REGS
 
 # ----------------------------
-# Generate SAURIA controller config regs
+# Tile loop limits and DRAM strides (in elements)
 # ----------------------------
 
-def get_controller_regs(CONV, sauria_regs, N_REGS, dram_base_addresses, loop_order, silent=True):
+# Tile sizes and counts come from CONV. For the jobs of a ragged layer, the tensor
+# sizes (DRAM strides) come from the whole layer (CONV_full).
+
+def get_tile_strides(CONV, WXfer_op=True, CONV_full=None):
+
+    if CONV_full is None:
+        CONV_full = CONV
 
     Bw = CONV['B_w']
     Bh = CONV['B_h']
     s = CONV['s']
-    d = CONV['d']
 
-    Cw = CONV['C_w']
-    Ch = CONV['C_h']
-    Ck = CONV['C_c']
-    Aw = CONV['A_w']
-    Ah = CONV['A_h']
-    Ac = CONV['A_c']
+    Cw = CONV_full['C_w']
+    Ch = CONV_full['C_h']
+    Ck = CONV_full['C_c']
+    Aw = CONV_full['A_w']
+    Ah = CONV_full['A_h']
+    Ac = CONV_full['A_c']
+    
+    Cw_til = CONV['w_til']
+    Ch_til = CONV['h_til']
+    Ck_til = CONV['k_til']
+    Ac_til = CONV['c_til']
+
+    STRIDES = {
+        'tile_x_lim' :          int(CONV['C_w']/Cw_til) - 1,
+        'tile_y_lim' :          int(CONV['C_h']/Ch_til) - 1,
+        'tile_k_lim' :          int(CONV['C_c']/Ck_til) - 1,
+        'tile_c_lim' :          int(CONV['A_c']/Ac_til) - 1,
+
+        'tile_psums_x_step' :   Cw_til,
+        'tile_psums_y_step' :   Ch_til*Cw,
+        'tile_psums_k_step' :   Ck_til*Cw*Ch,
+
+        'tile_ifmaps_x_step' :  s*Cw_til,
+        'tile_ifmaps_y_step' :  s*Ch_til*Aw,
+        'tile_ifmaps_c_step' :  Ac_til*Aw*Ah,
+    }
+
+    # Weights optimized for memory transfers: [K_tiles, C_tiles, c_til, K_h, K_w, k_til]
+    if WXfer_op:
+        STRIDES['tile_weights_k_step'] = Ck_til*Bw*Bh*Ac
+        STRIDES['tile_weights_c_step'] = Ck_til*Bw*Bh*Ac_til
+
+    # Original weights: [C_out, C_in, K_h, K_w]
+    else:
+        STRIDES['tile_weights_k_step'] = Ck_til
+        STRIDES['tile_weights_c_step'] = Ac_til*Ck*Bw*Bh
+
+    return STRIDES
+
+# ----------------------------
+# Generate SAURIA controller config regs
+# ----------------------------
+
+def get_controller_regs(CONV, sauria_regs, N_REGS, dram_base_addresses, loop_order, CONV_full=None, silent=True):
+
+    if CONV_full is None:
+        CONV_full = CONV
+
+    Cw = CONV_full['C_w']
+    Ch = CONV_full['C_h']
+    Ck = CONV_full['C_c']
+    Aw = CONV_full['A_w']
+    Ah = CONV_full['A_h']
     
     Cw_til = CONV['w_til']
     Ch_til = CONV['h_til']
@@ -365,27 +417,28 @@ def get_controller_regs(CONV, sauria_regs, N_REGS, dram_base_addresses, loop_ord
     # WXfer_op -> always optimize weights shape for memory transfers
     WXfer_op = True
 
-    tile_x_lim = int(Cw/Cw_til) - 1
-    tile_y_lim = int(Ch/Ch_til) - 1
-    tile_k_lim = int(Ck/Ck_til) - 1
-    tile_c_lim = int(Ac/Ac_til) - 1
+    STRIDES = get_tile_strides(CONV, WXfer_op=WXfer_op, CONV_full=CONV_full)
+
+    tile_x_lim = STRIDES['tile_x_lim']
+    tile_y_lim = STRIDES['tile_y_lim']
+    tile_k_lim = STRIDES['tile_k_lim']
+    tile_c_lim = STRIDES['tile_c_lim']
     
-    tile_psums_x_step = Cw_til
-    tile_psums_y_step = Ch_til*Cw
-    tile_psums_k_step = Ck_til*Cw*Ch
+    tile_psums_x_step = STRIDES['tile_psums_x_step']
+    tile_psums_y_step = STRIDES['tile_psums_y_step']
+    tile_psums_k_step = STRIDES['tile_psums_k_step']
     
-    tile_ifmaps_x_step = s*Cw_til
-    tile_ifmaps_y_step = s*Ch_til*Aw
-    tile_ifmaps_c_step = Ac_til*Aw*Ah
+    tile_ifmaps_x_step = STRIDES['tile_ifmaps_x_step']
+    tile_ifmaps_y_step = STRIDES['tile_ifmaps_y_step']
+    tile_ifmaps_c_step = STRIDES['tile_ifmaps_c_step']
+
+    tile_weights_k_step = STRIDES['tile_weights_k_step']
+    tile_weights_c_step = STRIDES['tile_weights_c_step']
     
     if WXfer_op:
-        tile_weights_k_step = Ck_til*Bw*Bh*Ac
-        tile_weights_c_step = Ck_til*Bw*Bh*Ac_til
         dma_weights_w_step = Ck_til     # Meaning is different!
         Ck_eq = True
     else:
-        tile_weights_k_step = Ck_til
-        tile_weights_c_step = Ac_til*Ck*Bw*Bh
         dma_weights_w_step = Ck
         Ck_eq = (Ck == Ck_til)
 
@@ -485,7 +538,9 @@ def rd_transaction(idx, cfg_list, address, data_gold, check_golden=True):
 
 def generate_controller_cmds(controller_regs, N_VECTORS, HOPTS):
 
-    ctrl_regs_array = np.array(controller_regs, dtype=np.uint64).astype(np.int64)
+    # One list of controller registers per job, jobs are executed in order
+    if np.ndim(controller_regs[0]) == 0:
+        controller_regs = [controller_regs]
 
     # Create control words
     cfg_address = np.zeros((N_VECTORS), dtype=np.uint32)
@@ -505,19 +560,23 @@ def generate_controller_cmds(controller_regs, N_VECTORS, HOPTS):
     # Enable interrupts initially
     idx = wr_transaction(idx,cfg, offs+0x8,3)
 
-    # Write cfg registers
-    for i, reg in enumerate(ctrl_regs_array):
-        idx = wr_transaction(idx,cfg, offs+0x10+(i<<2),reg)
+    for job_regs in controller_regs:
+
+        ctrl_regs_array = np.array(job_regs, dtype=np.uint64).astype(np.int64)
+
+        # Write cfg registers
+        for i, reg in enumerate(ctrl_regs_array):
+            idx = wr_transaction(idx,cfg, offs+0x10+(i<<2),reg)
 
-    # Start control FSM
-    idx = wr_transaction(idx,cfg, offs+0x0,3)
+        # Start control FSM
+        idx = wr_transaction(idx,cfg, offs+0x0,3)
 
-    # Wait for completion
-    cfg_waitflag[idx] =   1
-    idx+=1
+        # Wait for completion
+        cfg_waitflag[idx] =   1
+        idx+=1
 
-    # Lower interrupts
-    idx = wr_transaction(idx,cfg, offs+0xC,3)
+        # Lower interrupts
+        idx = wr_transaction(idx,cfg, offs+0xC,3)
 
     # READ STATISTICS - Total cycle counter
     idx = rd_transaction(idx,cfg, HOPTS['CORE_offset']+0x14,0,check_golden=False)
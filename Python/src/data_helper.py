@@ -184,7 +184,7 @@ def gen_random_tensor(shape, pzero, bit_width, FP=False, distribution='unif', ga
 # Generate the three random tensors for a convolution (A,B,C)
 # --------------------------------------------------------------
 
-def generate_tensors(CONV, HYPER, pzero=[0,0,0], insert_deadbeef=True, gauss_scale=1, ones_test=False):
+def generate_tensors(CONV, HYPER, pzero=[0,0,0], insert_deadbeef=True, gauss_scale=1, ones_test=False, batch=None):
     
     # Retrieve tensor shapes
     B_w = CONV['B_w']
@@ -198,15 +198,18 @@ def generate_tensors(CONV, HYPER, pzero=[0,0,0], insert_deadbeef=True, gauss_sca
     
     # Random distribution
     distribution = 'gauss' if (HYPER['OP_TYPE']==1) else 'unif'
+
+    # Batch of images: A and C get a leading batch dimension, B is shared
+    N_shape = [] if (batch is None) else [batch]
                    
     # Activations tensor
-    A_tensor = gen_random_tensor([A_c,A_h,A_w], pzero[0], HYPER['IA_W'], HYPER['OP_TYPE'], distribution, gauss_scale=gauss_scale, ones_test=ones_test)
+    A_tensor = gen_random_tensor(N_shape+[A_c,A_h,A_w], pzero[0], HYPER['IA_W'], HYPER['OP_TYPE'], distribution, gauss_scale=gauss_scale, ones_test=ones_test)
             
     # Weights tensor
     B_tensor = gen_random_tensor([C_c,A_c,B_h,B_w], pzero[1], HYPER['IB_W'], HYPER['OP_TYPE'], distribution, gauss_scale=gauss_scale, ones_test=ones_test)
     
     # Partial sums tensor
-    C_tensor = gen_random_tensor([C_c,C_h,C_w], pzero[2], HYPER['OC_W'], HYPER['OP_TYPE'], distribution, gauss_scale=gauss_scale, ones_test=ones_test)
+    C_tensor = gen_random_tensor(N_shape+[C_c,C_h,C_w], pzero[2], HYPER['OC_W'], HYPER['OP_TYPE'], distribution, gauss_scale=gauss_scale, ones_test=ones_test)
             
     # FOR EASY DEBUGGING, PUT SOME RECOGNIZABLE VALUES
     if insert_deadbeef:
@@ -218,11 +221,11 @@ def generate_tensors(CONV, HYPER, pzero=[0,0,0], insert_deadbeef=True, gauss_sca
             B_tensor[:,0,0,0] =         decode_FP(0xbeef, MANT_W, EXP_W)
             B_tensor[:,-1,-1,-1] =      decode_FP(0xbeef, MANT_W, EXP_W)
             
-            C_tensor[0,:,0] =                                   decode_FP(0xbeef, MANT_W, EXP_W)
-            C_tensor[CONV['X_used']-1,:,:] =                    decode_FP(0xdead, MANT_W, EXP_W)
-            C_tensor[0,:,CONV['Y_used']-1] =                    decode_FP(0xbebe, MANT_W, EXP_W)
-            C_tensor[CONV['X_used']-1,:,CONV['Y_used']-1] =     decode_FP(0xfe0, MANT_W, EXP_W)
-            C_tensor[-1,:,-1] =                                 decode_FP(0xfe0, MANT_W, EXP_W)            
+            C_tensor[...,0,:,0] =                                   decode_FP(0xbeef, MANT_W, EXP_W)
+            C_tensor[...,CONV['X_used']-1,:,:] =                    decode_FP(0xdead, MANT_W, EXP_W)
+            C_tensor[...,0,:,CONV['Y_used']-1] =                    decode_FP(0xbebe, MANT_W, EXP_W)
+            C_tensor[...,CONV['X_used']-1,:,CONV['Y_used']-1] =     decode_FP(0xfe0, MANT_W, EXP_W)
+            C_tensor[...,-1,:,-1] =                                 decode_FP(0xfe0, MANT_W, EXP_W)            
 
         else:
             IB_MASK = ((2**HYPER['IB_W']) - 1)
@@ -231,11 +234,11 @@ def generate_tensors(CONV, HYPER, pzero=[0,0,0], insert_deadbeef=True, gauss_sca
             B_tensor[:,0,0,0] =         -1*((16657)&IB_MASK)     #0xBEEF
             B_tensor[:,-1,-1,-1] =      -1*((16657)&IB_MASK)     #0xBEEF
             
-            C_tensor[0,:,0] =                                   0xBEEF & OC_MASK
-            C_tensor[CONV['X_used']-1,:,:] =                    0xDEAD & OC_MASK
-            C_tensor[0,:,CONV['Y_used']-1] =                    0xBEBE & OC_MASK
-            C_tensor[CONV['X_used']-1,:,CONV['Y_used']-1] =     0x0FE0 & OC_MASK
-            C_tensor[-1,:,-1] =                                 0x0FE0 & OC_MASK    
+            C_tensor[...,0,:,0] =                                   0xBEEF & OC_MASK
+            C_tensor[...,CONV['X_used']-1,:,:] =                    0xDEAD & OC_MASK
+            C_tensor[...,0,:,CONV['Y_used']-1] =                    0xBEBE & OC_MASK
+            C_tensor[...,CONV['X_used']-1,:,CONV['Y_used']-1] =     0x0FE0 & OC_MASK
+            C_tensor[...,-1,:,-1] =                                 0x0FE0 & OC_MASK    
         
     # If preload enable is zero, all C values start at zero
     if CONV['preload_en'] == 0: C_tensor[:] = 0
@@ -315,6 +318,24 @@ def optimize_weight_tensor_shape(B_tensor, CONV):
     # Final tensor is: [K_tiles, C_tiles, c_til, K_h, K_w, k_til]
     return B_tensor_opt
 
+# Ragged layers (edge tiles): same layout, but edge blocks are smaller
+# -> Flat concatenation of blocks [K_tiles][C_tiles] of [c_size, K_h, K_w, k_size]
+
+def optimize_ragged_weight_tensor_shape(B_tensor, CONV):
+
+    k_til = CONV['k_til']
+    c_til = CONV['c_til']
+
+    blocks = []
+    for k0 in range(0, CONV['C_c'], k_til):
+        for c0 in range(0, CONV['AB_c'], c_til):
+
+            # [k_size, c_size, K_h, K_w] -> [c_size, K_h, K_w, k_size]
+            B_block = B_tensor[k0:k0+k_til, c0:c0+c_til]
+            blocks.append(np.moveaxis(B_block, 0, -1).flatten())
+
+    return np.concatenate(blocks)
+
 # ------------------------------------------------------
 # Writes the tensors into a DRAM memory region
 # ------------------------------------------------------
@@ -20,19 +20,28 @@ Jordi Fornt <jfornt@bsc.es>
 """
 
 import numpy as np
-import torch
+import scipy.sparse as sparse
+import scipy.optimize as optimize
+import scipy.stats as stats
 import copy
 import sys
+import os
+import hashlib
+import pickle
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
 sys.path.insert(1, './../')
 from src.approx_comp.fp import FP_Madd
 import src.test_helper as th
+import src.file_helper as fh
+import src.config_helper as cfg
 
 # --------------------------------------------
 # Custom matrix multiplication with extra options
 # --------------------------------------------
 
-def custom_matmul(Mat_A, Mat_B, preloads=[], exact=True, MANT_bits=10, N_bits=16, mul_type=0, M=0, add_type=0, A=0, rounding='RNE'):
+def custom_matmul(Mat_A, Mat_B, preloads=[], exact=True, MANT_bits=10, N_bits=16, mul_type=0, M=0, add_type=0, A=0, rounding='RNE', thres=0):
     
     A_shape = Mat_A.shape
     B_shape = Mat_B.shape
@@ -59,159 +68,54 @@ def custom_matmul(Mat_A, Mat_B, preloads=[], exact=True, MANT_bits=10, N_bits=16
                     if exact:
                         Mat_C[k, j, i] += Mat_A[k, j, t] * Mat_B[k, t, i]
                     else:
-                        # Zero gating => Quite important for efficiency!
-                        if (Mat_A[k, j, t]!=0) and (Mat_B[k, t, i]!=0):
+                        # Zero gating => Quite important for efficiency! (and negligence, as the PEs)
+                        if (Mat_A[k, j, t]!=0) and (Mat_B[k, t, i]!=0) and ((thres == 0) or get_mac_gate(Mat_A[k, j, t], Mat_B[k, t, i], thres, FP=True)):
                             _, _, Mat_C[k, j, i] = FP_Madd(Mat_A[k, j, t], Mat_B[k, t, i], Mat_C[k, j, i], MANT_bits=MANT_bits, N_bits=N_bits, MulType=mul_type, m=M, AdderType=add_type, A=A, rounding=rounding)
     
     return Mat_C
 
 # --------------------------------------------
-# Accurate im2col performed by SAURIA
+# im2col - Reference (scalar loops, as in the hardware order)
 # --------------------------------------------
 
-def map_conv_to_MVM(SA_Param_dict, random_tensors=True, A_tensor=[], B_conv=[], preloads=[], data_type='FP', silent=False):
-    """
-    
-    TO-DO
-
-    Parameters
-    ----------
-    SA_Param_dict : TYPE
-        DESCRIPTION.
-
-    Returns
-    -------
-    N_inputs : TYPE
-        DESCRIPTION.
-    X_underuse : TYPE
-        DESCRIPTION.
-    Y_underuse : TYPE
-        DESCRIPTION.
-    tensor_C_mvm : TYPE
-        DESCRIPTION.
-    tensor_C : TYPE
-        DESCRIPTION.
-
-    """
-    
-    # -----------------------------------------------------------------------------
-    # Load constants from dict
-    # ----------------------------------------------------------------------------- 
-    
-    A_w = SA_Param_dict['A_w']
-    A_h = SA_Param_dict['A_h']
-    AB_c = SA_Param_dict['AB_c']
-    
-    B_w = SA_Param_dict['B_w']
-    B_h = SA_Param_dict['B_h']
-    B_k = SA_Param_dict['B_k']
+def im2col_reference(tensor_A, tensor_B, SA_Param_dict):
 
-    d = SA_Param_dict['d']
     s = SA_Param_dict['s']
-
-    B_w_eff = 1 + (B_w - 1)*d
-    B_h_eff = 1 + (B_h - 1)*d
-
+    d = SA_Param_dict['d']
     C_w = SA_Param_dict['C_w']
     C_h = SA_Param_dict['C_h']
     C_c = SA_Param_dict['C_c']
-    
     size_Y = SA_Param_dict['size_Y']
     size_X = SA_Param_dict['size_X']
-    
-    OS_buff_K = SA_Param_dict['OS_buff_K']
-    
-    # -----------------------------------------------------------------------------
-    # ATOMIC TENSOR PRIMITIVES
-    # ----------------------------------------------------------------------------- 
-    
-    atm_C_c = size_X        # Iterable (Architectural)
-    atm_C_w = size_Y        # Iterable (Architectural)
-    atm_C_h = OS_buff_K     # Iterable
-    
-    atm_A_c = AB_c                                  # Reductible
-    atm_A_w = s*size_Y + B_w_eff - (B_w_eff%2)      # Iterable (Architectural)
-    atm_A_h = OS_buff_K*B_h_eff                     # Iterable
-    
-    atm_B_k = size_X    # Iterable (Architectural)
-    atm_B_c = AB_c      # Reductible
-    atm_B_w = B_w       # Reductible 
-    atm_B_h = B_h       # Reductible
-    
-    # Write tensor primitives to param dict
-    SA_Param_dict['atm_C_c'] = atm_C_c
-    SA_Param_dict['atm_C_w'] = atm_C_w
-    SA_Param_dict['atm_C_h'] = atm_C_h
-    
-    SA_Param_dict['atm_A_c'] = atm_A_c
-    SA_Param_dict['atm_A_w'] = atm_A_w
-    SA_Param_dict['atm_A_h'] = atm_A_h
-    
-    SA_Param_dict['atm_B_k'] = atm_B_k
-    SA_Param_dict['atm_B_c'] = atm_B_c
-    SA_Param_dict['atm_B_w'] = atm_B_w
-    SA_Param_dict['atm_B_h'] = atm_B_h
-
     X_used = SA_Param_dict['X_used']
     Y_used = SA_Param_dict['Y_used']
 
-    # -----------------------------------------------------------------------------
-    # Number of iterations and number of MVM inputs
-    # ----------------------------------------------------------------------------- 
+    atm_C_c = SA_Param_dict['atm_C_c']
+    atm_C_w = SA_Param_dict['atm_C_w']
+    atm_C_h = SA_Param_dict['atm_C_h']
+    atm_B_c = SA_Param_dict['atm_B_c']
+    atm_B_w = SA_Param_dict['atm_B_w']
+    atm_B_h = SA_Param_dict['atm_B_h']
+
+    x_id_itr_max = np.ceil(C_w/Y_used).astype(int)
+    y_id_itr_max = np.ceil(C_h/atm_C_h).astype(int)
+    z_id_itr_max = np.ceil(C_c/X_used).astype(int)
+
+    N_inputs = z_id_itr_max*y_id_itr_max*x_id_itr_max*atm_B_c*atm_B_h*atm_B_w*atm_C_h
 
-    # Number of iterations (for Iterable dimensions)
-    n_iter_z = np.ceil(C_c/X_used)
-    n_iter_y = np.ceil(C_h/atm_C_h)
-    n_iter_x = np.ceil(C_w/Y_used)
-    
-    N_iter = n_iter_z*n_iter_y*n_iter_x
-    N_iter = N_iter.astype(int)
-    
-    # Input vectors per iteration (Reductible dimensions)
-    N_inputs_per_it = atm_C_h*B_w*B_h*AB_c
-    
-    # Total input vectors
-    N_inputs = N_inputs_per_it*N_iter
-    N_inputs = N_inputs.astype(int)
-        
     # Utilization: Architectural Iterable dimensions
     remaining_C_c = X_used
     remaining_C_w = Y_used
-    
-    ucoef_C_c = C_c/(n_iter_z*atm_C_c)
-    ucoef_C_w = C_w/(n_iter_x*atm_C_w)
-    
-    # --------------------------------------------------------------------------------
-    # ACTUAL MAPPING + UTILIZATION + CHECK
-    # --------------------------------------------------------------------------------
 
-    # Define pytorch values
-    if random_tensors:
-        tensor_A_torch = torch.randn(AB_c, A_h, A_w, dtype=torch.float32) * 100
-        m = torch.nn.Conv2d(AB_c, B_k, (B_h, B_w), stride=s, dilation=d)
-    else:
-        tensor_A_torch = A_tensor
-        m = B_conv
-        
-    m.weight.requires_grad = False
-    
-    #TEST
-    # tensor_A_torch = torch.tensor(np.ones((AB_c, A_h, A_w), dtype=np.float32))
-    # m.weight = torch.nn.Parameter(torch.tensor(np.ones((B_k, AB_c, B_h, B_w), dtype=np.float32)))
-    # m.weight.requires_grad = False
-    
-    tensor_A = np.array(tensor_A_torch).astype(np.float32)
-    tensor_B = np.array(m.weight).astype(np.float32)
-    
+    ucoef_C_c = C_c/(z_id_itr_max*atm_C_c)
+    ucoef_C_w = C_w/(x_id_itr_max*atm_C_w)
+
     A_Mat = np.zeros((N_inputs, size_Y)).astype(np.float32)
     B_Mat = np.zeros((N_inputs, size_X)).astype(np.float32)
     
     X_underuse = np.zeros((N_inputs)).astype(bool)
     Y_underuse = np.zeros((N_inputs)).astype(bool)
     
-    x_id_itr_max = np.ceil(C_w/Y_used).astype(int)
-    y_id_itr_max = np.ceil(C_h/atm_C_h).astype(int)
-    z_id_itr_max = np.ceil(C_c/X_used).astype(int)
     
     input_idx = 0
     
@@ -261,171 +165,1615 @@ def map_conv_to_MVM(SA_Param_dict, random_tensors=True, A_tensor=[], B_conv=[],
     
     assert input_idx == N_inputs, "There was a mapping issue, number of input vectors does not match"
 
-    # -----------------------------------------------------------------------------
-    # Check mapping: compare random results between MVM and Pytorch
-    # ----------------------------------------------------------------------------- 
+    return A_Mat, B_Mat, X_underuse, Y_underuse
 
-    # Convolution results with torch
-    tensor_A_torch = torch.reshape(tensor_A_torch, (1, tensor_A.shape[0], tensor_A.shape[1], tensor_A.shape[2]))
-    tensor_C_torch = m(tensor_A_torch)
-    
-    tensor_C = np.array(tensor_C_torch.detach())
-    tensor_C = tensor_C.reshape((C_c, C_h, C_w))
-    
-    preloads_mvm = np.zeros((N_iter, size_Y, size_X ))
-    
-    # Add Cinit after the convolution
-    if (len(preloads)>0):
-        tensor_C = tensor_C + preloads
-    
-        # Reshape preloads properly
-        for z in range(C_c):
-            for y in range(C_h):
-                for x in range(C_w):
-                    
-                    z_mvm_idx = int(z%X_used)
-                    x_mvm_idx = int(x%Y_used)
-                    
-                    vector_idx = int((z//X_used)*y_id_itr_max*x_id_itr_max + y*x_id_itr_max + x//Y_used)
-        
-                    preloads_mvm[vector_idx , x_mvm_idx, z_mvm_idx] = preloads[z,y,x]
-        
-    # Split the batches in order to compute the MVM
-    A_Mat_mvm = np.swapaxes(np.reshape(A_Mat, (N_iter, N_inputs_per_it, size_Y)), 1,2)
-    B_Mat_mvm = np.reshape(B_Mat, (N_iter, N_inputs_per_it, size_X))
-    
-    # Typecast when we operate with integer values
-    if (data_type=='int'):
-        A_Mat_mvm = A_Mat_mvm.astype(np.int64)
-        B_Mat_mvm = B_Mat_mvm.astype(np.int64)
-    
-    # MVM results
-    if not SA_Param_dict['approx_comp']:
-        C_Mat_mvm = np.matmul(A_Mat_mvm, B_Mat_mvm) + preloads_mvm
+# --------------------------------------------
+# im2col - Vectorized with strided views
+# --------------------------------------------
+
+def im2col_strided(tensor_A, tensor_B, SA_Param_dict, iter_start=0, iter_stop=None, dtype=np.float32):
+
+    s = SA_Param_dict['s']
+    d = SA_Param_dict['d']
+    C_w = SA_Param_dict['C_w']
+    C_h = SA_Param_dict['C_h']
+    C_c = SA_Param_dict['C_c']
+    size_Y = SA_Param_dict['size_Y']
+    size_X = SA_Param_dict['size_X']
+    X_used = SA_Param_dict['X_used']
+    Y_used = SA_Param_dict['Y_used']
+
+    atm_C_c = SA_Param_dict['atm_C_c']
+    atm_C_w = SA_Param_dict['atm_C_w']
+    atm_C_h = SA_Param_dict['atm_C_h']
+    atm_B_c = SA_Param_dict['atm_B_c']
+    atm_B_w = SA_Param_dict['atm_B_w']
+    atm_B_h = SA_Param_dict['atm_B_h']
+
+    x_id_itr_max = np.ceil(C_w/Y_used).astype(int)
+    y_id_itr_max = np.ceil(C_h/atm_C_h).astype(int)
+    z_id_itr_max = np.ceil(C_c/X_used).astype(int)
+
+    N_inputs = z_id_itr_max*y_id_itr_max*x_id_itr_max*atm_B_c*atm_B_h*atm_B_w*atm_C_h
+
+    ucoef_C_c = C_c/(z_id_itr_max*atm_C_c)
+    ucoef_C_w = C_w/(x_id_itr_max*atm_C_w)
+
+    # Columns (X) and rows (Y) of the array that actually receive data
+    n_cols = min(X_used, size_X)
+    n_rows = min(Y_used, size_Y)
+
+    tensor_A = np.ascontiguousarray(tensor_A, dtype=dtype)
+    tensor_B = np.ascontiguousarray(tensor_B, dtype=dtype)
+
+    # The scalar loops would raise an IndexError here, so we check the bounds explicitly
+    max_row = atm_C_h*s*(y_id_itr_max-1) + d*(atm_B_h-1) + s*(atm_C_h-1)
+    max_col = Y_used*s*(x_id_itr_max-1) + d*(atm_B_w-1) + s*(n_rows-1)
+    assert max_row < tensor_A.shape[1] and max_col < tensor_A.shape[2], "Activation tensor is too small for the mapping"
+    assert X_used*(z_id_itr_max-1) + n_cols <= tensor_B.shape[0], "Weight tensor is too small for the mapping"
+
+    # A: zero-copy view with one axis per loop index => [y_itr, x_itr, kz, ky, kx, ofmap_y, ofmap_x]
+    st_c, st_h, st_w = tensor_A.strides
+    A_view = np.lib.stride_tricks.as_strided(tensor_A,
+                shape=(y_id_itr_max, x_id_itr_max, atm_B_c, atm_B_h, atm_B_w, atm_C_h, n_rows),
+                strides=(atm_C_h*s*st_h, Y_used*s*st_w, st_c, d*st_h, d*st_w, s*st_h, s*st_w),
+                writeable=False)
+
+    # B: gather of the used output channels => [z_itr, kz, ky, kx, ofmap_z]
+    z_idx = X_used*np.arange(z_id_itr_max)[:,None] + np.arange(n_cols)[None,:]
+    B_view = np.moveaxis(tensor_B[z_idx], 1, -1)
+
+    # Only iterations [iter_start, iter_stop) are mapped (bounded memory mode)
+    N_iter = z_id_itr_max*y_id_itr_max*x_id_itr_max
+    if iter_stop is None:
+        iter_stop = N_iter
+
+    N_inputs_per_it = N_inputs//N_iter
+    N_inputs_chunk = (iter_stop-iter_start)*N_inputs_per_it
+
+    A_Mat = np.zeros((N_inputs_chunk, size_Y), dtype=dtype)
+    B_Mat = np.zeros((N_inputs_chunk, size_X), dtype=dtype)
+
+    # Whole layer: scatter into the MVM matrices (one copy, broadcasting over the missing loop indices)
+    if (iter_start == 0) and (iter_stop == N_iter):
+        A_Mat_view = np.reshape(A_Mat, (z_id_itr_max, y_id_itr_max, x_id_itr_max, atm_B_c, atm_B_h, atm_B_w, atm_C_h, size_Y))
+        B_Mat_view = np.reshape(B_Mat, (z_id_itr_max, y_id_itr_max, x_id_itr_max, atm_B_c, atm_B_h, atm_B_w, atm_C_h, size_X))
+
+        A_Mat_view[..., :n_rows] = A_view[None]
+        B_Mat_view[..., :n_cols] = B_view[:, None, None, :, :, :, None, :]
+
+    # Range of iterations: gather the loop indices of each iteration
     else:
-        C_Mat_mvm = custom_matmul(A_Mat_mvm, B_Mat_mvm, preloads=preloads_mvm, exact=False, MANT_bits=SA_Param_dict['MANT_bits'], N_bits=SA_Param_dict['ACT_IA_W'], mul_type=SA_Param_dict['mul_type'], M=SA_Param_dict['M'], add_type=SA_Param_dict['add_type'], A=SA_Param_dict['A'], rounding=SA_Param_dict['rounding'])
-    
-    # Reshape results properly
-    tensor_C_mvm = np.zeros(tensor_C.shape)
-    
-    for z in range(C_c):
-        for y in range(C_h):
-            for x in range(C_w):
-                
-                z_mvm_idx = int(z%X_used)
-                x_mvm_idx = int(x%Y_used)
-                
-                vector_idx = int((z//X_used)*y_id_itr_max*x_id_itr_max + y*x_id_itr_max + x//Y_used)
-    
-                tensor_C_mvm[z,y,x] = C_Mat_mvm[vector_idx , x_mvm_idx, z_mvm_idx]
-        
-    # Check MVM results only if exact computation
-    if not SA_Param_dict['approx_comp']:
-        
-        # Typically there is some +-0.1 error due to Pytorch numerical precision!
-        err = np.abs(tensor_C - tensor_C_mvm)
-        
-        l2_norm_scaled = np.linalg.norm(tensor_C_mvm.flatten())/np.size(tensor_C_mvm.flatten())
-        
-        # print(tensor_A)
-        # print(tensor_C[:4, :4, :4])
-        # print("------------------")
-        # print(tensor_C_mvm[:4, :4, :4])
-        # print(l2_norm_scaled/1000)
-        # print(np.max(err))
-        #print(tensor_A)
-        #print(tensor_B)
-        #print(A_Mat_mvm)
-        #print(B_Mat_mvm)
-        
-        tol = max(1.2, l2_norm_scaled/100)
-        
-        if np.any(err>=(tol)):
-            print("Pytorch results:")
-            print(tensor_C[:4, :4, :4])
-            print("------------------")
-            print("MVM results:")
-            print(tensor_C_mvm[:4, :4, :4])
-            print("------------------")
-            print("L2 Norm scaled:")
-            print(l2_norm_scaled/100)
-            print("Max error:")
-            print(np.max(err))
-        
-        assert np.all(err<(tol)), "Result check did not match numerically! tol={}; max err={}".format(tol, np.max(err))
+        it_idx = np.arange(iter_start, iter_stop)
+        z_it = it_idx//(y_id_itr_max*x_id_itr_max)
+        y_it = (it_idx//x_id_itr_max)%y_id_itr_max
+        x_it = it_idx%x_id_itr_max
+
+        A_Mat_view = np.reshape(A_Mat, (-1, atm_B_c, atm_B_h, atm_B_w, atm_C_h, size_Y))
+        B_Mat_view = np.reshape(B_Mat, (-1, atm_B_c, atm_B_h, atm_B_w, atm_C_h, size_X))
+
+        A_Mat_view[..., :n_rows] = A_view[y_it, x_it]
+        B_Mat_view[..., :n_cols] = B_view[z_it][:, :, :, :, None, :]
+
+    # Underutilization flags are the same for every input vector
+    X_underuse = np.full((N_inputs_chunk), (ucoef_C_c<1) and (size_X>X_used), dtype=bool)
+    Y_underuse = np.full((N_inputs_chunk), (ucoef_C_w<1) and (size_Y>Y_used), dtype=bool)
+
+    return A_Mat, B_Mat, X_underuse, Y_underuse
+
+# --------------------------------------------
+# Output tensor <-> MVM result layout
+# --------------------------------------------
+
+# Vector index of output element [z,y,x] is (z//X_used)*C_h*n_iter_x + y*n_iter_x + x//Y_used,
+# and its position in the vector is [x%Y_used, z%X_used]. Both directions are a single
+# reshape/transpose over a tensor padded to a whole number of iterations. A range of
+# iterations [iter_start, iter_stop) (bounded memory mode) is a gather of its elements.
+
+# Output elements [z, y, x] of the iterations [iter_start, iter_stop), and whether they
+# are inside the tensor. Shapes [N, 1, X_used], [N, 1, 1] and [N, Y_used, 1]
+def get_mvm_tensor_indices(SA_Param_dict, iter_start, iter_stop):
+
+    C_w = SA_Param_dict['C_w']
+    C_h = SA_Param_dict['C_h']
+    C_c = SA_Param_dict['C_c']
+    X_used = SA_Param_dict['X_used']
+    Y_used = SA_Param_dict['Y_used']
+
+    n_iter_x = int(np.ceil(C_w/Y_used))
+
+    it_idx = np.arange(iter_start, iter_stop)[:,None,None]
+    z_idx = (it_idx//(C_h*n_iter_x))*X_used + np.arange(X_used)[None,None,:]
+    y_idx = (it_idx//n_iter_x)%C_h
+    x_idx = (it_idx%n_iter_x)*Y_used + np.arange(Y_used)[None,:,None]
+
+    valid = (z_idx < C_c) & (x_idx < C_w)
+
+    return np.minimum(z_idx, C_c-1), y_idx, np.minimum(x_idx, C_w-1), valid
+
+def tensor_to_mvm(tensor, SA_Param_dict, iter_start=0, iter_stop=None, dtype=np.float64):
+
+    C_w = SA_Param_dict['C_w']
+    C_h = SA_Param_dict['C_h']
+    C_c = SA_Param_dict['C_c']
+    size_Y = SA_Param_dict['size_Y']
+    size_X = SA_Param_dict['size_X']
+    X_used = SA_Param_dict['X_used']
+    Y_used = SA_Param_dict['Y_used']
+
+    n_iter_z = int(np.ceil(C_c/X_used))
+    n_iter_x = int(np.ceil(C_w/Y_used))
+
+    N_iter = n_iter_z*C_h*n_iter_x
+    if iter_stop is None:
+        iter_stop = N_iter
+
+    Mat_mvm = np.zeros((iter_stop-iter_start, size_Y, size_X), dtype=dtype)
+
+    # Whole tensor: [z_itr, z_mvm, y, x_itr, x_mvm] -> [z_itr, y, x_itr, x_mvm, z_mvm]
+    if (iter_start == 0) and (iter_stop == N_iter):
+        tensor_pad = np.zeros((n_iter_z*X_used, C_h, n_iter_x*Y_used), dtype=dtype)
+        tensor_pad[:C_c, :, :C_w] = tensor
+
+        tensor_mvm = np.reshape(tensor_pad, (n_iter_z, X_used, C_h, n_iter_x, Y_used)).transpose(0,2,3,4,1)
+        Mat_mvm[:, :Y_used, :X_used] = np.reshape(tensor_mvm, (-1, Y_used, X_used))
+
+    # Range of iterations: gather
+    else:
+        z_idx, y_idx, x_idx, valid = get_mvm_tensor_indices(SA_Param_dict, iter_start, iter_stop)
+        Mat_mvm[:, :Y_used, :X_used] = np.where(valid, np.asarray(tensor)[z_idx, y_idx, x_idx], 0)
+
+    return Mat_mvm
+
+# Writes the MVM results of iterations [iter_start, iter_start + len(Mat_mvm)) into tensor
+def mvm_to_tensor(Mat_mvm, SA_Param_dict, iter_start=0, tensor=None, dtype=np.float64):
+
+    C_w = SA_Param_dict['C_w']
+    C_h = SA_Param_dict['C_h']
+    C_c = SA_Param_dict['C_c']
+    X_used = SA_Param_dict['X_used']
+    Y_used = SA_Param_dict['Y_used']
+
+    n_iter_z = int(np.ceil(C_c/X_used))
+    n_iter_x = int(np.ceil(C_w/Y_used))
+
+    N_iter = n_iter_z*C_h*n_iter_x
+    iter_stop = iter_start + len(Mat_mvm)
+
+    if tensor is None:
+        tensor = np.zeros((C_c, C_h, C_w), dtype=dtype)
+
+    # Whole tensor: [z_itr, y, x_itr, x_mvm, z_mvm] -> [z_itr, z_mvm, y, x_itr, x_mvm]
+    if (iter_start == 0) and (iter_stop == N_iter):
+        tensor_mvm = np.reshape(Mat_mvm[:, :Y_used, :X_used], (n_iter_z, C_h, n_iter_x, Y_used, X_used)).transpose(0,4,1,2,3)
+        tensor[:] = np.reshape(tensor_mvm, (n_iter_z*X_used, C_h, n_iter_x*Y_used))[:C_c, :, :C_w]
+
+    # Range of iterations: scatter
+    else:
+        z_idx, y_idx, x_idx, valid = get_mvm_tensor_indices(SA_Param_dict, iter_start, iter_stop)
+        z_idx, y_idx, x_idx = np.broadcast_arrays(z_idx, y_idx, x_idx)
+        tensor[z_idx[valid], y_idx[valid], x_idx[valid]] = Mat_mvm[:, :Y_used, :X_used][valid]
+
+    return tensor
+
+# --------------------------------------------
+# Golden convolution backends
+# --------------------------------------------
+
+def conv2d_numpy(tensor_A, tensor_B, s=1, d=1, bias=None):
+
+    # Integer tensors are computed in FP64 (exact while partial sums stay below 2**53)
+    if np.issubdtype(tensor_A.dtype, np.integer):
+        tensor_A = tensor_A.astype(np.float64)
+        tensor_B = tensor_B.astype(np.float64)
+
+    # Tensor shapes: A is [C_in, A_h, A_w], B is [C_out, C_in, B_h, B_w]
+    AB_c, A_h, A_w = tensor_A.shape
+    B_h = tensor_B.shape[2]
+    B_w = tensor_B.shape[3]
+
+    C_h = (A_h - (1 + (B_h - 1)*d))//s + 1
+    C_w = (A_w - (1 + (B_w - 1)*d))//s + 1
+
+    # Strided windows view => [C_in, B_h, B_w, C_h, C_w] (no copy)
+    st_c, st_h, st_w = tensor_A.strides
+    windows = np.lib.stride_tricks.as_strided(tensor_A,
+                shape=(AB_c, B_h, B_w, C_h, C_w),
+                strides=(st_c, d*st_h, d*st_w, s*st_h, s*st_w),
+                writeable=False)
+
+    # Reduction over [C_in, B_h, B_w]
+    tensor_C = np.tensordot(tensor_B, windows, axes=([1,2,3],[0,1,2]))
+
+    if bias is not None:
+        tensor_C = tensor_C + np.reshape(bias, (-1,1,1))
+
+    return tensor_C
+
+def conv2d_torch(tensor_A, tensor_B, s=1, d=1, bias=None):
+
+    # Imported here so that torch is only needed when this backend is selected
+    import torch
+
+    # Integer tensors are computed in FP64 (exact while partial sums stay below 2**53)
+    if np.issubdtype(tensor_A.dtype, np.integer):
+        tensor_A = tensor_A.astype(np.float64)
+        tensor_B = tensor_B.astype(np.float64)
+
+    torch_A = torch.from_numpy(np.ascontiguousarray(tensor_A)).unsqueeze(0)
+    torch_B = torch.from_numpy(np.ascontiguousarray(tensor_B))
+    torch_bias = None if (bias is None) else torch.from_numpy(np.ascontiguousarray(bias))
+
+    tensor_C = torch.nn.functional.conv2d(torch_A, torch_B, bias=torch_bias, stride=s, dilation=d)
+
+    return np.array(tensor_C[0])
+
+def conv2d_sampled(tensor_A, tensor_B, k_idx, y_idx, x_idx, s=1, d=1, bias=None):
+
+    # Convolution computed only at output positions [k_idx, y_idx, x_idx]
+    B_h = tensor_B.shape[2]
+    B_w = tensor_B.shape[3]
+
+    rows = s*y_idx[:,None] + d*np.arange(B_h)[None,:]
+    cols = s*x_idx[:,None] + d*np.arange(B_w)[None,:]
+
+    # Receptive fields => [points, C_in, B_h, B_w]
+    windows = tensor_A[:, rows[:,:,None], cols[:,None,:]].transpose(1,0,2,3)
+
+    values = np.einsum('ncij,ncij->n', tensor_B[k_idx].astype(np.float64), windows.astype(np.float64))
+
+    if bias is not None:
+        values = values + bias[k_idx]
+
+    return values
+
+# --------------------------------------------
+# Hardware-faithful FP golden (FMA sequence of the PEs)
+# --------------------------------------------
+
+# FP operands as seen by the PE FMA: the subnormal exponent correction of the
+# multiplicands is removed in the RTL, so subnormal A/B values count half
+def fp_hw_operand(x, dtype=np.float16):
+    x = x.astype(np.float64)
+    return np.where(np.abs(x) < np.finfo(dtype).tiny, x/2, x)
+
+# Vectorized FMA with a single rounding (RNE) to dtype, as in the PE FMA.
+# The product of two FP16 values is exact in FP64; the FP64 sum is rounded to odd
+# (its exact error comes from TwoSum), so the final rounding to dtype is exact.
+# Zero-gated steps (a==0 or b==0, or negligence) leave the accumulator untouched.
+def fp_fma_hw(a, b, c, dtype=np.float16, thres=0):
+
+    prod = fp_hw_operand(a, dtype) * fp_hw_operand(b, dtype)
+    c64 = c.astype(np.float64)
+
+    # TwoSum => total + err is the exact result
+    total = prod + c64
+    b_virt = total - c64
+    err = (prod - b_virt) + (c64 - (total - b_virt))
+
+    # Round to odd: inexact sums with an even mantissa go to the odd neighbour towards the exact value
+    even = (total.view(np.int64) & 1) == 0
+    total = np.where((err != 0) & even, np.nextafter(total, total + err), total)
+
+    with np.errstate(over='ignore'):
+        result = total.astype(dtype)
+
+    return np.where(get_mac_gate(a, b, thres, FP=True), result, c.astype(dtype))
+
+def conv2d_fp_hw(tensor_A, tensor_B, preloads=None, s=1, d=1, dtype=np.float16, thres=0):
+
+    # Tensor shapes: A is [C_in, A_h, A_w], B is [C_out, C_in, B_h, B_w]
+    tensor_A = np.ascontiguousarray(tensor_A, dtype=dtype)
+    tensor_B = np.ascontiguousarray(tensor_B, dtype=dtype)
+
+    AB_c, A_h, A_w = tensor_A.shape
+    C_c, _, B_h, B_w = tensor_B.shape
+
+    C_h = (A_h - (1 + (B_h - 1)*d))//s + 1
+    C_w = (A_w - (1 + (B_w - 1)*d))//s + 1
+
+    # Strided windows view => [C_in, B_h, B_w, C_h, C_w] (no copy)
+    st_c, st_h, st_w = tensor_A.strides
+    windows = np.lib.stride_tricks.as_strided(tensor_A,
+                shape=(AB_c, B_h, B_w, C_h, C_w),
+                strides=(st_c, d*st_h, d*st_w, s*st_h, s*st_w),
+                writeable=False)
+
+    # Accumulators start from the preloads
+    if (preloads is None) or (len(preloads) == 0):
+        tensor_C = np.zeros((C_c, C_h, C_w), dtype=dtype)
+    else:
+        tensor_C = np.array(preloads, dtype=dtype).reshape((C_c, C_h, C_w))
+
+    # Every PE accumulates in the same order: c tiles are consecutive, and each context
+    # reduces over [kz, ky, kx] => global [C_in, B_h, B_w] order, vectorized over all outputs
+    for c in range(AB_c):
+        for ky in range(B_h):
+            for kx in range(B_w):
+                tensor_C = fp_fma_hw(windows[c, ky, kx][None], tensor_B[:, c, ky, kx][:, None, None], tensor_C, dtype, thres)
+
+    return tensor_C
+
+# Error bound of the sequential FMA accumulation w.r.t. the exact result (with the
+# operands seen by the FMA): n roundings of at most u relative, plus subnormal underflows
+def fp_hw_error_bound(abs_values, N_reduce, dtype=np.float16):
+    u = np.finfo(dtype).eps/2
+    return N_reduce*u*abs_values*1.01 + N_reduce*np.finfo(dtype).smallest_subnormal
+
+def get_fp_hw_golden(A_tensor, B_tensor, C_tensor, CONV, HYPER, SA_dict, golden_backend='numpy', check_level='full', check_samples=1024):
+
+    assert not HYPER['approx_comp'], "The hardware-faithful FP golden only models exact FP arithmetic"
+    assert HYPER['rounding'] == 'RNE', "The hardware-faithful FP golden only supports RNE rounding"
+    assert check_level in ['full', 'sampled', 'none'], "Unrecognized check_level = '{}'".format(check_level)
+
+    dtype = HYPER['intyp']
+    s = CONV['s']
+    d = CONV['d']
+    thres = CONV.get('thres', 0)
+
+    C_output = conv2d_fp_hw(A_tensor, B_tensor, C_tensor, s, d, dtype, thres)
+
+    # Check against the exact convolution (of the operands seen by the FMA) within the accumulation error bound
+    A_op = fp_hw_operand(np.asarray(A_tensor, dtype=dtype), dtype)
+    B_op = fp_hw_operand(np.asarray(B_tensor, dtype=dtype), dtype)
+
+    # Products of two negligible operands are not part of the reference either
+    A_small = np.where(get_negligible_mask(A_tensor, thres, FP=True), A_op, 0)
+    B_small = np.where(get_negligible_mask(B_tensor, thres, FP=True), B_op, 0)
+    if (C_tensor is None) or (len(C_tensor) == 0):
+        pre = np.zeros(C_output.shape)
+    else:
+        pre = np.asarray(C_tensor, dtype=dtype).astype(np.float64).reshape(C_output.shape)
+
+    N_reduce = B_op.shape[1]*B_op.shape[2]*B_op.shape[3]
+
+    if check_level == 'full':
+        conv2d_ref = conv2d_torch if (golden_backend == 'torch') else conv2d_numpy
+        ref_values = conv2d_ref(A_op, B_op, s, d).reshape(C_output.shape) + pre
+        if thres > 0: ref_values -= conv2d_ref(A_small, B_small, s, d).reshape(C_output.shape)
+        abs_values = conv2d_ref(np.abs(A_op), np.abs(B_op), s, d).reshape(C_output.shape) + np.abs(pre)
+        hw_values = C_output
+
+    elif check_level == 'sampled':
+        rng = np.random.default_rng()
+        n_points = min(check_samples, C_output.size)
+        points = rng.choice(C_output.size, size=n_points, replace=False)
+        k_idx, y_idx, x_idx = np.unravel_index(points, C_output.shape)
+
+        ref_values = conv2d_sampled(A_op, B_op, k_idx, y_idx, x_idx, s, d) + pre[k_idx, y_idx, x_idx]
+        if thres > 0: ref_values -= conv2d_sampled(A_small, B_small, k_idx, y_idx, x_idx, s, d)
+        abs_values = conv2d_sampled(np.abs(A_op), np.abs(B_op), k_idx, y_idx, x_idx, s, d) + np.abs(pre[k_idx, y_idx, x_idx])
+        hw_values = C_output[k_idx, y_idx, x_idx]
+
+    SA_dict['check_level'] = check_level
+    SA_dict['check_points'] = 0 if (check_level == 'none') else hw_values.size
+
+    if check_level != 'none':
+        err = np.abs(hw_values.astype(np.float64) - ref_values)
+        tol = fp_hw_error_bound(abs_values, N_reduce, dtype)
+        assert np.all(err <= tol), "Hardware-faithful FP golden is out of the accumulation error bound (FP16 overflow?) ! max err={}".format(np.max(err))
+
+    return C_output
+
+# --------------------------------------------
+# Negligence threshold (zero detection with bit negligence)
+# --------------------------------------------
+
+# The zero detector of each PE gates a MAC (the accumulator keeps its value) when one operand
+# is zero, or when both operands are negligible for the threshold t (o_thres, 0 = off):
+#   - int: all bits from bit t up are copies of the sign => -2^t <= x < 2^t
+#   - FP: the exponent field is below 2^t
+def get_negligible_mask(tensor, thres, FP=False):
+
+    if thres == 0:
+        return np.zeros(np.shape(tensor), dtype=bool)
+
+    if FP:
+        exp_field = (np.asarray(tensor, dtype=np.float16).view(np.uint16) >> 10) & 0x1F
+        return exp_field < (1 << thres)
+
+    tensor = np.asarray(tensor)
+    return (tensor >= -(1 << thres)) & (tensor < (1 << thres))
+
+# MACs actually computed by the PEs
+def get_mac_gate(a, b, thres=0, FP=False):
+    return (a != 0) & (b != 0) & ~(get_negligible_mask(a, thres, FP) & get_negligible_mask(b, thres, FP))
+
+# Contribution of the neglected MACs to every output (exact result - result with negligence).
+# Only products of two negligible operands are neglected, so it is the convolution of the
+# negligible parts of A and B
+def get_neglected_products(A_tensor, B_tensor, thres, s=1, d=1, FP=False):
+
+    A_small = np.where(get_negligible_mask(A_tensor, thres, FP), A_tensor, 0).astype(np.float64)
+    B_small = np.where(get_negligible_mask(B_tensor, thres, FP), B_tensor, 0).astype(np.float64)
+
+    return conv2d_numpy(A_small, B_small, s, d)
+
+# Goldens that compute every MAC (MVM, surrogate): remove the neglected products
+def remove_neglected_products(C_output, A_tensor, B_tensor, CONV, HYPER):
+
+    thres = CONV.get('thres', 0)
+    if thres == 0:
+        return C_output
+
+    FP = (HYPER['OP_TYPE']==1)
+    neglected = get_neglected_products(A_tensor, B_tensor, thres, CONV['s'], CONV['d'], FP).reshape(C_output.shape)
+
+    if FP:
+        return (C_output.astype(np.float64) - neglected).astype(HYPER['intyp'])
+
+    return C_output - np.rint(neglected).astype(C_output.dtype)
+
+# MACs skipped by the zero detectors (exact zeros and negligence) and output error of the
+# negligence w.r.t. the exact convolution. C_output is the result with negligence. Without
+# a threshold, nothing is neglected and no convolution is needed. The MACs skipped on exact
+# zeros (one more convolution) are only counted with zero_stats
+def get_negligence_stats(A_tensor, B_tensor, C_output, CONV, HYPER, zero_stats=False):
+
+    thres = CONV.get('thres', 0)
+    FP = (HYPER['OP_TYPE']==1)
+    s = CONV['s']
+    d = CONV['d']
+
+    macs_total = int(np.prod(np.shape(C_output)))*int(np.prod(np.shape(B_tensor)[1:]))
+
+    STATS = {
+        'thres' :               thres,
+        'macs_total' :          macs_total,
+        'macs_neglected' :      0,
+        'neglect_max_error' :   0.0,
+        'neglect_mean_error' :  0.0,
+        'neglect_NMED' :        0.0,
+        'neglect_errors' :      0,
+    }
+
+    A_nz = (np.asarray(A_tensor) != 0).astype(np.float64)
+    B_nz = (np.asarray(B_tensor) != 0).astype(np.float64)
+
+    if thres > 0:
+        A_neg = get_negligible_mask(A_tensor, thres, FP) & (A_nz > 0)
+        B_neg = get_negligible_mask(B_tensor, thres, FP) & (B_nz > 0)
+
+        neglected = get_neglected_products(A_tensor, B_tensor, thres, s, d, FP).reshape(np.shape(C_output))
+        C_exact = np.asarray(C_output, dtype=np.float64) + neglected
+        abs_error = np.abs(neglected)
+
+        STATS['macs_neglected'] = int(np.sum(conv2d_numpy(A_neg.astype(np.float64), B_neg.astype(np.float64), s, d)))
+        STATS['neglect_max_error'] = float(np.max(abs_error))
+        STATS['neglect_mean_error'] = float(np.mean(abs_error))
+        STATS['neglect_NMED'] = float(np.mean(abs_error)/max(np.max(np.abs(C_exact)), 1e-30))
+        STATS['neglect_errors'] = int(np.count_nonzero(abs_error))
+
+    if zero_stats:
+        macs_nonzero = int(np.sum(conv2d_numpy(A_nz, B_nz, s, d)))
+        STATS['macs_zero_skipped'] = macs_total - macs_nonzero
+        STATS['macs_skip_ratio'] = (macs_total - macs_nonzero + STATS['macs_neglected'])/macs_total
+
+    return STATS
+
+# --------------------------------------------
+# Sampled Monte Carlo evaluation of approximate arithmetic
+# --------------------------------------------
+
+# Bit-accurate approximate results (FP_Madd chain, as in custom_matmul) only at output
+# positions [k_idx, y_idx, x_idx]. Each output starts from its preload and reduces
+# over the global [C_in, B_h, B_w] order with the gating of the zero detectors (exact
+# zeros and negligence threshold thres). The cost is n_samples*C_in*B_h*B_w calls to
+# FP_Madd, independent of the layer size.
+def approx_conv_sampled(tensor_A, tensor_B, preloads, k_idx, y_idx, x_idx, HYPER, s=1, d=1, thres=0):
+
+    B_h = tensor_B.shape[2]
+    B_w = tensor_B.shape[3]
+
+    rows = s*y_idx[:,None] + d*np.arange(B_h)[None,:]
+    cols = s*x_idx[:,None] + d*np.arange(B_w)[None,:]
+
+    # Operands as in the MVM matrices => [points, C_in*B_h*B_w]
+    windows = tensor_A[:, rows[:,:,None], cols[:,None,:]].transpose(1,0,2,3).astype(np.float32).reshape(len(k_idx), -1)
+    weights = tensor_B[k_idx].astype(np.float32).reshape(len(k_idx), -1)
+    gates = get_mac_gate(windows, weights, thres, FP=True)
+
+    values = np.zeros(len(k_idx))
+    if len(preloads) > 0:
+        values = preloads[k_idx, y_idx, x_idx].astype(np.float64)
+
+    for n in range(len(k_idx)):
+        acc = values[n]
+        for a, b, gate in zip(windows[n], weights[n], gates[n]):
+            # Zero detectors, as in the PEs
+            if gate:
+                _, _, acc = FP_Madd(a, b, acc, MANT_bits=HYPER['IA_MANT'], N_bits=HYPER['IA_W'], MulType=HYPER['mul_type'], m=HYPER['M'], AdderType=HYPER['add_type'], A=HYPER['A'], rounding=HYPER['rounding'])
+        values[n] = acc
+
+    return values
+
+# Mean of a sample with its confidence interval (Student t). Samples drawn without
+# replacement from N_pop values get the finite population correction.
+def mean_confidence_interval(values, confidence=0.95, N_pop=None):
+
+    n = len(values)
+    mean = float(np.mean(values)) if (n > 0) else np.nan
+
+    if n < 2:
+        return mean, (mean, mean)
+
+    fpc = 1.0 if (N_pop is None) else np.sqrt(max(N_pop - n, 0)/(N_pop - 1))
+    half = stats.t.ppf(0.5 + confidence/2, n-1)*np.std(values, ddof=1)/np.sqrt(n)*fpc
+
+    return mean, (mean - half, mean + half)
+
+# Error statistics of an approximate-arithmetic convolution from a random sample of
+# output positions, versus the exact result (FP64):
+#   MRED: mean |approx - exact|/|exact| (outputs with exact == 0 are excluded)
+#   NMED: mean |approx - exact| / max |exact| (max over the whole layer)
+# with confidence intervals, and the max error of the sample. With confidence
+# 'confidence', less than a fraction 'max_error_exceed' of all outputs have a larger error.
+def evaluate_approx_sampled(A_tensor, B_tensor, C_tensor, CONV, HYPER, n_samples=1024, confidence=0.95, seed=None):
+
+    assert HYPER['OP_TYPE']==1, "Approximate arithmetic is only modelled for FP"
+
+    s = CONV['s']
+    d = CONV['d']
+    C_c, C_h, C_w = CONV['C_c'], CONV['C_h'], CONV['C_w']
+    N_outputs = C_c*C_h*C_w
+
+    tensor_A = np.asarray(A_tensor)
+    tensor_B = np.asarray(B_tensor)
+    preloads = np.asarray(C_tensor) if (len(C_tensor)>0) else []
+
+    # Exact result of the whole layer (cheap), needed for the NMED normalization
+    exact = conv2d_numpy(tensor_A.astype(np.float64), tensor_B.astype(np.float64), s, d).reshape((C_c, C_h, C_w))
+    if len(preloads) > 0:
+        exact = exact + preloads.astype(np.float64)
+
+    # Random output positions (all of them if the sample is larger than the layer)
+    rng = np.random.default_rng(seed)
+    n_samples = min(n_samples, N_outputs)
+    flat_idx = rng.choice(N_outputs, size=n_samples, replace=False)
+    k_idx, y_idx, x_idx = np.unravel_index(flat_idx, (C_c, C_h, C_w))
+
+    approx = approx_conv_sampled(tensor_A, tensor_B, preloads, k_idx, y_idx, x_idx, HYPER, s=s, d=d, thres=CONV.get('thres', 0))
+    approx = approx.astype(HYPER['intyp']).astype(np.float64)
+
+    exact_sampled = exact[k_idx, y_idx, x_idx]
+    abs_error = np.abs(approx - exact_sampled)
+    nonzero = exact_sampled != 0
+    N_nonzero = int(np.count_nonzero(exact != 0))
+
+    max_exact = np.max(np.abs(exact))
+    mred, mred_ci = mean_confidence_interval(abs_error[nonzero]/np.abs(exact_sampled[nonzero]), confidence, N_pop=N_nonzero)
+    med, med_ci = mean_confidence_interval(abs_error, confidence, N_pop=N_outputs)
+    nmed, nmed_ci = (med/max_exact, (med_ci[0]/max_exact, med_ci[1]/max_exact)) if (max_exact > 0) else (0.0, (0.0, 0.0))
+
+    ERROR = {
+        'N_samples' :           n_samples,
+        'N_outputs' :           N_outputs,
+        'confidence' :          confidence,
+        'MRED' :                mred,
+        'MRED_CI' :             mred_ci,
+        'NMED' :                nmed,
+        'NMED_CI' :             nmed_ci,
+        'max_error' :           float(np.max(abs_error)),
+        'max_exact' :           float(max_exact),
+        'max_error_exceed' :    0.0 if (n_samples == N_outputs) else float(1 - (1 - confidence)**(1/n_samples)),
+        'positions' :           [k_idx, y_idx, x_idx],
+        'approx' :              approx,
+        'exact' :               exact_sampled,
+    }
+
+    return ERROR
+
+# --------------------------------------------
+# Statistical surrogate of approximate arithmetic (error injection)
+# --------------------------------------------
+
+# Each (mul_type, M, add_type, A) configuration is characterized once with FP_Madd as an
+# empirical distribution of the MAC error, normalized by the larger operand of the sum
+# (max(|a*b|, |c|)) with the sign of the exact result (errors that shrink or grow the
+# magnitude of the result accumulate coherently) and conditioned on the exponent difference of the product and the
+# accumulator (the alignment of the adder). Products are aligned away beyond the
+# prod-/addend-anchored limits of FP_Madd, which bound the bins; c == 0 has its own bin.
+# Tables keep APPROX_TABLE_QUANTILES quantiles per bin, in memory and (optionally) on disk.
+APPROX_TABLE_QUANTILES = 129
+APPROX_TABLES = {}
+
+def get_approx_table_name(HYPER, n_per_bin):
+
+    # Parameters can be tuples (e.g. GeAr adders) => only alphanumeric characters in the name
+    params = [HYPER['mul_type'], HYPER['M'], HYPER['add_type'], HYPER['A'], HYPER['IA_MANT'], HYPER['IA_W'], HYPER['rounding'], n_per_bin]
+    params = ['-'.join(''.join(ch if ch.isalnum() else ' ' for ch in str(p)).split()) for p in params]
+
+    return "approx_mul{}_M{}_add{}_A{}_mant{}_n{}_{}_{}.npz".format(*params)
+
+def characterize_approx_arith(HYPER, n_per_bin=512, seed=0):
+
+    MANT_bits = HYPER['IA_MANT']
+    P = MANT_bits + 1
+    ediff_min = -(P + 3)
+    ediff_max = 2*P + 2
+    N_bins = ediff_max - ediff_min + 2      # Last bin: c == 0
+
+    rng = np.random.default_rng(seed)
+
+    # FP16 operands with random signs, log-uniform mantissas (as most real data) and the given exponents
+    def random_fp(exponents):
+        values = rng.choice([-1,1], len(exponents))*2.0**(rng.uniform(0, 1, len(exponents)) + exponents)
+        return values.astype(np.float16).astype(np.float32)
+
+    errors = [[] for _ in range(N_bins)]
+
+    # Target exponent differences (and c == 0), centered so that a, b and c stay normal
+    for target in list(range(ediff_min, ediff_max+1)) + [None]:
+        t = 0 if (target is None) else target
+        e_a = rng.integers(-2, 3, n_per_bin) + t//4
+        e_b = rng.integers(-2, 3, n_per_bin) + t//2 - t//4
+        e_c = rng.integers(-2, 3, n_per_bin) + t//2 - t
+
+        a = random_fp(e_a)
+        b = random_fp(e_b)
+        c = np.zeros(n_per_bin) if (target is None) else random_fp(e_c).astype(np.float64)
+        prod = a.astype(np.float64)*b.astype(np.float64)
+
+        for n in range(n_per_bin):
+            _, _, res = FP_Madd(a[n], b[n], c[n], MANT_bits=MANT_bits, N_bits=HYPER['IA_W'], MulType=HYPER['mul_type'], m=HYPER['M'], AdderType=HYPER['add_type'], A=HYPER['A'], rounding=HYPER['rounding'])
+            exact = prod[n] + c[n]
+            scale = max(abs(prod[n]), abs(c[n]))*(-1 if (exact < 0) else 1)
+            errors[approx_bin(prod[n], c[n], ediff_min, ediff_max)].append((float(res) - exact)/scale)
+
+    # Empirical distribution of each bin (bins without samples borrow the closest one)
+    quantiles = np.zeros((N_bins, APPROX_TABLE_QUANTILES))
+    counts = np.array([len(e) for e in errors])
+    filled = np.flatnonzero(counts > 0)
+    for i in range(N_bins):
+        source = i if (counts[i] > 0) else filled[np.argmin(np.abs(filled - i))]
+        quantiles[i] = np.quantile(errors[source], np.linspace(0, 1, APPROX_TABLE_QUANTILES))
+
+    TABLE = {
+        'quantiles' :   quantiles,
+        'mean' :        np.array([np.mean(e) if (len(e) > 0) else 0.0 for e in errors]),
+        'std' :         np.array([np.std(e) if (len(e) > 0) else 0.0 for e in errors]),
+        'counts' :      counts,
+        'ediff_min' :   ediff_min,
+        'ediff_max' :   ediff_max,
+    }
+
+    return TABLE
+
+# Bin of the exponent difference of the product and the accumulator (vectorized)
+def approx_bin(prod, acc, ediff_min, ediff_max):
+
+    _, e_prod = np.frexp(prod)
+    _, e_acc = np.frexp(acc)
+    ediff = np.clip(e_prod - e_acc, ediff_min, ediff_max) - ediff_min
+
+    return np.where(acc == 0, ediff_max - ediff_min + 1, ediff)
+
+# Characterization table of a configuration: memory, then disk (table_dir), then FP_Madd
+def get_approx_table(HYPER, table_dir=None, n_per_bin=512):
+
+    name = get_approx_table_name(HYPER, n_per_bin)
+
+    if name not in APPROX_TABLES:
+
+        if (table_dir is not None) and os.path.exists(os.path.join(table_dir, name)):
+            with np.load(os.path.join(table_dir, name)) as f:
+                TABLE = {key : f[key] for key in f.files}
+            TABLE['ediff_min'] = int(TABLE['ediff_min'])
+            TABLE['ediff_max'] = int(TABLE['ediff_max'])
+
+        else:
+            TABLE = characterize_approx_arith(HYPER, n_per_bin=n_per_bin)
+
+            if table_dir is not None:
+                os.makedirs(table_dir, exist_ok=True)
+                np.savez(os.path.join(table_dir, name), **TABLE)
+
+        APPROX_TABLES[name] = TABLE
+
+    return APPROX_TABLES[name]
+
+# Exact convolution (numpy or torch) plus the MAC errors drawn from the table. The
+# errors of each reduction step [C_in, B_h, B_w] are drawn for all outputs at once,
+# conditioned on the product and on the exact partial sum. Zero-gated MACs add no error.
+def conv2d_approx_surrogate(tensor_A, tensor_B, preloads, TABLE, s=1, d=1, backend='numpy', seed=None):
+
+    tensor_A = np.asarray(tensor_A).astype(np.float64)
+    tensor_B = np.asarray(tensor_B).astype(np.float64)
+
+    if backend == 'torch':
+        tensor_C = conv2d_torch(tensor_A, tensor_B, s, d)
+    else:
+        tensor_C = conv2d_numpy(tensor_A, tensor_B, s, d)
+
+    acc = np.zeros(tensor_C.shape)
+    if len(preloads) > 0:
+        acc = acc + np.asarray(preloads).astype(np.float64)
+    tensor_C = tensor_C + acc
+
+    C_out, C_h, C_w = tensor_C.shape
+    _, AB_c, B_h, B_w = tensor_B.shape
+
+    rng = np.random.default_rng(seed)
+    quantiles = TABLE['quantiles']
+    N_q = quantiles.shape[1]
+    noise = np.zeros(tensor_C.shape)
+
+    for c in range(AB_c):
+        for ky in range(B_h):
+            for kx in range(B_w):
+                window = tensor_A[c, d*ky : d*ky + s*(C_h-1) + 1 : s, d*kx : d*kx + s*(C_w-1) + 1 : s]
+                prod = tensor_B[:, c, ky, kx][:,None,None]*window[None,:,:]
+
+                # Inverse CDF sampling of the empirical distribution of each bin
+                bins = approx_bin(prod, acc, TABLE['ediff_min'], TABLE['ediff_max'])
+                pos = rng.random(prod.shape)*(N_q - 1)
+                low = pos.astype(np.int64)
+                high = np.minimum(low + 1, N_q - 1)
+                eps = quantiles[bins, low] + (pos - low)*(quantiles[bins, high] - quantiles[bins, low])
+
+                scale = np.maximum(np.abs(prod), np.abs(acc))*np.where(prod + acc < 0, -1, 1)
+                noise += np.where(prod != 0, eps*scale, 0)
+                acc += prod
+
+    return tensor_C + noise
+
+# --------------------------------------------
+# Exact integer MVM data types
+# --------------------------------------------
+
+def get_int_mvm_dtypes(tensor_A, tensor_B, N_reduce):
+
+    min_op = min([int(np.min(tensor)) for tensor in [tensor_A, tensor_B] if tensor.size] + [0])
+    max_op = max([int(np.max(tensor)) for tensor in [tensor_A, tensor_B] if tensor.size] + [0])
+
+    max_A = max(-int(np.min(tensor_A)), int(np.max(tensor_A))) if tensor_A.size else 0
+    max_B = max(-int(np.min(tensor_B)), int(np.max(tensor_B))) if tensor_B.size else 0
+
+    # Operands are stored in the smallest signed integer type that holds their range
+    op_dtype = [dtype for dtype in [np.int8, np.int16, np.int32, np.int64] if (np.iinfo(dtype).min <= min_op) and (max_op <= np.iinfo(dtype).max)][0]
+
+    # Every partial sum is bounded by this value. If it fits in the mantissa of a
+    # floating point type, a BLAS matmul in that type is bit-exact w.r.t. int64
+    acc_bound = N_reduce*max_A*max_B
+
+    if acc_bound < 2**24:
+        mvm_dtype = np.float32
+    elif acc_bound < 2**53:
+        mvm_dtype = np.float64
+    else:
+        mvm_dtype = np.int64
+
+    return op_dtype, mvm_dtype
+
+# --------------------------------------------
+# Sparsity-aware convolution (golden model)
+# --------------------------------------------
+
+# Chooses the tensor computed as a sparse matrix: the sparser of A and B if its
+# measured density is below the threshold ('auto'), always ('sparse') or never ('dense').
+# 'auto' only applies to integer data: FP sums in another order than the dense FP32 MVM
+def choose_sparse_operand(tensor_A, tensor_B, sparse_mode='auto', sparse_threshold=0.2, FP=False):
+
+    assert sparse_mode in ['auto', 'dense', 'sparse'], "Unrecognized sparse_mode = '{}'".format(sparse_mode)
+
+    density_A = np.count_nonzero(tensor_A)/max(tensor_A.size, 1)
+    density_B = np.count_nonzero(tensor_B)/max(tensor_B.size, 1)
+
+    operand = 'A' if (density_A <= density_B) else 'B'
+    density = min(density_A, density_B)
+
+    if (sparse_mode == 'dense') or ((sparse_mode == 'auto') and (FP or (density >= sparse_threshold))):
+        operand = None
+
+    return operand, density_A, density_B
+
+# Convolution as one sparse x dense product per kernel offset [ky, kx]. With a sparse A,
+# the im2col block of each offset is a CSR matrix built from the non-zeros of A (the dense
+# im2col matrices are never built); with a sparse B, the weights of each offset are CSR.
+# Returns the output tensor [C_out, C_h, C_w] and the number of MACs computed
+def conv2d_sparse(tensor_A, tensor_B, s=1, d=1, operand='A'):
+
+    AB_c, A_h, A_w = tensor_A.shape
+    C_c, _, B_h, B_w = tensor_B.shape
+
+    C_h = (A_h - (1 + (B_h - 1)*d))//s + 1
+    C_w = (A_w - (1 + (B_w - 1)*d))//s + 1
+
+    # Results are accumulated transposed => [C_h*C_w, C_out]
+    tensor_C_T = np.zeros((C_h*C_w, C_c), dtype=np.result_type(tensor_A, tensor_B))
+    macs = 0
+
+    if operand == 'A':
+        c_nz, y_nz, x_nz = np.nonzero(tensor_A)
+        values = tensor_A[c_nz, y_nz, x_nz]
+
+        for ky in range(B_h):
+            for kx in range(B_w):
+
+                # Output position reached by each non-zero input through this offset
+                y_out = y_nz - d*ky
+                x_out = x_nz - d*kx
+                valid = (y_out >= 0) & (x_out >= 0) & (y_out%s == 0) & (x_out%s == 0) & (y_out < s*C_h) & (x_out < s*C_w)
+
+                rows = (y_out[valid]//s)*C_w + x_out[valid]//s
+                A_csr = sparse.csr_matrix((values[valid], (rows, c_nz[valid])), shape=(C_h*C_w, AB_c))
+
+                tensor_C_T += A_csr @ tensor_B[:, :, ky, kx].T
+                macs += A_csr.nnz*C_c
+
+    else:
+        for ky in range(B_h):
+            for kx in range(B_w):
+
+                # Input windows of this offset => [C_in, C_h*C_w]
+                A_win = np.reshape(tensor_A[:, d*ky : d*ky + s*(C_h-1) + 1 : s, d*kx : d*kx + s*(C_w-1) + 1 : s], (AB_c, C_h*C_w))
+                B_csr = sparse.csr_matrix(tensor_B[:, :, ky, kx].T)
+
+                tensor_C_T += (B_csr.T @ A_win).T
+                macs += B_csr.nnz*C_h*C_w
+
+    return np.reshape(tensor_C_T.T, (C_c, C_h, C_w)), macs
+
+# --------------------------------------------
+# Atomic tensor primitives of the MVM mapping (written to the param dict, used by im2col)
+# --------------------------------------------
+
+def set_mvm_primitives(SA_Param_dict):
+
+    AB_c = SA_Param_dict['AB_c']
+    B_w = SA_Param_dict['B_w']
+    B_h = SA_Param_dict['B_h']
+    d = SA_Param_dict['d']
+    s = SA_Param_dict['s']
+
+    B_w_eff = 1 + (B_w - 1)*d
+    B_h_eff = 1 + (B_h - 1)*d
+
+    size_Y = SA_Param_dict['size_Y']
+    size_X = SA_Param_dict['size_X']
+    OS_buff_K = SA_Param_dict['OS_buff_K']
+
+    atm_C_c = size_X        # Iterable (Architectural)
+    atm_C_w = size_Y        # Iterable (Architectural)
+    atm_C_h = OS_buff_K     # Iterable
+    
+    atm_A_c = AB_c                                  # Reductible
+    atm_A_w = s*size_Y + B_w_eff - (B_w_eff%2)      # Iterable (Architectural)
+    atm_A_h = OS_buff_K*B_h_eff                     # Iterable
+    
+    atm_B_k = size_X    # Iterable (Architectural)
+    atm_B_c = AB_c      # Reductible
+    atm_B_w = B_w       # Reductible 
+    atm_B_h = B_h       # Reductible
+    
+    # Write tensor primitives to param dict
+    SA_Param_dict['atm_C_c'] = atm_C_c
+    SA_Param_dict['atm_C_w'] = atm_C_w
+    SA_Param_dict['atm_C_h'] = atm_C_h
+    
+    SA_Param_dict['atm_A_c'] = atm_A_c
+    SA_Param_dict['atm_A_w'] = atm_A_w
+    SA_Param_dict['atm_A_h'] = atm_A_h
+    
+    SA_Param_dict['atm_B_k'] = atm_B_k
+    SA_Param_dict['atm_B_c'] = atm_B_c
+    SA_Param_dict['atm_B_w'] = atm_B_w
+    SA_Param_dict['atm_B_h'] = atm_B_h
+
+# --------------------------------------------
+# Accurate im2col performed by SAURIA
+# --------------------------------------------
+
+# Maps the convolution of SA_Param_dict (geometry and mapping constants) to the MVMs of the
+# array and computes them. Operands are random (random_tensors) or A_tensor, B_conv and
+# preloads, with 'FP' or 'int' data_type.
+#   mapping:        'strided' builds A_Mat / B_Mat from strided views, 'reference' with the
+#                   scalar loops (slow, for equivalence checks)
+#   golden_backend: reference convolution of the check, 'numpy' or 'torch' (imported lazily)
+#   check_level:    'full' (whole reference), 'sampled' (check_samples random outputs) or
+#                   'none'. The level and checked points go to SA_Param_dict ('check_level',
+#                   'check_points')
+#   max_mem_MB:     if set, the MVMs run in chunks of iterations within this budget; then
+#                   tensor_C, A_Mat and B_Mat are not returned (None). Ignored with 'reference'
+#   sparse_mode:    'auto' computes from the sparser of A/B as CSR matrices when its density
+#                   is below sparse_threshold (integer data only), 'sparse' always, 'dense'
+#                   never. Backend, densities and MAC reduction go to SA_Param_dict
+#                   ('mvm_backend', 'mvm_density_A', 'mvm_density_B', 'mvm_sparse_gain')
+# Returns the number of MVM input vectors and of iterations, the input vectors of each chunk
+# that underuse the X_used columns / Y_used rows, the MVM output tensor, the reference output
+# tensor and the MVM matrices A_Mat, B_Mat.
+def map_conv_to_MVM(SA_Param_dict, random_tensors=True, A_tensor=[], B_conv=[], preloads=[], data_type='FP', mapping='strided', golden_backend='numpy', check_level='full', check_samples=1024, max_mem_MB=None, sparse_mode='auto', sparse_threshold=0.2, silent=False):
+    
+    # -----------------------------------------------------------------------------
+    # Load constants from dict
+    # ----------------------------------------------------------------------------- 
+    
+    A_w = SA_Param_dict['A_w']
+    A_h = SA_Param_dict['A_h']
+    AB_c = SA_Param_dict['AB_c']
+    
+    B_w = SA_Param_dict['B_w']
+    B_h = SA_Param_dict['B_h']
+    B_k = SA_Param_dict['B_k']
+
+    d = SA_Param_dict['d']
+    s = SA_Param_dict['s']
+
+    B_w_eff = 1 + (B_w - 1)*d
+    B_h_eff = 1 + (B_h - 1)*d
+
+    C_w = SA_Param_dict['C_w']
+    C_h = SA_Param_dict['C_h']
+    C_c = SA_Param_dict['C_c']
+    
+    size_Y = SA_Param_dict['size_Y']
+    size_X = SA_Param_dict['size_X']
+    
+    OS_buff_K = SA_Param_dict['OS_buff_K']
+    
+    # -----------------------------------------------------------------------------
+    # ATOMIC TENSOR PRIMITIVES
+    # ----------------------------------------------------------------------------- 
+
+    set_mvm_primitives(SA_Param_dict)
+
+    atm_C_c = SA_Param_dict['atm_C_c']
+    atm_C_w = SA_Param_dict['atm_C_w']
+    atm_C_h = SA_Param_dict['atm_C_h']
+
+    X_used = SA_Param_dict['X_used']
+    Y_used = SA_Param_dict['Y_used']
+
+    # -----------------------------------------------------------------------------
+    # Number of iterations and number of MVM inputs
+    # ----------------------------------------------------------------------------- 
+
+    # Number of iterations (for Iterable dimensions)
+    n_iter_z = np.ceil(C_c/X_used)
+    n_iter_y = np.ceil(C_h/atm_C_h)
+    n_iter_x = np.ceil(C_w/Y_used)
+    
+    N_iter = n_iter_z*n_iter_y*n_iter_x
+    N_iter = N_iter.astype(int)
+    
+    # Input vectors per iteration (Reductible dimensions)
+    N_inputs_per_it = atm_C_h*B_w*B_h*AB_c
+    
+    # Total input vectors
+    N_inputs = N_inputs_per_it*N_iter
+    N_inputs = N_inputs.astype(int)
+        
+    # Utilization: Architectural Iterable dimensions
+    remaining_C_c = X_used
+    remaining_C_w = Y_used
+    
+    ucoef_C_c = C_c/(n_iter_z*atm_C_c)
+    ucoef_C_w = C_w/(n_iter_x*atm_C_w)
+    
+    # --------------------------------------------------------------------------------
+    # ACTUAL MAPPING + UTILIZATION + CHECK
+    # --------------------------------------------------------------------------------
+
+    # Integer operands keep their exact values, FP operands are computed in FP32
+    in_dtype = np.int64 if (data_type=='int') else np.float32
+
+    # Define input values
+    if random_tensors:
+        tensor_A = (np.random.randn(AB_c, A_h, A_w) * 100).astype(in_dtype)
+        w_bound = 1/np.sqrt(AB_c*B_h*B_w)
+        tensor_B = np.random.uniform(-w_bound, w_bound, (B_k, AB_c, B_h, B_w)).astype(in_dtype)
+        bias = None
+
+    # B_conv can be either a weight array or a torch.nn.Conv2d layer
+    elif hasattr(B_conv, 'weight'):
+        B_conv.weight.requires_grad = False
+        tensor_A = np.array(A_tensor).astype(in_dtype)
+        tensor_B = np.array(B_conv.weight).astype(in_dtype)
+        bias = None if (B_conv.bias is None) else np.array(B_conv.bias.detach()).astype(np.float32)
+
+    else:
+        tensor_A = np.array(A_tensor).astype(in_dtype)
+        tensor_B = np.array(B_conv).astype(in_dtype)
+        bias = None
+    
+    # -----------------------------------------------------------------------------
+    # Check mapping: compare results between MVM and a reference convolution
+    # ----------------------------------------------------------------------------- 
+
+    # Verification depth (approximate results cannot be checked against an exact reference)
+    if SA_Param_dict['approx_comp']:
+        check_level = 'none'
+
+    assert check_level in ['full', 'sampled', 'none'], "Unrecognized check_level = '{}'".format(check_level)
+
+    # Reference convolution results (full check only). With a memory budget, the full
+    # check is done in blocks of output positions after the MVM (see below)
+    bounded = (max_mem_MB is not None) and (mapping != 'reference')
+
+    if (check_level == 'full') and not bounded:
+        if golden_backend == 'torch':
+            tensor_C = conv2d_torch(tensor_A, tensor_B, s, d, bias=bias)
+        else:
+            tensor_C = conv2d_numpy(tensor_A, tensor_B, s, d, bias=bias)
+
+        tensor_C = tensor_C.reshape((C_c, C_h, C_w))
+    
+        # Add Cinit after the convolution
+        if (len(preloads)>0):
+            tensor_C = tensor_C + preloads
+    else:
+        tensor_C = None
+        
+    # Data types of the MVM operands and of the matrix multiplication
+    if (data_type=='int'):
+        op_dtype, mvm_dtype = get_int_mvm_dtypes(tensor_A, tensor_B, N_inputs_per_it)
+        if SA_Param_dict['approx_comp']:
+            mvm_dtype = np.int64
+    else:
+        op_dtype, mvm_dtype = np.float32, np.float32
+
+    SA_Param_dict['mvm_dtype'] = np.dtype(mvm_dtype).name
+
+    # Exact integer results are kept in int64 (a float64 buffer would round the int64 MVM)
+    out_dtype = np.int64 if ((data_type=='int') and not SA_Param_dict['approx_comp']) else np.float64
+
+    # Iterations computed at once: whole layer, or bounded by the memory budget
+    # (A/B matrices + index gather + their copies for the MVM + preloads, C vectors and their indices)
+    if not bounded:
+        N_iter_chunk = N_iter
+    else:
+        bytes_per_iter = N_inputs_per_it*(size_Y+size_X)*(2*np.dtype(op_dtype).itemsize + np.dtype(mvm_dtype).itemsize) + 6*size_Y*size_X*8
+        N_iter_chunk = int(min(N_iter, max(1, (max_mem_MB*1024*1024)//bytes_per_iter)))
+
+    SA_Param_dict['N_iter_chunk'] = N_iter_chunk
+
+    # Sparse golden: convolution from the non-zeros of the sparser tensor, without the dense
+    # im2col matrices (not for approximate arithmetic nor for the reference mapping)
+    sparse_operand, density_A, density_B = choose_sparse_operand(tensor_A, tensor_B, sparse_mode, sparse_threshold, FP=(data_type == 'FP'))
+    if SA_Param_dict['approx_comp'] or (mapping == 'reference'):
+        sparse_operand = None
+
+    SA_Param_dict['mvm_backend'] = 'dense' if (sparse_operand is None) else 'sparse_' + sparse_operand
+    SA_Param_dict['mvm_density_A'] = density_A
+    SA_Param_dict['mvm_density_B'] = density_B
+
+    # Iterations of the dense MVM (none if the golden is sparse)
+    N_iter_dense = N_iter if (sparse_operand is None) else 0
+    N_chunks = int(np.ceil(N_iter_dense/N_iter_chunk))
+
+    # Results are written to the output tensor chunk by chunk (preloads gathered per chunk)
+    tensor_C_mvm = np.zeros((C_c, C_h, C_w), dtype=out_dtype)
+
+    # Underused input vectors, counted per chunk
+    X_underuse = np.zeros((max(N_chunks, 1)), dtype=np.int64)
+    Y_underuse = np.zeros((max(N_chunks, 1)), dtype=np.int64)
+
+    for chunk in range(N_chunks):
+
+        it_start = chunk*N_iter_chunk
+        it_stop = min(it_start+N_iter_chunk, N_iter)
+        in_start = it_start*N_inputs_per_it
+        in_stop = it_stop*N_inputs_per_it
+
+        # Build the MVM input vectors (im2col)
+        if mapping == 'reference':
+            A_Mat, B_Mat, X_flags, Y_flags = im2col_reference(tensor_A, tensor_B, SA_Param_dict)
+        else:
+            A_Mat, B_Mat, X_flags, Y_flags = im2col_strided(tensor_A, tensor_B, SA_Param_dict, iter_start=it_start, iter_stop=it_stop, dtype=op_dtype)
+
+        assert A_Mat.shape[0] == (in_stop-in_start), "There was a mapping issue, number of input vectors does not match"
+
+        X_underuse[chunk] = np.count_nonzero(X_flags)
+        Y_underuse[chunk] = np.count_nonzero(Y_flags)
+
+        # Split the batches in order to compute the MVM
+        A_Mat_mvm = np.swapaxes(np.reshape(A_Mat, (it_stop-it_start, N_inputs_per_it, size_Y)), 1,2)
+        B_Mat_mvm = np.reshape(B_Mat, (it_stop-it_start, N_inputs_per_it, size_X))
+        
+        # Typecast to the MVM data type (exact for integer values, see get_int_mvm_dtypes)
+        A_Mat_mvm = A_Mat_mvm.astype(mvm_dtype)
+        B_Mat_mvm = B_Mat_mvm.astype(mvm_dtype)
+
+        # Preloads of the chunk
+        if (len(preloads)>0):
+            preloads_mvm = tensor_to_mvm(preloads, SA_Param_dict, iter_start=it_start, iter_stop=it_stop, dtype=out_dtype)
+        else:
+            preloads_mvm = np.zeros((it_stop-it_start, size_Y, size_X), dtype=out_dtype)
+        
+        # MVM results
+        if not SA_Param_dict['approx_comp']:
+            C_Mat_mvm = np.matmul(A_Mat_mvm, B_Mat_mvm).astype(out_dtype) + preloads_mvm
+        else:
+            C_Mat_mvm = custom_matmul(A_Mat_mvm, B_Mat_mvm, preloads=preloads_mvm, exact=False, MANT_bits=SA_Param_dict['MANT_bits'], N_bits=SA_Param_dict['ACT_IA_W'], mul_type=SA_Param_dict['mul_type'], M=SA_Param_dict['M'], add_type=SA_Param_dict['add_type'], A=SA_Param_dict['A'], rounding=SA_Param_dict['rounding'], thres=SA_Param_dict.get('thres', 0))
+
+        mvm_to_tensor(C_Mat_mvm, SA_Param_dict, iter_start=it_start, tensor=tensor_C_mvm)
+
+    # MACs of the dense MVM vs. MACs computed by the sparse golden
+    macs_dense = N_inputs*size_Y*size_X
+    macs_done = macs_dense
+
+    if sparse_operand is not None:
+        tensor_C_sparse, macs_done = conv2d_sparse(tensor_A.astype(mvm_dtype), tensor_B.astype(mvm_dtype), s, d, operand=sparse_operand)
+
+        X_underuse[:] = N_inputs if ((ucoef_C_c<1) and (size_X>X_used)) else 0
+        Y_underuse[:] = N_inputs if ((ucoef_C_w<1) and (size_Y>Y_used)) else 0
+
+        tensor_C_mvm[:] = tensor_C_sparse
+        if (len(preloads)>0):
+            tensor_C_mvm += np.asarray(preloads).astype(out_dtype)
+
+    SA_Param_dict['mvm_sparse_gain'] = macs_dense/max(macs_done, 1)
+
+    # The full MVM matrices are only kept when the layer is mapped at once
+    if (N_iter_chunk < N_iter) or (sparse_operand is not None):
+        A_Mat = None
+        B_Mat = None
+        
+    # Check MVM results against the reference: whole reference tensor, or output positions
+    # in blocks (sampled check, or full check within the memory budget)
+    if check_level == 'sampled':
+        rng = np.random.default_rng()
+        point_blocks = [rng.choice(tensor_C_mvm.size, size=min(check_samples, tensor_C_mvm.size), replace=False)]
+    elif (check_level == 'full') and (tensor_C is None):
+        block = max(1, int(max_mem_MB*1024*1024)//(3*8*AB_c*B_h*B_w))
+        point_blocks = (np.arange(start, min(start+block, tensor_C_mvm.size)) for start in range(0, tensor_C_mvm.size, block))
+    else:
+        point_blocks = []
+
+    # Typically there is some +-0.1 error due to FP32 numerical precision!
+    l2_norm_scaled = np.linalg.norm(tensor_C_mvm.ravel())/np.size(tensor_C_mvm)
+    tol = max(1.2, l2_norm_scaled/100)
+
+    check_points = 0
+    max_err = 0
+    failed = None
+
+    if tensor_C is not None:
+        err = np.abs(tensor_C - tensor_C_mvm)
+        check_points = tensor_C.size
+        max_err = np.max(err)
+        if not np.all(err<(tol)):
+            failed = (tensor_C[:4, :4, :4], tensor_C_mvm[:4, :4, :4])
+
+    for points in point_blocks:
+        k_idx, y_idx, x_idx = np.unravel_index(points, tensor_C_mvm.shape)
+
+        ref_values = conv2d_sampled(tensor_A, tensor_B, k_idx, y_idx, x_idx, s, d, bias=bias)
+        if (len(preloads)>0):
+            ref_values = ref_values + np.asarray(preloads)[k_idx, y_idx, x_idx]
+
+        mvm_values = tensor_C_mvm[k_idx, y_idx, x_idx]
+
+        err = np.abs(ref_values - mvm_values)
+        check_points += points.size
+        max_err = max(max_err, np.max(err))
+        if (failed is None) and not np.all(err<(tol)):
+            failed = (ref_values[:16], mvm_values[:16])
+
+    SA_Param_dict['check_level'] = check_level
+    SA_Param_dict['check_points'] = check_points
+
+    if failed is not None:
+        print("Reference ({}) results:".format(golden_backend))
+        print(failed[0])
+        print("------------------")
+        print("MVM results:")
+        print(failed[1])
+        print("------------------")
+        print("L2 Norm scaled:")
+        print(l2_norm_scaled/100)
+        print("Max error:")
+        print(max_err)
+        
+    assert failed is None, "Result check did not match numerically! tol={}; max err={}".format(tol, max_err)
+
+    if not silent:
+        print("\nTotal iterations:")
+        print("{}".format(N_iter))
+        print("\nTotal number of MVM input vectors:")
+        print("{}".format(N_inputs))
+
+    return N_inputs, N_iter, X_underuse, Y_underuse, tensor_C_mvm, tensor_C, A_Mat, B_Mat
+
+# ------------------------------------------------------------
+# Accurate computation of partial MACs exactly like SAURIA
+# ------------------------------------------------------------
+
+def compute_partial_macs(A_Mats, B_Mats, C_tensor, CONV, HYPER):
+
+    X_used = CONV['X_used']
+    Y_used = CONV['Y_used']
+    N_cswitch = CONV['N_cswitch']
+    intyp = HYPER['intyp']
+
+    N_values_per_ctx = CONV['B_w']*CONV['B_h']*CONV['AB_c']
+            
+    # Convolution => Need some mapping
+    C_pre = np.zeros((N_cswitch, X_used, Y_used), dtype=intyp)
+    
+    til = 0
+    for k in range(CONV['K_int_tiles']):
+        for y in range(CONV['Y_int_tiles']):
+            for x in range(CONV['X_int_tiles']):
+                    
+                C_pre[til] = C_tensor[X_used*k:X_used*(k+1), y, Y_used*x:Y_used*(x+1)]
+                til += 1
+                
+    A_Mats = np.reshape(A_Mats[:,:Y_used], (N_cswitch, N_values_per_ctx, Y_used)).astype(intyp)
+    B_Mats = np.reshape(B_Mats[:,:X_used], (N_cswitch, N_values_per_ctx, X_used)).astype(intyp)
+
+    # Exact version: outer products + running sum along the reduction axis
+    if not HYPER['approx_comp']:
+
+        # Zero gating => Quite important for efficiency! (and negligence, as the PEs)
+        gate = get_mac_gate(B_Mats[:,:,:,None], A_Mats[:,:,None,:], CONV.get('thres', 0), FP=(HYPER['OP_TYPE']==1))
+        muls = B_Mats[:,:,:,None] * A_Mats[:,:,None,:]
+
+        partial_muls = np.zeros((N_cswitch, N_values_per_ctx+1, X_used, Y_used), dtype=intyp)
+        partial_muls[:,1:] = np.where(gate, muls, intyp(0))
+
+        # Gated steps add -0.0, which leaves any value (and the sign of zero) untouched
+        partial_ops = np.empty((N_cswitch, N_values_per_ctx+1, X_used, Y_used), dtype=intyp)
+        partial_ops[:,0] = C_pre
+        partial_ops[:,1:] = np.where(gate, muls, intyp(-0.0))
+
+        # Sequential accumulation in intyp, same rounding order as the hardware
+        np.cumsum(partial_ops, axis=1, dtype=intyp, out=partial_ops)
+
+        return partial_ops, partial_muls, [A_Mats, B_Mats]
+        
+    # Initialize arrays
+    partial_ops = np.zeros((N_cswitch, N_values_per_ctx+1, X_used, Y_used), dtype=intyp)
+    partial_muls = np.zeros((N_cswitch, N_values_per_ctx+1, X_used, Y_used), dtype=intyp)
+    
+    partial_ops[:,0] = C_pre
+    
+    # Approx version
+    for ctx in range(N_cswitch):
+        for idx in range(1,N_values_per_ctx+1):
+            
+            for y in range(Y_used):
+                for x in range(X_used):
+            
+                    # Zero gating => Quite important for efficiency! (and negligence, as the PEs)
+                    if (A_Mats[ctx, idx-1, y]!=0) and (B_Mats[ctx, idx-1, x]!=0) and ((CONV.get('thres', 0) == 0) or get_mac_gate(A_Mats[ctx, idx-1, y], B_Mats[ctx, idx-1, x], CONV['thres'], FP=True)):        
+                        _,_,partial_ops[ctx, idx, x, y] =   FP_Madd(A_Mats[ctx, idx-1, y], B_Mats[ctx, idx-1, x], partial_ops[ctx, idx-1, x, y], MANT_bits=HYPER['IA_MANT'], N_bits=HYPER['IA_W'], MulType=HYPER['mul_type'], m=HYPER['M'], AdderType=HYPER['add_type'], A=HYPER['A'], rounding=HYPER['rounding'])
+                        #_,_,partial_muls[ctx, idx, x, y] =  FP_Madd(A_Mats[ctx, idx-1, y], B_Mats[ctx, idx-1, x], 0,                             MANT_bits=HYPER['IA_MANT'], N_bits=HYPER['IA_W'], MulType=HYPER['mul_type'], m=HYPER['M'], AdderType=HYPER['add_type'], A=HYPER['A'], rounding=HYPER['rounding'])
+
+                    else:
+                        partial_ops[ctx, idx, x, y] = partial_ops[ctx, idx-1, x, y]
+                        partial_muls[ctx, idx, x, y] = 0
+
+    return partial_ops, partial_muls, [A_Mats, B_Mats]
+
+# ------------------------------------------------------
+# DRAM traffic of a loop order (as done by the df_controller)
+# ------------------------------------------------------
+
+# The tile loop nests of the controller, from inner to outer. 'S' are the spatial
+# tiles (x, then y), 'C' the input channel tiles and 'K' the output channel tiles.
+# When a loop level advances, all inner levels also advance, and each level that
+# has more than one tile forces a reload of the tensors it indexes:
+#   S -> A, C      C -> A, B      K -> B, C
+LOOP_ORDER_NESTS = {
+    0 : ['S', 'C', 'K'],    # Keep B: inner loop over w,h dims
+    1 : ['C', 'K', 'S'],    # Keep C: inner loop over c dim
+    2 : ['K', 'C', 'S'],    # Keep A: inner loop over k dim
+}
+
+def get_loop_order_traffic(CONV, HYPER, loop_order, CONV_full=None):
+
+    # For the jobs of a ragged layer, DRAM transfers depend on the whole tensors
+    if CONV_full is None:
+        CONV_full = CONV
+
+    # Tile sizes can also be numpy arrays (many candidate tilings at once)
+    Aw = np.asarray(CONV_full['A_w'])
+    Ah = np.asarray(CONV_full['A_h'])
+    Cw = np.asarray(CONV_full['C_w'])
+    Ch = np.asarray(CONV_full['C_h'])
+    
+    Aw_til = np.asarray(CONV['A_w_til']).astype(int)
+    Ah_til = np.asarray(CONV['A_h_til']).astype(int)
+    Ac_til = np.asarray(CONV['c_til'])
+    Cw_til = np.asarray(CONV['w_til'])
+    Ch_til = np.asarray(CONV['h_til'])
+    Ck_til = np.asarray(CONV['k_til'])
+
+    axi_bytes = HYPER['DATA_AXI_DATA_WIDTH']//8
+
+    # Number of tiles per loop level
+    level_tiles = {
+        'S' : (np.asarray(CONV['C_w'])//Cw_til)*(np.asarray(CONV['C_h'])//Ch_til),
+        'C' : np.asarray(CONV['AB_c'])//Ac_til,
+        'K' : np.asarray(CONV['C_c'])//Ck_til,
+    }
+    N_tiles = level_tiles['S']*level_tiles['C']*level_tiles['K']
+
+    # DMA transfers of one tile: [number of commands, elements per command]
+    A_full = (Aw == Aw_til) & (Ah == Ah_til)
+    A_cmds = [np.where(A_full, 1, np.where(Aw == Aw_til, Ac_til, Ac_til*Ah_til)),
+              np.where(A_full, Ac_til*Aw*Ah, np.where(Aw == Aw_til, Ah_til*Aw, Aw_til))]
+
+    B_cmds = [1, Ck_til*CONV['B_w']*CONV['B_h']*Ac_til]
+
+    C_full = (Cw == Cw_til) & (Ch == Ch_til)
+    C_cmds = [np.where(C_full, 1, np.where(Cw == Cw_til, Ck_til, Ck_til*Ch_til)),
+              np.where(C_full, Ck_til*Cw*Ch, np.where(Cw == Cw_til, Ch_til*Cw, Cw_til))]
+
+    # Bytes moved per tile, rounded up to whole AXI beats per command
+    elem_bytes = [HYPER['IA_W']//8, HYPER['IB_W']//8, HYPER['OC_W']//8]
+    tile_bytes = [n*(-((-ett*eb)//axi_bytes))*axi_bytes for (n, ett), eb in zip([A_cmds, B_cmds, C_cmds], elem_bytes)]
+
+    # Number of tile loads: the first one + every advance of the innermost level that reloads the tensor
+    nest = LOOP_ORDER_NESTS[loop_order]
+    reload_levels = {'A' : ['S', 'C'], 'B' : ['C', 'K'], 'C' : ['S', 'K']}
+
+    loads = {}
+    for tensor, levels in reload_levels.items():
+        loads[tensor] = np.ones_like(N_tiles)
+        found = np.zeros(np.shape(N_tiles), dtype=bool)
+        inner_tiles = 1
+        for level in nest:
+            if level in levels:
+                reload = (~found) & (level_tiles[level] > 1)
+                loads[tensor] = np.where(reload, N_tiles//inner_tiles, loads[tensor])
+                found = found | reload
+            inner_tiles = inner_tiles*level_tiles[level]
+
+    # Psums are read when loaded and written back when replaced. Without preloads, the first
+    # load of each psum tile (first pass over c) is not read
+    C_reads = loads['C'] if CONV.get('preload_en', 1) else loads['C'] - level_tiles['S']*level_tiles['K']
+
+    TRAFFIC = {
+        'loop_order' :  loop_order,
+        'tensor_kept' : ['B', 'C', 'A'][loop_order],
+        'N_tiles' :     N_tiles,
+        'A_loads' :     loads['A'],
+        'B_loads' :     loads['B'],
+        'C_loads' :     loads['C'],
+        'A_bytes' :     loads['A']*tile_bytes[0],
+        'B_bytes' :     loads['B']*tile_bytes[1],
+        'C_rd_bytes' :  C_reads*tile_bytes[2],
+        'C_wr_bytes' :  loads['C']*tile_bytes[2],
+    }
+    TRAFFIC['total_bytes'] = TRAFFIC['A_bytes'] + TRAFFIC['B_bytes'] + TRAFFIC['C_rd_bytes'] + TRAFFIC['C_wr_bytes']
+    TRAFFIC['dma_cmds'] = loads['A']*A_cmds[0] + loads['B']*B_cmds[0] + (C_reads + loads['C'])*C_cmds[0]
+
+    # Plain integers for a single tiling
+    if np.ndim(N_tiles) == 0:
+        TRAFFIC = {key : (int(val) if (key != 'tensor_kept') else val) for key, val in TRAFFIC.items()}
+
+    return TRAFFIC
+
+# ------------------------------------------------------
+# Search the loop order with minimum DRAM traffic
+# ------------------------------------------------------
+
+def search_loop_order(CONV, HYPER, CONV_full=None):
+
+    candidates = [get_loop_order_traffic(CONV, HYPER, loop_order, CONV_full=CONV_full) for loop_order in LOOP_ORDER_NESTS]
+
+    # Ties are broken in favor of the lowest loop order index
+    best = min(candidates, key=lambda t: (t['total_bytes'], t['loop_order']))
+
+    return best['loop_order'], best, candidates
+
+# ------------------------------------------------------
+# Analytical cycle model (calibrated against RTL simulations)
+# ------------------------------------------------------
+
+# The model is linear in a few features of each tiling. Stalls come from the feeders
+# (activation row windows wider than the reduction steps that hide their reads,
+# weights not aligned to the SRAM words) and from context switches that take longer
+# than one context (the switch propagates through the X+Y array). The tile time adds
+# the reduction steps of all contexts, a fixed cost per context and the array/FIFO fill.
+# The total time adds the tiles, the DMA beats, the DMA commands and a fixed cost per
+# tile of the controller. Default coefficients are rough first guesses: calibrate them
+# with calibrate_cycle_model and the stats_dict of past simulations.
+CYCLE_MODEL_COEFS = {
+    'stalls' :  {'act' : 1.0, 'wei' : 1.0, 'cswitch' : 1.0, 'const' : 0.0},
+    'tile' :    {'compute' : 1.0, 'contexts' : 2.0, 'fill' : 1.0, 'act' : 1.0, 'wei' : 1.0, 'cswitch' : 1.0, 'const' : 10.0},
+    'total' :   {'tiles' : 1.0, 'dma' : 0.5, 'dma_exposed' : 0.0, 'dma_cmds' : 8.0, 'tile_overhead' : 20.0, 'const' : 100.0},
+}
+
+# Features of the stalls and of one tile (tile sizes can be numpy arrays, many candidate
+# tilings at once), plus the DMA beats and commands of the whole layer
+def get_cycle_features(CONV, HYPER, loop_order, CONV_full=None):
+
+    B_w = np.asarray(CONV['B_w'])
+    B_h = np.asarray(CONV['B_h'])
+    s = np.asarray(CONV['s'])
+    d = np.asarray(CONV['d'])
+
+    c_til = np.asarray(CONV['c_til'])
+    k_til = np.asarray(CONV['k_til'])
+    w_til = np.asarray(CONV['w_til'])
+    h_til = np.asarray(CONV['h_til'])
+    X_used = np.asarray(CONV['X_used'])
+    Y_used = np.asarray(CONV['Y_used'])
+
+    X = HYPER['X']
+    Y = HYPER['Y']
+    SRAMA_N = HYPER['MEMA_N']
+    SRAMB_N = HYPER['MEMB_N']
+
+    B_w_eff = 1 + (B_w - 1)*d
+    N_red = B_w*B_h*c_til
+    N_cswitch = (w_til//Y_used)*h_til*(k_til//X_used)
+    ones = np.ones(np.shape(N_cswitch))
+
+    # Feeder alignment (o_waligned and o_xlim, as in get_sauria_regs)
+    waligned = (k_til%SRAMB_N == 0) & (X_used == SRAMB_N)
+    xaligned = (s == 1) & (d == 1) & (B_w == 1) & (B_h == 1) & (c_til%SRAMA_N == 0) & (Y_used%SRAMA_N == 0)
+    o_xlim = np.where(xaligned, Y_used, (1 + (Y_used-1)*s) + B_w_eff + 1-(B_w_eff%2) + SRAMA_N)
+
+    # Activations: the words of a new row window that the B_w steps of the row cannot hide
+    act = N_cswitch*B_h*c_til*np.maximum(0, -(-o_xlim//SRAMA_N) - B_w)
+
+    # Unaligned weights: one extra read every time the X_used weights cross an SRAM word
+    wei = np.where(waligned, 0, N_cswitch*(-(-N_red*X_used//SRAMB_N)))
+
+    # Context switches longer than the reduction of one context
+    cswitch = N_cswitch*np.maximum(0, X + Y - N_red)
+
+    traffic = get_loop_order_traffic(CONV, HYPER, loop_order, CONV_full=CONV_full)
+
+    FEATURES = {
+        'stalls' :      {'act' : act, 'wei' : wei, 'cswitch' : cswitch, 'const' : ones},
+        'tile' :        {'compute' : N_cswitch*N_red, 'contexts' : N_cswitch, 'fill' : (X + Y + HYPER['FIFO_FILL_CYCLES'])*ones,
+                         'act' : act, 'wei' : wei, 'cswitch' : cswitch, 'const' : ones},
+        'N_tiles' :     np.asarray(traffic['N_tiles']),
+        'dma_beats' :   np.asarray(traffic['total_bytes'])/(HYPER['DATA_AXI_DATA_WIDTH']//8),
+        'dma_cmds' :    np.asarray(traffic['dma_cmds']),
+    }
+
+    return FEATURES
+
+# Features of the total time, given the (predicted) cycles of one tile. DMA beats that
+# the computation of a tile does not hide are counted again as exposed
+def get_total_cycle_features(FEATURES, tile_cycles):
+
+    N_tiles = FEATURES['N_tiles']
+    dma_beats = FEATURES['dma_beats']
+
+    return {
+        'tiles' :           N_tiles*tile_cycles,
+        'dma' :             dma_beats,
+        'dma_exposed' :     N_tiles*np.maximum(0, dma_beats/N_tiles - tile_cycles),
+        'dma_cmds' :        FEATURES['dma_cmds'],
+        'tile_overhead' :   N_tiles,
+        'const' :           np.ones(np.shape(N_tiles)),
+    }
+
+def linear_cycle_model(coefs, features):
+    return sum(coefs[key]*features[key] for key in coefs)
+
+# Predicted cycles of one uniform job (vectorized over candidate tilings)
+def predict_cycles(CONV, HYPER, loop_order, coefs=None, CONV_full=None):
+
+    if coefs is None:
+        coefs = CYCLE_MODEL_COEFS
+
+    FEATURES = get_cycle_features(CONV, HYPER, loop_order, CONV_full=CONV_full)
+
+    tile_cycles = linear_cycle_model(coefs['tile'], FEATURES['tile'])
+    total_features = get_total_cycle_features(FEATURES, tile_cycles)
+
+    PREDICTION = {
+        '1tile_SAURIA_cycles' : tile_cycles,
+        '1tile_SAURIA_stalls' : linear_cycle_model(coefs['stalls'], FEATURES['stalls']),
+        'total_cycles' :        linear_cycle_model(coefs['total'], total_features),
+        'compute_cycles' :      FEATURES['N_tiles']*FEATURES['tile']['compute'],
+        'dma_beats' :           FEATURES['dma_beats'],
+    }
+
+    return PREDICTION
+
+# Features of a whole layer: tile and stall features of the first job (as measured by the
+# stats counters), total features summed over all jobs of a ragged layer
+def get_conv_cycle_features(CONV, HYPER, loop_order_mode='heuristic', coefs=None):
 
-    if not silent:
-        print("\nTotal iterations:")
-        print("{}".format(N_iter))
-        print("\nTotal number of MVM input vectors:")
-        print("{}".format(N_inputs))
+    if coefs is None:
+        coefs = CYCLE_MODEL_COEFS
 
-    return N_inputs, N_iter, X_underuse, Y_underuse, tensor_C_mvm, tensor_C, A_Mat, B_Mat
+    FEATURES = {}
 
-# ------------------------------------------------------------
-# Accurate computation of partial MACs exactly like SAURIA
-# ------------------------------------------------------------
+    for job in get_conv_jobs(CONV):
 
-def compute_partial_macs(A_Mats, B_Mats, C_tensor, CONV, HYPER):
+        CONV_job = job['CONV']
+        _,_,_,loop_order = get_tiling_loops(CONV_job, mode=loop_order_mode, HYPER=HYPER, CONV_full=CONV)
 
-    X_used = CONV['X_used']
-    Y_used = CONV['Y_used']
-    N_cswitch = CONV['N_cswitch']
-    intyp = HYPER['intyp']
+        job_features = get_cycle_features(CONV_job, HYPER, loop_order, CONV_full=CONV)
+        tile_cycles = linear_cycle_model(coefs['tile'], job_features['tile'])
+        total_features = get_total_cycle_features(job_features, tile_cycles)
 
-    N_values_per_ctx = CONV['B_w']*CONV['B_h']*CONV['AB_c']
-            
-    # Convolution => Need some mapping
-    C_pre = np.zeros((N_cswitch, X_used, Y_used), dtype=intyp)
-    
-    til = 0
-    for k in range(CONV['K_tiles']):
-        for y in range(CONV['Y_tiles']):
-            for x in range(CONV['X_tiles']):
-                    
-                C_pre[til] = C_tensor[X_used*k:X_used*(k+1), y, Y_used*x:Y_used*(x+1)]
-                til += 1
-                
-    A_Mats = np.reshape(A_Mats[:,:Y_used], (N_cswitch, N_values_per_ctx, Y_used)).astype(intyp)
-    B_Mats = np.reshape(B_Mats[:,:X_used], (N_cswitch, N_values_per_ctx, X_used)).astype(intyp)
-        
-    # Initialize arrays
-    partial_ops = np.zeros((N_cswitch, N_values_per_ctx+1, X_used, Y_used), dtype=intyp)
-    partial_muls = np.zeros((N_cswitch, N_values_per_ctx+1, X_used, Y_used), dtype=intyp)
-    
-    partial_ops[:,0] = C_pre
-    
-    idx = 0
-    for ctx in range(N_cswitch):
-        for idx in range(1,N_values_per_ctx+1):
-            
-            for y in range(Y_used):
-                for x in range(X_used):
-            
-                    # Zero gating => Quite important for efficiency!
-                    if (A_Mats[ctx, idx-1, y]!=0) and (B_Mats[ctx, idx-1, x]!=0):        
-            
-                        # Exact version
-                        if not HYPER['approx_comp']:
-                            partial_muls[ctx, idx, x, y] = A_Mats[ctx, idx-1, y] * B_Mats[ctx, idx-1, x]
-                            partial_ops[ctx, idx, x, y] = partial_ops[ctx, idx-1, x, y] + partial_muls[ctx, idx, x, y]
+        if len(FEATURES) == 0:
+            FEATURES = {'stalls' : job_features['stalls'], 'tile' : job_features['tile'], 'total' : total_features}
+        else:
+            FEATURES['total'] = {key : FEATURES['total'][key] + total_features[key] for key in total_features}
 
-                        # Approx version
-                        else:
-                            _,_,partial_ops[ctx, idx, x, y] =   FP_Madd(A_Mats[ctx, idx-1, y], B_Mats[ctx, idx-1, x], partial_ops[ctx, idx-1, x, y], MANT_bits=HYPER['IA_MANT'], N_bits=HYPER['IA_W'], MulType=HYPER['mul_type'], m=HYPER['M'], AdderType=HYPER['add_type'], A=HYPER['A'], rounding=HYPER['rounding'])
-                            #_,_,partial_muls[ctx, idx, x, y] =  FP_Madd(A_Mats[ctx, idx-1, y], B_Mats[ctx, idx-1, x], 0,                             MANT_bits=HYPER['IA_MANT'], N_bits=HYPER['IA_W'], MulType=HYPER['mul_type'], m=HYPER['M'], AdderType=HYPER['add_type'], A=HYPER['A'], rounding=HYPER['rounding'])
+    # The fixed cost of the layer is paid once
+    FEATURES['total']['const'] = np.ones(np.shape(FEATURES['total']['const']))
 
-                    else:
-                        partial_ops[ctx, idx, x, y] = partial_ops[ctx, idx-1, x, y]
-                        partial_muls[ctx, idx, x, y] = 0
+    return FEATURES
 
-    return partial_ops, partial_muls, [A_Mats, B_Mats]
+# Predicted cycles of a layer, including ragged layers split in jobs
+def predict_conv_cycles(CONV, HYPER, loop_order_mode='heuristic', coefs=None):
+
+    if coefs is None:
+        coefs = CYCLE_MODEL_COEFS
+
+    FEATURES = get_conv_cycle_features(CONV, HYPER, loop_order_mode=loop_order_mode, coefs=coefs)
+
+    PREDICTION = {target : float(linear_cycle_model(coefs[target], FEATURES[target])) for target in ['stalls', 'tile', 'total']}
+
+    return {
+        '1tile_SAURIA_cycles' : PREDICTION['tile'],
+        '1tile_SAURIA_stalls' : PREDICTION['stalls'],
+        'total_cycles' :        PREDICTION['total'],
+    }
+
+# Prediction error (relative to the measured values)
+def get_cycle_prediction_error(predicted, measured):
+
+    predicted = np.asarray(predicted, dtype=np.float64)
+    measured = np.asarray(measured, dtype=np.float64)
+    rel_error = np.abs(predicted - measured)/np.maximum(np.abs(measured), 1)
+
+    return {
+        'mean_rel_error' :  float(np.mean(rel_error)),
+        'max_rel_error' :   float(np.max(rel_error)),
+        'rmse' :            float(np.sqrt(np.mean((predicted - measured)**2))),
+    }
+
+# Stats of the simulations predicted by each part of the model
+CYCLE_MODEL_TARGETS = {'stalls' : '1tile_SAURIA_stalls', 'tile' : '1tile_SAURIA_cycles', 'total' : 'total_cycles'}
+
+# Fit the coefficients of the cycle model (non-negative least squares on the relative
+# error, so that small layers weigh as much as large ones) against past simulations. Every sample is (CONV, HYPER, stats_dict) with the stats_dict returned by
+# Conv2d_SAURIA. Stalls and tile cycles are fitted first, the total time then uses the
+# fitted tile cycles, as when predicting. Returns the coefficients and the prediction
+# error of each target before and after the calibration.
+def calibrate_cycle_model(samples, loop_order_mode='heuristic', coefs=None):
+
+    assert len(samples) > 0, "The cycle model needs at least one simulation to be calibrated"
+
+    if coefs is None:
+        coefs = CYCLE_MODEL_COEFS
+
+    new_coefs = copy.deepcopy(coefs)
+
+    for target in CYCLE_MODEL_TARGETS:
+
+        # Total features depend on the (already fitted) tile coefficients
+        features = [get_conv_cycle_features(CONV, HYPER, loop_order_mode=loop_order_mode, coefs=new_coefs)[target] for CONV, HYPER, _ in samples]
+        measured = np.array([stats_dict[CYCLE_MODEL_TARGETS[target]] for _, _, stats_dict in samples], dtype=np.float64)
+
+        keys = list(coefs[target].keys())
+        F_Mat = np.array([[float(f[key]) for key in keys] for f in features])
+
+        weights = 1/np.maximum(measured, 1)
+        fit, _ = optimize.nnls(F_Mat*weights[:,None], measured*weights)
+        new_coefs[target] = {key : float(val) for key, val in zip(keys, fit)}
+
+    # Prediction error of the initial and of the calibrated coefficients
+    REPORT = {'N_samples' : len(samples)}
+
+    for label, model_coefs in [('before', coefs), ('after', new_coefs)]:
+        predictions = [predict_conv_cycles(CONV, HYPER, loop_order_mode=loop_order_mode, coefs=model_coefs) for CONV, HYPER, _ in samples]
+        for stats_key in CYCLE_MODEL_TARGETS.values():
+            REPORT.setdefault(stats_key, {})[label] = get_cycle_prediction_error([p[stats_key] for p in predictions], [stats_dict[stats_key] for _, _, stats_dict in samples])
+
+    return new_coefs, REPORT
 
 # ------------------------------------------------------
 # Get tiling loops with Heuristic - Decides stationarity
 # ------------------------------------------------------
 
-def get_tiling_loops(CONV):
+def get_tiling_loops(CONV, mode='heuristic', HYPER=None, CONV_full=None):
+
+    assert mode in ['heuristic', 'search'], "Unrecognized loop order mode = '{}'".format(mode)
     
     A_tile_shape = [CONV['c_til'],CONV['A_h_til'],CONV['A_w_til']]
     B_tile_shape = [CONV['k_til'],CONV['c_til'],CONV['B_h'],CONV['B_w']]
@@ -453,7 +1801,13 @@ def get_tiling_loops(CONV):
         C_weight = 0
         
     # Decide based on which tensor weighs the most
-    decision = np.argmax([B_weight,C_weight,A_weight])
+    if mode == 'heuristic':
+        decision = np.argmax([B_weight,C_weight,A_weight])
+
+    # Or based on the exact DRAM traffic of every loop order of the controller
+    else:
+        assert HYPER is not None, "The loop order search needs the hardware parameters (HYPER)"
+        decision, _, _ = search_loop_order(CONV, HYPER, CONV_full=CONV_full)
     
     # IF WE KEEP TENSOR B - Inner loop over w,h dims
     if (decision == 0):
@@ -491,92 +1845,621 @@ def map_tiling_vars(i,j,k,m,id_list):
     
     return c,k,w,h
 
-# ------------------------------------------------------------
-# Cycle-accurate convolution for HW debugging
-# ------------------------------------------------------------
+# ------------------------------------------------------
+# Jobs of a layer (ragged layers are split in uniform jobs)
+# ------------------------------------------------------
 
-def cycle_accurate_convolution(CONV, HYPER, tensors, SA, map_iter_list, id_list, silent=True):
+def get_conv_jobs(CONV):
 
-    # Retrieve convolution variables
-    B_w = CONV['B_w']
-    B_h = CONV['B_h']
-    C_w = CONV['C_w']
-    C_h = CONV['C_h']
-    C_c = CONV['C_c']
-    A_w = CONV['A_w']
-    A_h = CONV['A_h']
-    AB_c = CONV['AB_c']
-    s =    CONV['s']
-    
+    if CONV.get('jobs') is None:
+        return [{'CONV': CONV, 'origin': [0,0,0,0], 'tile_origin': [0,0,0,0]}]
+
+    return CONV['jobs']
+
+# Largest array use (<= used) that divides the tile size
+def fit_array_use(til, used):
+    return max([u for u in range(1, min(til, used)+1) if til%u == 0])
+
+# DRAM offsets (in elements, relative to the start of each tensor) of tile (c,k,w,h)
+# of the layer, where CONV_job is the job the tile belongs to. They use the same tile
+# strides as the controller (cfg.get_tile_strides). Main tiles give the positions of
+# all tiles, also the (last) edge tiles. B is stored as blocks [K_tiles][C_tiles] of
+# [c_til, K_h, K_w, k_til], and the blocks before the tile have the k size of its job
+
+def get_tile_dram_offsets(CONV, c, k, w, h, CONV_job=None):
+
+    if CONV_job is None:
+        CONV_job = CONV
+
+    STRIDES = cfg.get_tile_strides(CONV, WXfer_op=True)
+
+    A_offs = c*STRIDES['tile_ifmaps_c_step'] + h*STRIDES['tile_ifmaps_y_step'] + w*STRIDES['tile_ifmaps_x_step']
+    B_offs = k*STRIDES['tile_weights_k_step'] + (c*STRIDES['tile_weights_c_step']//CONV['k_til'])*CONV_job['k_til']
+    C_offs = k*STRIDES['tile_psums_k_step'] + h*STRIDES['tile_psums_y_step'] + w*STRIDES['tile_psums_x_step']
+
+    return [A_offs, B_offs, C_offs]
+
+# ------------------------------------------------------
+# Tile iterator in the loop order of the hardware
+# ------------------------------------------------------
+
+# Yields one lightweight descriptor per tile: numpy views of the A/B/C tiles (no
+# copies), the tile-local CONV parameters (one dict shared by all tiles of a job),
+# the tile offsets in DRAM (in elements, relative to the start of each tensor, with
+# B in the transfer-optimized layout) and the tile and loop indices. Ragged layers
+# are iterated job by job, with tile indices relative to the whole layer. The first
+# tile of each job (loop indices 0) also carries what the controller config of the
+# job needs: its CONV dict and loop order. Tensors can be None (no views).
+
+def get_tile_conv(CONV):
+
+    CONV_tile = dict(CONV)
+    CONV_tile['C_w'] = CONV['w_til']
+    CONV_tile['C_h'] = CONV['h_til']
+    CONV_tile['C_c'] = CONV['k_til']
+    CONV_tile['A_w'] = CONV['A_w_til']
+    CONV_tile['A_h'] = CONV['A_h_til']
+    CONV_tile['A_c'] = CONV['c_til']
+    CONV_tile['AB_c'] = CONV['c_til']
+
+    return CONV_tile
+
+def iterate_tiles(CONV, tensors=None, map_iter_list=None, id_list=None, loop_order_mode='heuristic', HYPER=None):
+
+    s = CONV['s']
     c_til = CONV['c_til']
     k_til = CONV['k_til']
     h_til = CONV['h_til']
     w_til = CONV['w_til']
-    A_h_til = CONV['A_h_til']
-    A_w_til = CONV['A_w_til']
-                         
-    # Partial macs list
-    partial_macs = []
+
+    jobs = get_conv_jobs(CONV)
+
+    order = 0
+
+    for job_idx, job in enumerate(jobs):
+
+        CONV_job = job['CONV']
+        c0, k0, h0, w0 = job['tile_origin']
+
+        # Loop order of the job (given by the caller for uniform layers)
+        if (map_iter_list is None) or (len(jobs) > 1):
+            _, job_iter_list, job_id_list, loop_order = get_tiling_loops(CONV_job, mode=loop_order_mode, HYPER=HYPER, CONV_full=CONV)
+        else:
+            job_iter_list, job_id_list, loop_order = map_iter_list, id_list, None
+
+        # Tile sizes of the job (edge tiles are smaller)
+        c_size = CONV_job['c_til']
+        k_size = CONV_job['k_til']
+        h_size = CONV_job['h_til']
+        w_size = CONV_job['w_til']
+        A_h_size = int(CONV_job['A_h_til'])
+        A_w_size = int(CONV_job['A_w_til'])
+
+        CONV_tile = get_tile_conv(CONV_job)
+
+        # TILING LOOPS
+        for m in range(job_iter_list[3]):
+            for l in range(job_iter_list[2]):
+                for j in range(job_iter_list[1]):               
+                    for i in range(job_iter_list[0]):
+                        
+                        c,k,w,h = map_tiling_vars(i,j,l,m,job_id_list)
+                        c,k,w,h = c+c0, k+k0, w+w0, h+h0
+
+                        TILE = {
+                            'order' :       order,
+                            'job' :         job_idx,
+                            'idx' :         (c,k,w,h),
+                            'loop_idx' :    (i,j,l,m),
+                            'CONV' :        CONV_tile,
+                            'dram_offsets': get_tile_dram_offsets(CONV, c, k, w, h, CONV_job)
+                        }
+
+                        if (i,j,l,m) == (0,0,0,0):
+                            TILE['CONV_job'] = CONV_job
+                            TILE['loop_order'] = loop_order
+
+                        # Tiles are views of the full tensors
+                        if tensors is not None:
+                            if tensors[0] is not None:
+                                TILE['A'] = tensors[0][c*c_til:c*c_til+c_size, h*s*h_til:h*s*h_til+A_h_size, w*s*w_til:w*s*w_til+A_w_size]
+                            if tensors[1] is not None:
+                                TILE['B'] = tensors[1][k*k_til:k*k_til+k_size, c*c_til:c*c_til+c_size, :, :]
+                            if tensors[2] is not None:
+                                TILE['C'] = tensors[2][k*k_til:k*k_til+k_size, h*h_til:h*h_til+h_size, w*w_til:w*w_til+w_size]
+
+                        order += 1
+
+                        yield TILE
+
+# Weights in DRAM (transfer-optimized layout): the B block of every tile, flattened as
+# [c_size, K_h, K_w, k_size] at the offset of its descriptor. Blocks are shared by the
+# tiles of all (w,h), so only the tiles at w = h = 0 are written
+
+def pack_weight_tiles(B_tensor, CONV):
+
+    B_dram = np.zeros(np.size(B_tensor), dtype=np.asarray(B_tensor).dtype)
+
+    for TILE in iterate_tiles(CONV, tensors=[None, B_tensor, None]):
+        c, k, w, h = TILE['idx']
+        if (w == 0) and (h == 0):
+            B_block = np.moveaxis(TILE['B'], 0, -1).ravel()
+            B_dram[TILE['dram_offsets'][1] : TILE['dram_offsets'][1] + B_block.size] = B_block
+
+    return B_dram
+
+# ------------------------------------------------------------
+# Cycle-accurate computation of one output tile chain
+# ------------------------------------------------------------
+
+# Tiles that share (k,h,w) depend on each other through the accumulation of C
+# across c, so each chain is computed in order over its c_tiles. Different chains
+# are independent and can be computed in parallel. If trace_dir is set, the
+# partial macs of each tile are written to disk and only the file name is kept.
+
+def compute_tile_chain(HYPER, SA, chain_tiles, C_tile, chain_coords=None, trace_dir=None, golden_mode='mvm'):
+
+    # C is special because we aggregate the results from previous tiles
+    C_tile = copy.deepcopy(C_tile)
+
+    chain_results = []
+
+    for c, A_tile, B_tile, CONV_tile in chain_tiles:
+
+        # Get results for the current tile (hw: the accumulated tile follows the FMA sequence of the PEs).
+        # The layer golden is already checked and cached, so the tiles are neither checked nor cached
+        C_output_tile, _, _ = get_ideal_results(A_tile, B_tile, C_tile, CONV_tile, HYPER, SA, compute_macs=False, golden_mode=golden_mode, check_level='none', use_cache=False)
+
+        # Get matrices for the current tile
+        set_mvm_primitives(SA)
+        A_Mats_tile, B_Mats_tile, _, _ = im2col_strided(A_tile, B_tile, SA, dtype=HYPER['intyp'])
+
+        # Compute partial macs from the matrices
+        macs_tile, muls_tile, imats_tile = compute_partial_macs(A_Mats_tile, B_Mats_tile, C_tile, CONV_tile, HYPER)
+
+        # Aggregate results (convolution)
+        C_tile[:] = C_output_tile
+
+        if trace_dir is None:
+            chain_results.append([macs_tile, muls_tile, imats_tile])
+        else:
+            k, w, h = chain_coords
+            chain_results.append(fh.write_macs_trace_tile(trace_dir, c, k, w, h, macs_tile, muls_tile, imats_tile))
+
+    return C_tile, chain_results
+
+# ------------------------------------------------------------
+# Cycle-accurate convolution for HW debugging
+# ------------------------------------------------------------
+
+# Packs per-tile arrays of different shapes into a 1D object array
+def pack_tile_arrays(arr_list):
+    packed = np.empty(len(arr_list), dtype=object)
+    for i, arr in enumerate(arr_list):
+        packed[i] = arr
+    return packed
+
+def cycle_accurate_convolution(CONV, HYPER, tensors, SA, map_iter_list, id_list, n_workers=1, trace_dir=None, loop_order_mode='heuristic', golden_mode='mvm', silent=True):
+
+    C_tensor_full = copy.deepcopy(tensors[2])
+
+    # Group the tiles into independent (k,h,w) chains, keeping the order over c
+    tile_order = []
+    chains = {}
+    for TILE in iterate_tiles(CONV, [tensors[0], tensors[1], C_tensor_full], map_iter_list, id_list, loop_order_mode=loop_order_mode, HYPER=HYPER):
+
+        c,k,w,h = TILE['idx']
+        tile_order.append(TILE['idx'])
+
+        if (k,w,h) not in chains:
+            chains[(k,w,h)] = {'tiles': [], 'C': TILE['C']}
+        chains[(k,w,h)]['tiles'].append((c, TILE['A'], TILE['B'], TILE['CONV']))
+
+    chain_args = [(HYPER, copy.copy(SA), sorted(ch['tiles'], key=lambda t: t[0]), ch['C'], coords, trace_dir, golden_mode) for coords, ch in chains.items()]
+
+    # Compute the chains (0 workers => all available cores)
+    if n_workers == 0:
+        n_workers = os.cpu_count()
+
+    if (n_workers > 1) and (len(chains) > 1):
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(chains))) as pool:
+            futures = [pool.submit(compute_tile_chain, *args) for args in chain_args]
+            chain_outputs = [f.result() for f in futures]
+    else:
+        chain_outputs = [compute_tile_chain(*args) for args in chain_args]
+
+    if not silent:
+        print("Computed {} tile chains with {} worker(s)".format(len(chains), n_workers))
+
+    # Aggregate results (convolution), C tiles are views of C_tensor_full
+    # and the partial macs are indexed by tile coordinates
+    chain_results = {}
+    for args, (C_tile, results) in zip(chain_args, chain_outputs):
+        k, w, h = args[4]
+        chains[(k,w,h)]['C'][:] = C_tile
+        chain_results[(k,w,h)] = {tile[0] : res for tile, res in zip(args[2], results)}
+
+    # Streaming mode: the partial macs are on disk, return the trace index
+    if trace_dir is not None:
+        file_names = [chain_results[(k,w,h)][c] for (c,k,w,h) in tile_order]
+        partial_macs = fh.write_macs_trace_index(trace_dir, tile_order, file_names)
+        return C_tensor_full, partial_macs
+
     A_Mats = []
     B_Mats = []
     macs = []
     muls = []
-    
-    C_tensor_full = copy.deepcopy(tensors[2])
-                    
-    # TILING LOOPS
-    for m in range(map_iter_list[3]):
-        for l in range(map_iter_list[2]):
-            for j in range(map_iter_list[1]):               
-                for i in range(map_iter_list[0]):
-                    
-                    c,k,w,h = map_tiling_vars(i,j,l,m,id_list)
-                    
-                    # Set tile parameters in a copy of CONV, which will be passed to the functions...
-                    CONV_temp = copy.deepcopy(CONV)
-                    CONV_temp['C_w'] = w_til
-                    CONV_temp['C_h'] = h_til
-                    CONV_temp['C_c'] = k_til
-                    CONV_temp['A_w'] = A_w_til
-                    CONV_temp['A_h'] = A_h_til
-                    CONV_temp['AB_c'] = c_til
-                    
-                    # Get tiles (convolution)
-                    A_tile = tensors[0][c*c_til:(c+1)*c_til, h*s*h_til:h*s*h_til+int(A_h_til), w*s*w_til:w*s*w_til+int(A_w_til)]
-                    B_tile = tensors[1][k*k_til:(k+1)*k_til, c*c_til:(c+1)*c_til, :, :]
-                    
-                    # C is special because we aggregate the results from previous tiles
-                    C_tile = C_tensor_full[k*k_til:(k+1)*k_til, h*h_til:(h+1)*h_til, w*w_til:(w+1)*w_til]
-                                            
-                    # Get matrices for the current tile
-                    A_Mats_tile, B_Mats_tile, C_output_tile = get_ideal_results(A_tile, B_tile, C_tile, CONV_temp, HYPER, SA, compute_macs=False)
-    
-                    # Compute partial macs from the matrices
-                    macs_tile, muls_tile, imats_tile = compute_partial_macs(A_Mats_tile, B_Mats_tile, C_tile, CONV_temp, HYPER)
 
-                    # Aggregate results (convolution)
-                    C_tensor_full[k*k_til:(k+1)*k_til, h*h_til:(h+1)*h_til, w*w_til:(w+1)*w_til] = C_output_tile
-                        
-                    A_Mats.append(imats_tile[0])    
-                    B_Mats.append(imats_tile[1]) 
-                    macs.append(macs_tile)
-                    muls.append(muls_tile)
+    for (c,k,w,h) in tile_order:
+        macs_tile, muls_tile, imats_tile = chain_results[(k,w,h)][c]
+        A_Mats.append(imats_tile[0])    
+        B_Mats.append(imats_tile[1]) 
+        macs.append(macs_tile)
+        muls.append(muls_tile)
     
-    # Pack partial macs into list
-    macs = np.array(macs)
-    muls = np.array(muls)
-    A_Mats = np.array(A_Mats)
-    B_Mats = np.array(B_Mats)
+    # Pack partial macs into list (ragged layers => one object entry per tile, edge tiles are smaller)
+    if CONV.get('jobs') is None:
+        macs = np.array(macs)
+        muls = np.array(muls)
+        A_Mats = np.array(A_Mats)
+        B_Mats = np.array(B_Mats)
+    else:
+        macs, muls, A_Mats, B_Mats = [pack_tile_arrays(arr_list) for arr_list in [macs, muls, A_Mats, B_Mats]]
     
     partial_macs = [macs, muls, [A_Mats, B_Mats]]
 
     return C_tensor_full, partial_macs
 
+# ------------------------------------------------------------
+# Operand-toggle power proxy (from the cycle-accurate MAC trace)
+# ------------------------------------------------------------
+
+# Switching activity of the PE registers, counted as the Hamming distance between
+# consecutive values (relative power proxy, no gate-level tools needed):
+#   - A / B: operand registers of the MAC, which hold their value on zero-gated MACs
+#   - prop: pass-through registers of the systolic propagation (never gated)
+#   - acc: accumulator states, from the preload of each context to its last MAC
+TOGGLE_REGS = ['A', 'B', 'prop', 'acc']
+
+POPCOUNT_LUT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def popcount(values):
+    values = np.ascontiguousarray(values, dtype=np.uint64)
+    return POPCOUNT_LUT[values.view(np.uint8)].reshape(values.shape + (8,)).sum(axis=-1, dtype=np.int64)
+
+# Register bits of the values: two's complement of bit_width bits, or the FP16 encoding
+def get_bit_patterns(values, bit_width, FP=False):
+
+    if FP:
+        return np.asarray(values, dtype=np.float16).view(np.uint16).astype(np.uint64)
+
+    return np.asarray(values).astype(np.int64).astype(np.uint64) & np.uint64((1 << bit_width) - 1)
+
+# Toggles along the step axis (axis 0), starting from the reset value (0)
+def count_toggles(patterns):
+    previous = np.concatenate([np.zeros_like(patterns[:1]), patterns[:-1]])
+    return popcount(patterns ^ previous).sum(axis=0)
+
+# Toggle counts of one tile of the trace, per PE [X_used, Y_used]
+def get_tile_toggles(macs, imats, CONV, HYPER):
+
+    A_Mats, B_Mats = imats
+    N_cswitch, N_values, Y_used = np.shape(A_Mats)
+    X_used = np.shape(B_Mats)[2]
+    N_steps = N_cswitch*N_values
+
+    FP = (HYPER['OP_TYPE']==1)
+
+    # Context switches follow each other => one sequence of steps per PE
+    A_seq = np.reshape(A_Mats, (N_steps, 1, Y_used))
+    B_seq = np.reshape(B_Mats, (N_steps, X_used, 1))
+    gate = get_mac_gate(B_seq, A_seq, CONV.get('thres', 0), FP)
+
+    A_bits = np.broadcast_to(get_bit_patterns(A_seq, HYPER['IA_W'], FP), (N_steps, X_used, Y_used))
+    B_bits = np.broadcast_to(get_bit_patterns(B_seq, HYPER['IB_W'], FP), (N_steps, X_used, Y_used))
+
+    # Operand registers keep the last computed MAC (zero gating)
+    last = np.maximum.accumulate(np.where(gate, np.arange(N_steps)[:,None,None], -1), axis=0)
+    loaded = last >= 0
+    A_reg = np.where(loaded, np.take_along_axis(A_bits, np.maximum(last, 0), axis=0), np.uint64(0))
+    B_reg = np.where(loaded, np.take_along_axis(B_bits, np.maximum(last, 0), axis=0), np.uint64(0))
+
+    # Accumulator: preload + partial sums of every context
+    acc_bits = get_bit_patterns(np.reshape(macs, (-1, X_used, Y_used)), HYPER['OC_W'], FP)
+
+    return {
+        'A' :           count_toggles(A_reg),
+        'B' :           count_toggles(B_reg),
+        'prop' :        count_toggles(A_bits) + count_toggles(B_bits),
+        'acc' :         count_toggles(acc_bits),
+        'macs' :        np.sum(gate, axis=0),
+        'steps' :       N_steps,
+    }
+
+# Tiles of a trace: partial macs in memory [macs, muls, [A_Mats, B_Mats]] or streamed to disk (index)
+def iter_trace_tiles(partial_macs):
+
+    if isinstance(partial_macs, dict):
+        for _, macs, _, imats in fh.iter_macs_trace(partial_macs['trace_dir']):
+            yield macs, imats
+
+    else:
+        macs, _, imats = partial_macs
+        for n in range(len(macs)):
+            yield macs[n], [imats[0][n], imats[1][n]]
+
+# Per-layer activity: toggle heatmaps over the PE array [X, Y], computed MACs and steps of
+# every PE, zero-gated MACs of the used PEs, and activity factors (toggles / (register bits
+# x steps) over the whole array). traces is a list of partial macs (one per image of a batch)
+def get_toggle_activity(traces, CONV, HYPER):
+
+    X, Y = HYPER['X'], HYPER['Y']
+    ACT = {'heatmap_'+reg : np.zeros((X, Y), dtype=np.int64) for reg in TOGGLE_REGS}
+    ACT['heatmap_macs'] = np.zeros((X, Y), dtype=np.int64)
+    ACT['heatmap_steps'] = np.zeros((X, Y), dtype=np.int64)
+    steps = 0
+
+    for partial_macs in traces:
+        for macs, imats in iter_trace_tiles(partial_macs):
+            TOGGLES = get_tile_toggles(macs, imats, CONV, HYPER)
+            X_used, Y_used = np.shape(TOGGLES['macs'])
+
+            for reg in TOGGLE_REGS + ['macs']:
+                ACT['heatmap_'+reg][:X_used, :Y_used] += TOGGLES[reg]
+            ACT['heatmap_steps'][:X_used, :Y_used] += TOGGLES['steps']
+            steps += TOGGLES['steps']
+
+    reg_bits = {'A': HYPER['IA_W'], 'B': HYPER['IB_W'], 'prop': HYPER['IA_W'] + HYPER['IB_W'], 'acc': HYPER['OC_W']}
+
+    ACT['heatmap'] = np.sum([ACT['heatmap_'+reg] for reg in TOGGLE_REGS], axis=0)
+    ACT['steps'] = steps
+    ACT['macs_computed'] = int(np.sum(ACT['heatmap_macs']))
+    ACT['macs_gated'] = int(np.sum(ACT['heatmap_steps'])) - ACT['macs_computed']
+    ACT['toggles'] = int(np.sum(ACT['heatmap']))
+
+    for reg in TOGGLE_REGS:
+        ACT['activity_'+reg] = np.sum(ACT['heatmap_'+reg])/max(reg_bits[reg]*X*Y*steps, 1)
+    ACT['activity_factor'] = ACT['toggles']/max(np.sum(list(reg_bits.values()))*X*Y*steps, 1)
+
+    return ACT
+
+# --------------------------------------------
+# PE utilization report (from the mapping)
+# --------------------------------------------
+
+# Where the peak throughput of the array is lost, per PE [X, Y], without simulating the RTL.
+# Every step of a context is a MAC slot of all X*Y PEs, and each slot is either:
+#   - spatial underuse: the PE is outside the X_used x Y_used block of the main tiles
+#   - edge underuse: the PE is used by the main tiles, but not by the edge tiles of a
+#     ragged layer (their job uses a smaller block, see fit_array_use)
+#   - zero-gated: mapped to an output, but the MAC is skipped by the zero detectors
+#     (exact zeros and negligence). Needs the tensors, otherwise it is counted as computed
+#   - computed MAC
+# Output k of a job goes to column (k - k0) % X_used of the job, output column w to row
+# (w - w0) % Y_used, so the MACs of each PE are the sum over its outputs. Compute steps
+# only: fill/drain and memory stalls are not included (see total_utilization of the RTL)
+def get_utilization_report(CONV, HYPER, A_tensor=None, B_tensor=None):
+
+    X, Y = HYPER['X'], HYPER['Y']
+    X_used, Y_used = CONV['X_used'], CONV['Y_used']
+    FP = (HYPER['OP_TYPE']==1)
+    thres = CONV.get('thres', 0)
+    s, d = CONV['s'], CONV['d']
+
+    # Batch: sum of the images
+    if A_tensor is None:
+        images = [None]
+    else:
+        images = A_tensor if (np.ndim(A_tensor) == 4) else [A_tensor]
+
+    REPORT = {'heatmap_'+loss : np.zeros((X, Y), dtype=np.int64) for loss in ['mapped', 'macs', 'gated', 'spatial', 'edge']}
+    steps = 0
+
+    if B_tensor is not None:
+        B_nz = (np.asarray(B_tensor) != 0).astype(np.float64)
+        B_neg = (get_negligible_mask(B_tensor, thres, FP) & (B_nz > 0)).astype(np.float64)
+
+    for A_image in images:
+
+        if A_image is not None:
+            A_nz = (np.asarray(A_image) != 0).astype(np.float64)
+            A_neg = (get_negligible_mask(A_image, thres, FP) & (A_nz > 0)).astype(np.float64)
+
+        for job in get_conv_jobs(CONV):
+            CJ = job['CONV']
+            c0, k0, h0, w0 = job['origin']
+            X_job, Y_job = CJ['X_used'], CJ['Y_used']
+
+            job_steps = CJ['N_total_tiles']*CJ['N_cswitch']*CJ['B_w']*CJ['B_h']*CJ['c_til']
+            steps += job_steps
+
+            REPORT['heatmap_mapped'][:X_job, :Y_job] += job_steps
+            REPORT['heatmap_edge'][:X_used, :Y_used] += job_steps
+            REPORT['heatmap_edge'][:X_job, :Y_job] -= job_steps
+            REPORT['heatmap_spatial'] += job_steps
+            REPORT['heatmap_spatial'][:X_used, :Y_used] -= job_steps
+
+            if A_image is None:
+                continue
+
+            # Computed MACs of every output of the job (its input channels only)
+            A_rows = slice(h0*s, (h0 + CJ['C_h'] - 1)*s + CJ['B_h_eff'])
+            A_cols = slice(w0*s, (w0 + CJ['C_w'] - 1)*s + CJ['B_w_eff'])
+            A_chan = slice(c0, c0 + CJ['AB_c'])
+            B_outs = slice(k0, k0 + CJ['C_c'])
+
+            macs = conv2d_numpy(A_nz[A_chan, A_rows, A_cols], B_nz[B_outs, A_chan], s, d)
+            if thres > 0:
+                macs -= conv2d_numpy(A_neg[A_chan, A_rows, A_cols], B_neg[B_outs, A_chan], s, d)
+
+            # Outputs => PEs
+            x_idx = np.arange(CJ['C_c'])%X_job
+            y_idx = np.arange(CJ['C_w'])%Y_job
+            pe_macs = np.zeros((X, Y))
+            np.add.at(pe_macs, (x_idx[:,None], y_idx[None,:]), np.sum(macs, axis=1))
+            REPORT['heatmap_macs'] += np.rint(pe_macs).astype(np.int64)
+
+    if A_tensor is None:
+        REPORT['heatmap_macs'] = REPORT['heatmap_mapped'].copy()
+    REPORT['heatmap_gated'] = REPORT['heatmap_mapped'] - REPORT['heatmap_macs']
+
+    peak = max(X*Y*steps, 1)
+
+    REPORT['steps'] = steps
+    REPORT['peak_macs'] = X*Y*steps
+    REPORT['heatmap'] = REPORT['heatmap_macs']/max(steps, 1)
+    REPORT['util_X'] = np.sum(REPORT['heatmap_macs'], axis=1)/max(Y*steps, 1)
+    REPORT['util_Y'] = np.sum(REPORT['heatmap_macs'], axis=0)/max(X*steps, 1)
+    REPORT['util_mapped'] = np.sum(REPORT['heatmap_mapped'])/peak
+    REPORT['util_effective'] = np.sum(REPORT['heatmap_macs'])/peak
+    for loss in ['spatial', 'edge', 'gated']:
+        REPORT['loss_'+loss] = np.sum(REPORT['heatmap_'+loss])/peak
+
+    return REPORT
+
+# --------------------------------------------
+# Content-addressed cache of golden results
+# --------------------------------------------
+
+# Golden results are keyed by a hash of the tensors, the mapping geometry and the
+# arithmetic options. The in-memory tier is an LRU of at most mem_max_MB; the optional
+# on-disk tier (one pickle per key in disk_dir) evicts the least recently used files
+# beyond disk_max_MB. The SA_dict entries set by the golden model are stored with the
+# result, so a hit reports the same statistics as the original computation, except for the
+# cross-check: it was not run again, and is reported as 'cached'.
+GOLDEN_CACHE = {
+    'enabled' :     True,
+    'mem_max_MB' :  256,
+    'disk_dir' :    None,
+    'disk_max_MB' : 1024,
+    'entries' :     OrderedDict(),
+    'mem_bytes' :   0,
+    'hits_mem' :    0,
+    'hits_disk' :   0,
+    'misses' :      0,
+}
+
+def configure_golden_cache(enabled=True, mem_max_MB=256, disk_dir=None, disk_max_MB=1024, clear=False):
+
+    GOLDEN_CACHE['enabled'] = enabled
+    GOLDEN_CACHE['mem_max_MB'] = mem_max_MB
+    GOLDEN_CACHE['disk_dir'] = disk_dir
+    GOLDEN_CACHE['disk_max_MB'] = disk_max_MB
+
+    if disk_dir is not None:
+        os.makedirs(disk_dir, exist_ok=True)
+
+    if clear:
+        GOLDEN_CACHE['entries'].clear()
+        GOLDEN_CACHE['mem_bytes'] = 0
+        for key in ['hits_mem', 'hits_disk', 'misses']:
+            GOLDEN_CACHE[key] = 0
+
+    evict_golden_cache()
+
+def get_golden_cache_stats():
+    CACHE_STATS = {key : GOLDEN_CACHE[key] for key in ['hits_mem', 'hits_disk', 'misses', 'mem_bytes']}
+    CACHE_STATS['mem_entries'] = len(GOLDEN_CACHE['entries'])
+    return CACHE_STATS
+
+# Version of the golden model semantics. Bump it whenever a change makes the golden
+# results (or the stats stored with them) differ for the same inputs: results cached on
+# disk by older versions are then never hit
+GOLDEN_MODEL_VERSION = 1
+
+# Hash of the golden model inputs: tensors (values, shape and type), mapping and
+# arithmetic options (the SA_dict entries set by get_ideal_results) and golden options
+GOLDEN_KEY_PARAMS = ['AB_c', 'B_w', 'B_h', 'B_k', 'd', 's', 'X_used', 'Y_used', 'C_w', 'C_h', 'C_c', 'A_w', 'A_h',
+                     'MANT_bits', 'approx_comp', 'mul_type', 'M', 'add_type', 'A', 'rounding', 'thres']
+
+def get_golden_key(A_tensor, B_tensor, C_tensor, SA_dict, HYPER, golden_options):
+
+    h = hashlib.blake2b(digest_size=20)
+    h.update(repr(GOLDEN_MODEL_VERSION).encode())
+
+    for tensor in [A_tensor, B_tensor, C_tensor]:
+        tensor = np.ascontiguousarray(tensor)
+        h.update(repr((tensor.shape, tensor.dtype.str)).encode())
+        h.update(memoryview(tensor).cast('B'))
+
+    params = [SA_dict[key] for key in GOLDEN_KEY_PARAMS] + [HYPER['OP_TYPE'], HYPER['IC_MANT'], np.dtype(HYPER['intyp']).str]
+    h.update(repr((params, golden_options)).encode())
+
+    return h.hexdigest()
+
+def golden_cache_file(key):
+    return os.path.join(GOLDEN_CACHE['disk_dir'], key + '.pkl')
+
+# Drop least recently used entries until both tiers fit their size cap
+def evict_golden_cache():
+
+    entries = GOLDEN_CACHE['entries']
+    while (GOLDEN_CACHE['mem_bytes'] > GOLDEN_CACHE['mem_max_MB']*2**20) and (len(entries) > 0):
+        _, (C_output, _) = entries.popitem(last=False)
+        GOLDEN_CACHE['mem_bytes'] -= C_output.nbytes
+
+    if GOLDEN_CACHE['disk_dir'] is None:
+        return
+
+    files = [os.path.join(GOLDEN_CACHE['disk_dir'], f) for f in os.listdir(GOLDEN_CACHE['disk_dir']) if f.endswith('.pkl')]
+    files = sorted([(os.path.getmtime(f), os.path.getsize(f), f) for f in files])
+    disk_bytes = sum(size for _, size, _ in files)
+
+    for _, size, f in files:
+        if disk_bytes <= GOLDEN_CACHE['disk_max_MB']*2**20:
+            break
+        os.remove(f)
+        disk_bytes -= size
+
+# Returns (C_output, SA_dict entries) and the tier of the hit ('mem' or 'disk'), or None
+def golden_cache_get(key):
+
+    entries = GOLDEN_CACHE['entries']
+
+    if key in entries:
+        entries.move_to_end(key)
+        GOLDEN_CACHE['hits_mem'] += 1
+        return entries[key], 'mem'
+
+    if (GOLDEN_CACHE['disk_dir'] is not None) and os.path.exists(golden_cache_file(key)):
+        with open(golden_cache_file(key), 'rb') as f:
+            value = pickle.load(f)
+
+        # Recently used files are evicted last
+        os.utime(golden_cache_file(key))
+        GOLDEN_CACHE['hits_disk'] += 1
+
+        golden_cache_put(key, value, to_disk=False)
+        return value, 'disk'
+
+    GOLDEN_CACHE['misses'] += 1
+    return None, 'miss'
+
+def golden_cache_put(key, value, to_disk=True):
+
+    GOLDEN_CACHE['entries'][key] = value
+    GOLDEN_CACHE['mem_bytes'] += value[0].nbytes
+
+    # Written atomically, other processes may read the same directory
+    if to_disk and (GOLDEN_CACHE['disk_dir'] is not None):
+        tmp_file = golden_cache_file(key) + '.{}.tmp'.format(os.getpid())
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(value, f)
+        os.replace(tmp_file, golden_cache_file(key))
+
+    evict_golden_cache()
+
 # --------------------------------------------
 # Top function to perform convolution / GeMM with the model
 # --------------------------------------------
 
-def get_ideal_results(A_tensor, B_tensor, C_tensor, CONV, HYPER, SA_dict, compute_macs=False):
+def get_ideal_results(A_tensor, B_tensor, C_tensor, CONV, HYPER, SA_dict, compute_macs=False, macs_workers=1, macs_trace_dir=None, loop_order_mode='heuristic', golden_mode='mvm', golden_backend='numpy', check_level='full', check_samples=1024, max_mem_MB=None, sparse_mode='auto', sparse_threshold=0.2, approx_mode='exact', approx_table_dir=None, use_cache=True):
+
+    # Golden mode: 'mvm' (FP32 MVM, cast to the output type) or 'hw' (FP: same FMA sequence as the PEs)
+    assert golden_mode in ['mvm', 'hw'], "Unrecognized golden_mode = '{}'".format(golden_mode)
+
+    # Approximate arithmetic: bit-accurate FP_Madd chains ('exact') or the statistical surrogate
+    assert approx_mode in ['exact', 'surrogate'], "Unrecognized approx_mode = '{}'".format(approx_mode)
 
     # Put convolution parameters into SA dictionary
     SA_dict['AB_c'] =       CONV['AB_c']
@@ -587,6 +2470,10 @@ def get_ideal_results(A_tensor, B_tensor, C_tensor, CONV, HYPER, SA_dict, comput
     SA_dict['s'] =          CONV['s']
     SA_dict['X_used'] =     CONV['X_used']
     SA_dict['Y_used'] =     CONV['Y_used']
+    if CONV.get('jobs') is not None:
+        # Ragged layers: the whole-layer mapping needs an array use that divides the layer
+        SA_dict['X_used'] = fit_array_use(CONV['C_c'], CONV['X_used'])
+        SA_dict['Y_used'] = fit_array_use(CONV['C_w'], CONV['Y_used'])
     SA_dict['C_w'] =        CONV['C_w']
     SA_dict['C_h'] =        CONV['C_h']
     SA_dict['C_c'] =        CONV['C_c']
@@ -600,6 +2487,7 @@ def get_ideal_results(A_tensor, B_tensor, C_tensor, CONV, HYPER, SA_dict, comput
     SA_dict['add_type'] =       HYPER['add_type']
     SA_dict['A'] =              HYPER['A']
     SA_dict['rounding'] =       HYPER['rounding']
+    SA_dict['thres'] =          CONV.get('thres', 0)
  
     # Tiling loops
     c_til_iter = int(CONV['AB_c']/ CONV['c_til'])
@@ -614,30 +2502,65 @@ def get_ideal_results(A_tensor, B_tensor, C_tensor, CONV, HYPER, SA_dict, comput
     C_tile_shape = [CONV['k_til'], CONV['h_til'], CONV['w_til']]
     
     # Decision on inner and outer loops (ACCELERATOR-LEVEL STATIONARITY)
-    _, map_iter_list, id_list, loop_order = get_tiling_loops(CONV)
+    # For ragged layers, the loop order of the main job (each job decides its own)
+    _, map_iter_list, id_list, loop_order = get_tiling_loops(get_conv_jobs(CONV)[0]['CONV'], mode=loop_order_mode, HYPER=HYPER, CONV_full=CONV)
 
     # ONLY FOR DEBUGGING - Replicate the exact compute order as the hardware (SLOW)
     if compute_macs:
 
         tensors = [A_tensor, B_tensor, C_tensor]
-        C_output, partial_macs = cycle_accurate_convolution(CONV, HYPER, tensors, th.get_sa_dict(HYPER), map_iter_list, id_list)
+        C_output, partial_macs = cycle_accurate_convolution(CONV, HYPER, tensors, copy.copy(SA_dict), map_iter_list, id_list, n_workers=macs_workers, trace_dir=macs_trace_dir, loop_order_mode=loop_order_mode, golden_mode=golden_mode)
 
-    # If not debugging, compute the convolution as a single systolic array job
     else:
         partial_macs = [0,0,0]
 
-        # Convolution => Do it with model mapping
-        torch_A_tensor = torch.from_numpy(A_tensor.astype(np.float32))
-        
-        B_conv = torch.nn.Conv2d(CONV['AB_c'], CONV['C_c'], (CONV['B_h'], CONV['B_w']), stride=CONV['s'], dilation=CONV['d'])
-        
-        B_conv.weight = torch.nn.Parameter(torch.tensor(B_tensor.astype(np.float32)))
-        B_conv.bias = torch.nn.Parameter(torch.zeros(B_conv.bias.shape))
-        
-        data_type = 'FP' if (HYPER['OP_TYPE']==1) else 'int'
-        
-        _, _, _, _, C_output, _, _, _ = map_conv_to_MVM(SA_dict, random_tensors=False, A_tensor=torch_A_tensor, B_conv=B_conv, preloads=C_tensor, data_type=data_type, silent=True)
-        
-        C_output = C_output.astype(HYPER['intyp'])
+        # Golden result of the same inputs and options computed before (memory or disk).
+        # The check options are part of the key: a hit was checked as requested when computed
+        golden_options = [golden_mode if (HYPER['OP_TYPE']==1) else 'mvm', sparse_mode, sparse_threshold, max_mem_MB, approx_mode if HYPER['approx_comp'] else 'exact',
+                          golden_backend, check_level, check_samples if (check_level == 'sampled') else None]
+        cache_key = get_golden_key(A_tensor, B_tensor, C_tensor, SA_dict, HYPER, golden_options) if (use_cache and GOLDEN_CACHE['enabled']) else None
+        cached, cache_status = golden_cache_get(cache_key) if (cache_key is not None) else (None, 'off')
+
+        if cached is not None:
+            C_output = cached[0].copy()
+            SA_dict.update(cached[1])
+            SA_dict['check_level'] = 'cached'
+            SA_dict['check_points'] = 'cached'
+
+        # Approximate arithmetic: exact convolution + MAC errors drawn from the characterization
+        elif HYPER['approx_comp'] and (approx_mode == 'surrogate'):
+            TABLE = get_approx_table(HYPER, table_dir=approx_table_dir)
+            C_output = conv2d_approx_surrogate(A_tensor, B_tensor, C_tensor, TABLE, s=CONV['s'], d=CONV['d'], backend=golden_backend)
+            C_output = remove_neglected_products(C_output.astype(HYPER['intyp']), A_tensor, B_tensor, CONV, HYPER)
+
+            SA_dict['check_level'] = 'none'
+            SA_dict['check_points'] = 0
+
+        # Hardware-faithful FP golden: sequential FMAs, vectorized over all output positions
+        # (integer results are exact in any order, they use the MVM)
+        elif (golden_mode == 'hw') and (HYPER['OP_TYPE']==1):
+            C_output = get_fp_hw_golden(A_tensor, B_tensor, C_tensor, CONV, HYPER, SA_dict, golden_backend=golden_backend, check_level=check_level, check_samples=check_samples)
+
+        # Otherwise, compute the convolution as a single systolic array job
+        else:
+            # Convolution => Do it with model mapping
+            data_type = 'FP' if (HYPER['OP_TYPE']==1) else 'int'
+            
+            N_inputs, _, X_underuse, Y_underuse, C_output, _, _, _ = map_conv_to_MVM(SA_dict, random_tensors=False, A_tensor=A_tensor, B_conv=B_tensor, preloads=C_tensor, data_type=data_type, golden_backend=golden_backend, check_level=check_level, check_samples=check_samples, max_mem_MB=max_mem_MB, sparse_mode=sparse_mode, sparse_threshold=sparse_threshold, silent=True)
+            
+            C_output = C_output.astype(HYPER['intyp'])
+
+            # Input vectors that do not fill the used columns / rows (see get_utilization_report)
+            SA_dict['mvm_X_underuse'] = float(np.sum(X_underuse)/N_inputs)
+            SA_dict['mvm_Y_underuse'] = float(np.sum(Y_underuse)/N_inputs)
+
+            # Negligence: the bit-accurate approximate MVM skips the MACs like the PEs, the others compute them all
+            if not HYPER['approx_comp']:
+                C_output = remove_neglected_products(C_output, A_tensor, B_tensor, CONV, HYPER)
+
+        if (cached is None) and (cache_key is not None):
+            golden_cache_put(cache_key, (C_output.copy(), copy.copy(SA_dict)))
+
+        SA_dict['golden_cache'] = cache_status
                     
     return C_output, partial_macs, loop_order
\ No newline at end of file
@@ -22,6 +22,7 @@ Jordi Fornt <jfornt@bsc.es>
 import numpy as np
 import sys
 import os
+import json
 
 sys.path.insert(1, './../')
 import src.data_helper as dh
@@ -33,7 +34,13 @@ import src.config_helper as cfg
 
 def generate_test_files(DRAM_mem, DRAM_mem_gold, controller_regs, testcfg_list, HOPTS, N_REGS, test_dir="../../test"):
     
+    # One list of controller registers per job (several jobs if the layer has edge tiles)
+    if np.ndim(controller_regs[0]) == 0:
+        controller_regs = [controller_regs]
+
     N_VECTORS = N_REGS + 100 # Variable sized register region + an offset for high level configuration (100 should be more than enough)
+    if len(controller_regs) > 1:
+        N_VECTORS = len(controller_regs)*(N_REGS + 50) + 100 # Each job also writes its registers, starts and waits
             
     # Fill config arrays
     # ----------------------------------
@@ -112,4 +119,61 @@ def parse_test_outputs(HOPTS, tensor_size, test_dir="../../test"):
 
     n_test_errors = stats_outputs[3]
 
-    return out_values, stats_dict, n_test_errors
\ No newline at end of file
+    return out_values, stats_dict, n_test_errors
+
+# ---------------------------------------
+# PARTIAL MAC TRACES
+# ---------------------------------------
+
+# Cycle-accurate traces are stored as one npz shard per tile, plus an index
+# (in the tile order of the hardware) that maps tile coordinates to shards.
+# Tiles can be iterated or accessed randomly without loading the whole trace.
+
+def write_macs_trace_tile(trace_dir, c, k, w, h, macs, muls, imats):
+
+    if not(os.path.exists(trace_dir)):
+        os.makedirs(trace_dir, exist_ok=True)
+
+    file_name = "tile_c{}_k{}_w{}_h{}.npz".format(c, k, w, h)
+    np.savez(os.path.join(trace_dir, file_name), macs=macs, muls=muls, A_Mats=imats[0], B_Mats=imats[1])
+
+    return file_name
+
+def write_macs_trace_index(trace_dir, tile_order, file_names):
+
+    index = {
+        'tiles' : [{'order': n, 'c': int(c), 'k': int(k), 'w': int(w), 'h': int(h), 'file': f} for n, ((c,k,w,h), f) in enumerate(zip(tile_order, file_names))]
+    }
+
+    with open(os.path.join(trace_dir, "index.json"), "w") as f:
+        json.dump(index, f, indent=1)
+
+    index['trace_dir'] = trace_dir
+
+    return index
+
+def load_macs_trace_index(trace_dir):
+
+    with open(os.path.join(trace_dir, "index.json"), "r") as f:
+        index = json.load(f)
+
+    index['trace_dir'] = trace_dir
+
+    return index
+
+def read_macs_trace_tile(trace_dir, c, k, w, h):
+
+    file_name = "tile_c{}_k{}_w{}_h{}.npz".format(c, k, w, h)
+    assert os.path.exists(os.path.join(trace_dir, file_name)), "Tile (c={},k={},w={},h={}) is not in the trace".format(c, k, w, h)
+
+    with np.load(os.path.join(trace_dir, file_name)) as shard:
+        return shard['macs'], shard['muls'], [shard['A_Mats'], shard['B_Mats']]
+
+def iter_macs_trace(trace_dir):
+
+    index = load_macs_trace_index(trace_dir)
+
+    # Yields one tile at a time, in the tile order of the hardware
+    for tile in index['tiles']:
+        macs, muls, imats = read_macs_trace_tile(trace_dir, tile['c'], tile['k'], tile['w'], tile['h'])
+        yield (tile['c'], tile['k'], tile['w'], tile['h']), macs, muls, imats
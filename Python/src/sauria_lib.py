@@ -64,7 +64,7 @@ def get_sa_dict(HOPTS):
 # GET CURRENT CONVOLUTION DICT
 # ------------------------------
 
-def get_conv_dict(tensor_shapes, TILING_DICT, HOPTS, preloads=0, d=1, s=1, p=0):
+def get_conv_dict(tensor_shapes, TILING_DICT, HOPTS, preloads=0, d=1, s=1, p=0, thres=0):
     
     B_w =           tensor_shapes[1][3]
     B_h =           tensor_shapes[1][2]
@@ -86,17 +86,30 @@ def get_conv_dict(tensor_shapes, TILING_DICT, HOPTS, preloads=0, d=1, s=1, p=0):
     # Essential assertions
     # --------------------------------------------------------------------------
 
-    assert w_til%Y_used == 0, "ERROR - Tiling size in the W dimension must be a multiple of Y_used !"
-    assert k_til%X_used == 0, "ERROR - Tiling size in the C_out dimension must be a multiple of X_used !"
+    assert (w_til <= C_w) and (h_til <= C_h) and (k_til <= C_c) and (c_til <= c), "ERROR - Tiling sizes cannot be larger than the tensors !"
+    assert (Y_used <= HOPTS['Y']) and (X_used <= HOPTS['X']), "ERROR - X_used and Y_used cannot be larger than the array !"
+    assert (Y_used <= w_til) and (X_used <= k_til), "ERROR - X_used and Y_used cannot be larger than the tiles !"
 
-    assert C_w%w_til == 0, "ERROR - Full tensor size Cw must be a multiple of the tiling size in the W dimension !"
-    assert C_c%k_til == 0, "ERROR - Full tensor size C_out must be a multiple of the tiling size in the C_out dimension !"
+    # The array use must divide the tiles: tiles that it does not divide are cut to a multiple of
+    # it, so that the main tiles keep the requested X_used/Y_used (the rest are edge tiles)
+    w_til = w_til - w_til%Y_used
+    k_til = k_til - k_til%X_used
 
     # Derived constants
     # --------------------------------------------------------------------------
     
     AB_c = c
 
+    # Ragged layers: the tiles do not divide the tensors. They are executed as several jobs
+    # (one per edge class), each of them with uniform tiles.
+    ragged = (C_w%w_til != 0) or (C_h%h_til != 0) or (C_c%k_til != 0) or (AB_c%c_til != 0)
+
+    if ragged:
+        job_tiling = dict(TILING_DICT, C_tile_shape=[k_til, h_til, w_til])
+        jobs = get_edge_jobs(tensor_shapes, job_tiling, HOPTS, preloads=preloads, d=d, s=s, thres=thres)
+    else:
+        jobs = None
+
     # Internal tiles for SAURIA execution
     X_int_tiles = int(w_til//Y_used)
     Y_int_tiles = int(h_til)
@@ -125,11 +138,11 @@ def get_conv_dict(tensor_shapes, TILING_DICT, HOPTS, preloads=0, d=1, s=1, p=0):
     A_w_til = C_w_eff_til + B_w_eff - 1
     A_h_til = C_h_eff_til + B_h_eff - 1
        
-    # External tiles
-    X_ext_tiles = int(C_w//w_til)
-    Y_ext_tiles = int(C_h//h_til)
-    C_ext_tiles = int(A_c//c_til)
-    K_ext_tiles = int(C_c//k_til)
+    # External tiles (the last ones can be edge tiles)
+    X_ext_tiles = int(np.ceil(C_w/w_til))
+    Y_ext_tiles = int(np.ceil(C_h/h_til))
+    C_ext_tiles = int(np.ceil(A_c/c_til))
+    K_ext_tiles = int(np.ceil(C_c/k_til))
     N_total_tiles = X_ext_tiles*Y_ext_tiles*C_ext_tiles*K_ext_tiles
 
     # Memory size check
@@ -146,8 +159,8 @@ def get_conv_dict(tensor_shapes, TILING_DICT, HOPTS, preloads=0, d=1, s=1, p=0):
     # Derived config parameters
     # ---------------------------------------------------------------------------------------
     
-    # Threshold fix to zero (for now...)
-    thres = 0
+    # Negligence threshold of the zero detectors (0 = exact zeros only)
+    assert 0 <= thres < (1 << HOPTS['TH_W']), "Negligence threshold must fit in {} bits".format(HOPTS['TH_W'])
         
     # Dilation pattern generation
     Dil_str = '0b'
@@ -228,31 +241,284 @@ def get_conv_dict(tensor_shapes, TILING_DICT, HOPTS, preloads=0, d=1, s=1, p=0):
         "rows_active" : rows_active,
         "cols_active" : cols_active,
         "lwoffs" : lwoffs,
-        "thres" : thres
+        "thres" : thres,
+
+        "jobs" : jobs
         }
     
     return CONV
 
+# ------------------------------
+# EDGE TILES: SPLIT A RAGGED LAYER INTO UNIFORM JOBS
+# ------------------------------
+
+def get_edge_jobs(tensor_shapes, TILING_DICT, HOPTS, preloads=0, d=1, s=1, thres=0):
+
+    c =     tensor_shapes[1][1]
+    C_c =   tensor_shapes[2][0]
+    C_h =   tensor_shapes[2][1]
+    C_w =   tensor_shapes[2][2]
+
+    c_til = TILING_DICT['tile_cin']
+    k_til = TILING_DICT['C_tile_shape'][0]
+    h_til = TILING_DICT['C_tile_shape'][1]
+    w_til = TILING_DICT['C_tile_shape'][2]
+
+    # Regions of each dimension: main tiles + one edge tile
+    # [start element, extent, tile size, index of the first tile]
+    regions = []
+    for size, til in [[c, c_til], [C_c, k_til], [C_h, h_til], [C_w, w_til]]:
+        n_main = size//til
+        dim_regions = []
+        if n_main > 0:
+            dim_regions.append([0, n_main*til, til, 0])
+        if size%til != 0:
+            dim_regions.append([n_main*til, size%til, size%til, n_main])
+        regions.append(dim_regions)
+
+    # Jobs over c are ordered (the edge c tiles accumulate on the main results)
+    jobs = []
+    for rc in regions[0]:
+        for rk in regions[1]:
+            for rh in regions[2]:
+                for rw in regions[3]:
+
+                    job_shapes = [
+                        [rc[1], 0, 0],
+                        [rk[1], rc[1], tensor_shapes[1][2], tensor_shapes[1][3]],
+                        [rk[1], rh[1], rw[1]]
+                    ]
+
+                    job_tiling = {
+                        'C_tile_shape' :    [rk[2], rh[2], rw[2]],
+                        'tile_cin' :        rc[2],
+                        'X_used' :          ex.fit_array_use(rk[2], TILING_DICT['X_used']),
+                        'Y_used' :          ex.fit_array_use(rw[2], TILING_DICT['Y_used'])
+                    }
+
+                    # Edge c tiles always preload the partial sums of the previous jobs
+                    job_preload = preloads if (rc[0] == 0) else 1
+
+                    jobs.append({
+                        'CONV' :        get_conv_dict(job_shapes, job_tiling, HOPTS, preloads=job_preload, d=d, s=s, thres=thres),
+                        'origin' :      [rc[0], rk[0], rh[0], rw[0]],
+                        'tile_origin' : [rc[3], rk[3], rh[3], rw[3]]
+                    })
+
+    return jobs
+
+# ---------------------------------------------
+# Automatic tiling: search legal tile sizes
+# ---------------------------------------------
+
+def get_divisors(n):
+    return np.array([i for i in range(1, n+1) if n%i == 0], dtype=np.int64)
+
+def optimize_tiling(tensor_shapes, d, s, HOPTS, top_n=5, cycle_coefs=None):
+
+    B_w =   tensor_shapes[1][3]
+    B_h =   tensor_shapes[1][2]
+    AB_c =  tensor_shapes[1][1]
+    C_c =   tensor_shapes[2][0]
+    C_h =   tensor_shapes[2][1]
+    C_w =   tensor_shapes[2][2]
+    A_h =   tensor_shapes[0][1]
+    A_w =   tensor_shapes[0][2]
+
+    X = HOPTS['X']
+    Y = HOPTS['Y']
+
+    if cycle_coefs is None:
+        cycle_coefs = ex.CYCLE_MODEL_COEFS
+
+    # Candidates (same legality rules as get_conv_dict)
+    # --------------------------------------------------------------------------
+
+    # X_used must divide k_til and Y_used must divide w_til. The k and w tiles can also be
+    # multiples of the whole array that do not divide the tensor: the rest of the layer is then
+    # run as edge jobs (see get_edge_jobs). Input channels and rows stay on divisor tiles
+    kX = [[k, x] for k in get_divisors(C_c) for x in range(1, min(X, k)+1) if k%x == 0]
+    kX += [[m*X, X] for m in range(1, C_c//X + 1) if C_c%(m*X) != 0]
+    wY = [[w, y] for w in get_divisors(C_w) for y in range(1, min(Y, w)+1) if w%y == 0]
+    wY += [[m*Y, Y] for m in range(1, C_w//Y + 1) if C_w%(m*Y) != 0]
+    kX = np.array(kX, dtype=np.int64)
+    wY = np.array(wY, dtype=np.int64)
+    c_divs = get_divisors(AB_c)
+    h_divs = get_divisors(C_h)
+
+    i_kX, i_wY, i_c, i_h = np.meshgrid(np.arange(len(kX)), np.arange(len(wY)), np.arange(len(c_divs)), np.arange(len(h_divs)), indexing='ij')
+
+    k_til, X_used = kX[i_kX.ravel()].T
+    w_til, Y_used = wY[i_wY.ravel()].T
+    c_til = c_divs[i_c.ravel()]
+    h_til = h_divs[i_h.ravel()]
+
+    # Derived constants
+    B_w_eff = 1 + (B_w - 1)*d
+    B_h_eff = 1 + (B_h - 1)*d
+
+    A_h_til = (1 + (h_til - 1)*s) + B_h_eff - 1
+
+    # Jobs of every candidate: main tiles, and the edge tiles of k and w (as in get_edge_jobs,
+    # with the array use that fits them). Missing edges keep the main tiles and are masked out
+    k_edge = C_c%k_til
+    w_edge = C_w%w_til
+
+    def fit_array_use(til, used):
+        u = np.arange(1, max(X, Y)+1)[:, None]
+        return np.max(np.where((u <= used) & (til%u == 0), u, 1), axis=0)
+
+    k_regions = [[C_c - k_edge, k_til, X_used, np.ones_like(k_til, dtype=bool)],
+                 [np.where(k_edge > 0, k_edge, C_c), np.where(k_edge > 0, k_edge, k_til), fit_array_use(k_edge, X_used), k_edge > 0]]
+    w_regions = [[C_w - w_edge, w_til, Y_used, np.ones_like(w_til, dtype=bool)],
+                 [np.where(w_edge > 0, w_edge, C_w), np.where(w_edge > 0, w_edge, w_til), fit_array_use(w_edge, Y_used), w_edge > 0]]
+
+    JOBS = []
+    for job_C_c, job_k_til, job_X_used, k_valid in k_regions:
+        for job_C_w, job_w_til, job_Y_used, w_valid in w_regions:
+            JOBS.append({'C_c': job_C_c, 'k_til': job_k_til, 'X_used': job_X_used,
+                         'C_w': job_C_w, 'w_til': job_w_til, 'Y_used': job_Y_used,
+                         'A_w_til': (1 + (job_w_til - 1)*s) + B_w_eff - 1, 'valid': k_valid & w_valid})
+
+    legal = np.ones_like(k_til, dtype=bool)
+    for job in JOBS:
+
+        A_w_til = job['A_w_til']
+        N_cswitch = (job['w_til']//job['Y_used'])*h_til*(job['k_til']//job['X_used'])
+
+        # Memory sizes
+        job_legal = (A_w_til*A_h_til*c_til <= HOPTS['MEMA_size'])
+        job_legal &= (B_w*B_h*c_til*job['k_til'] <= HOPTS['MEMB_size'])
+        job_legal &= (job['w_til']*h_til*job['k_til'] <= HOPTS['MEMC_size'])
+
+        # Register field widths of the largest values in the SAURIA config (see get_sauria_regs)
+        act_max = np.max([B_w*B_h*c_til - 1, A_w_til*B_h_eff, A_w_til*A_h_til*c_til, job['w_til']*s, h_til*A_w_til*s,
+                          (1 + (job['Y_used']-1)*s) + B_w_eff + 1 - (B_w_eff%2) + HOPTS['MEMA_N']], axis=0)
+        wei_max = job['k_til']*B_w*B_h*c_til
+        out_max = np.max([N_cswitch, job['w_til']*h_til*job['k_til'], job['Y_used'] + HOPTS['MEMC_N']], axis=0)
+
+        job_legal &= (act_max < 2**HOPTS['IFM_IDX_W'])
+        job_legal &= (wei_max < 2**HOPTS['WEI_IDX_W'])
+        job_legal &= (out_max < 2**HOPTS['PSM_IDX_W'])
+
+        # Tile loop limits of the controller are 16-bit
+        job_legal &= np.max([job['C_w']//job['w_til'], C_h//h_til, AB_c//c_til, job['C_c']//job['k_til']], axis=0) <= 2**16
+
+        legal &= job_legal | ~job['valid']
+
+    assert np.any(legal), "No legal tiling was found for this convolution and hardware"
+
+    k_til, X_used, w_til, Y_used, c_til, h_til, A_h_til = [x[legal] for x in [k_til, X_used, w_til, Y_used, c_til, h_til, A_h_til]]
+    JOBS = [{key : x[legal] for key, x in job.items()} for job in JOBS]
+
+    # Scores: DRAM traffic of the best loop order + predicted cycles, summed over the jobs
+    # --------------------------------------------------------------------------
+
+    CONV_full = {'A_w': A_w, 'A_h': A_h, 'C_w': C_w, 'C_h': C_h}
+
+    dram_bytes = 0
+    predicted_cycles = 0
+    compute_cycles = 0
+
+    for j, job in enumerate(JOBS):
+
+        CONV = {'A_w': A_w, 'A_h': A_h, 'C_w': job['C_w'], 'C_h': C_h, 'C_c': job['C_c'], 'AB_c': AB_c, 'B_w': B_w, 'B_h': B_h, 'd': d, 's': s,
+                'w_til': job['w_til'], 'h_til': h_til, 'c_til': c_til, 'k_til': job['k_til'], 'A_w_til': job['A_w_til'], 'A_h_til': A_h_til,
+                'X_used': job['X_used'], 'Y_used': job['Y_used']}
+
+        order_bytes = np.array([ex.get_loop_order_traffic(CONV, HOPTS, loop_order, CONV_full=CONV_full)['total_bytes'] for loop_order in ex.LOOP_ORDER_NESTS])
+        job_loop_order = np.argmin(order_bytes, axis=0)
+
+        # Analytical cycle model with the loop order of least traffic
+        predictions = [ex.predict_cycles(CONV, HOPTS, loop_order, coefs=cycle_coefs, CONV_full=CONV_full) for loop_order in ex.LOOP_ORDER_NESTS]
+        order_cycles = np.array([p['total_cycles'] for p in predictions])
+
+        dram_bytes = dram_bytes + np.where(job['valid'], np.min(order_bytes, axis=0), 0)
+        predicted_cycles = predicted_cycles + np.where(job['valid'], np.take_along_axis(order_cycles, job_loop_order[None], axis=0)[0], 0)
+        compute_cycles = compute_cycles + np.where(job['valid'], predictions[0]['compute_cycles'], 0)
+
+        # The main job gives the loop order of the tiling
+        if j == 0:
+            loop_order = job_loop_order
+
+    # The fixed cost of the layer is paid once (as in ex.predict_conv_cycles)
+    N_jobs = np.sum([job['valid'] for job in JOBS], axis=0)
+    predicted_cycles = predicted_cycles - (N_jobs - 1)*cycle_coefs['total'].get('const', 0)
+
+    # Top-N: fewest predicted cycles, then least DRAM traffic
+    best = np.lexsort((dram_bytes, predicted_cycles))[:top_n]
+
+    TILINGS = []
+    for i in best:
+        TILINGS.append({
+            'C_tile_shape' :        [int(k_til[i]), int(h_til[i]), int(w_til[i])],
+            'tile_cin' :            int(c_til[i]),
+            'X_used' :              int(X_used[i]),
+            'Y_used' :              int(Y_used[i]),
+            'loop_order' :          int(loop_order[i]),
+            'jobs' :                int(N_jobs[i]),
+            'dram_bytes' :          int(dram_bytes[i]),
+            'compute_cycles' :      int(compute_cycles[i]),
+            'predicted_cycles' :    float(predicted_cycles[i]),
+        })
+
+    return TILINGS
+
 # ---------------------------------------------
 # Full SAURIA Operation, including RTL simulation
 # ---------------------------------------------
 
-def Conv2d_SAURIA(A_tensor, B_tensor, C_preload, C_golden, CONV_DICT, HOPTS, generate_vcd=False, assert_no_errors = False, print_statistics=True, test_dir="../../test", silent=True):
+def Conv2d_SAURIA(A_tensor, B_tensor, C_preload, C_golden, CONV_DICT, HOPTS, loop_order_mode='heuristic', cycle_coefs=None, generate_vcd=False, assert_no_errors = False, print_statistics=True, test_dir="../../test", silent=True):
+
+    # Batch of images: A and C tensors are [N, C, H, W]. Weights are shared by all
+    # images, or one set per image if B is [N, C_out, C_in, B_h, B_w] (grouped convolutions)
+    N_images = np.shape(A_tensor)[0] if (np.ndim(A_tensor) == 4) else 1
+    B_images = list(B_tensor) if (np.ndim(B_tensor) == 5) else [B_tensor]
 
-    # Optimize weight tensor shape for maximum memory transfer efficiency
-    B_tensor_opt = dh.optimize_weight_tensor_shape(B_tensor, CONV_DICT)
+    # Optimize weight tensor shape for maximum memory transfer efficiency (tile blocks at the offsets of the tile iterator)
+    B_tensor_opt = np.concatenate([ex.pack_weight_tiles(B_image, CONV_DICT) for B_image in B_images])
 
-    # Write values into simulated main memory
+    # Write values into simulated main memory (with a batch, the A and C regions hold
+    # the images back to back, and the weights are staged once between them)
     DRAM_mem, DRAM_mem_gold, offsets = dh.assign_dram_values(A_tensor, B_tensor_opt, C_preload, C_golden, 0, CONV_DICT, HOPTS)
 
-    # Generate SAURIA config registers    
-    sauria_regs, N_REGS = cfg.get_sauria_regs(CONV_DICT, HOPTS, silent=True)
+    # Configuration of each job (a single one, unless the layer has edge tiles)
+    elem_bytes = [HOPTS['IA_W']//8, HOPTS['IB_W']//8, HOPTS['OC_W']//8]
+    image_bytes = [np.size(A_tensor)//N_images*elem_bytes[0], 0, np.size(C_golden)//N_images*elem_bytes[2]]
+    if len(B_images) > 1:
+        assert len(B_images) == N_images, "One weight tensor per image is needed"
+        image_bytes[1] = np.size(B_tensor_opt)//N_images*elem_bytes[1]
+    controller_args = []
+    loop_orders = []
+    traffic = {}
+
+    # First tile of each job, in the loop order of the hardware (heuristic, or search over the DRAM traffic of all orders)
+    job_tiles = [TILE for TILE in ex.iterate_tiles(CONV_DICT, loop_order_mode=loop_order_mode, HYPER=HOPTS) if 'CONV_job' in TILE]
+
+    for TILE in job_tiles:
+
+        CONV_job = TILE['CONV_job']
+        loop_order = TILE['loop_order']
+        loop_orders.append(loop_order)
 
-    # Heuristically evaluate the loop order
-    _,_,_,loop_order = ex.get_tiling_loops(CONV_DICT)
+        # Generate SAURIA config registers    
+        sauria_regs, N_REGS = cfg.get_sauria_regs(CONV_job, HOPTS, silent=True)
+
+        # DRAM addresses of the first tile of the job
+        job_offsets = [offsets[i] + TILE['dram_offsets'][i]*elem_bytes[i] for i in range(3)]
     
-    # Get controller configuration for the hardware
-    controller_args = cfg.get_controller_regs(CONV_DICT, sauria_regs, N_REGS, offsets, loop_order)
+        # Get controller configuration for the hardware (the same job for every image,
+        # only the addresses move to the region of the image)
+        controller_args.append([cfg.get_controller_regs(CONV_job, sauria_regs, N_REGS, [job_offsets[i] + n*image_bytes[i] for i in range(3)], loop_order, CONV_full=CONV_DICT) for n in range(N_images)])
+
+        # DRAM traffic of all jobs
+        job_traffic = ex.get_loop_order_traffic(CONV_job, HOPTS, loop_order, CONV_full=CONV_DICT)
+        for key in ['A_bytes', 'B_bytes', 'C_rd_bytes', 'C_wr_bytes', 'total_bytes']:
+            traffic[key] = traffic.get(key, 0) + N_images*job_traffic[key]
+        traffic.setdefault('tensor_kept', job_traffic['tensor_kept'])
+
+    # One controller job sequence for the whole batch: all jobs of image 0, then image 1...
+    controller_args = [controller_args[j][n] for n in range(N_images) for j in range(len(controller_args))]
 
     # Save Test outputs
     fh.generate_test_files(DRAM_mem, DRAM_mem_gold, controller_args, [offsets[0],offsets[2],offsets[3]], HOPTS, N_REGS, test_dir=test_dir)
@@ -279,7 +545,7 @@ def Conv2d_SAURIA(A_tensor, B_tensor, C_preload, C_golden, CONV_DICT, HOPTS, gen
 
     # SAURIA statistics & performance metrics
     # -----------------------------------------
-    stats_dict['total_ops'] = 2*CONV_DICT['A_c']*CONV_DICT['B_w']*CONV_DICT['B_h']*CONV_DICT['C_w']*CONV_DICT['C_h']*CONV_DICT['C_c']
+    stats_dict['total_ops'] = 2*N_images*CONV_DICT['A_c']*CONV_DICT['B_w']*CONV_DICT['B_h']*CONV_DICT['C_w']*CONV_DICT['C_h']*CONV_DICT['C_c']
     stats_dict['tile_ops'] = 2*CONV_DICT['c_til']*CONV_DICT['B_w']*CONV_DICT['B_h']*CONV_DICT['w_til']*CONV_DICT['h_til']*CONV_DICT['k_til']
 
     # Virtual time runs at 10 GHz (0.1 ns), SAURIA runs at 500 MHz -> Division factor of 20
@@ -308,13 +574,33 @@ def Conv2d_SAURIA(A_tensor, B_tensor, C_preload, C_golden, CONV_DICT, HOPTS, gen
     stats_dict['MEMB_utilization'] = stats_dict['used_MEMB_kB']/stats_dict['total_MEMB_kB']
     stats_dict['MEMC_utilization'] = stats_dict['used_MEMC_kB']/stats_dict['total_MEMC_kB']
 
+    # DRAM traffic of the selected loop order(s)
+    stats_dict['loop_order'] = loop_orders[0]
+    stats_dict['N_jobs'] = len(loop_orders)
+    stats_dict['dram_A_bytes'] = traffic['A_bytes']
+    stats_dict['dram_B_bytes'] = traffic['B_bytes']
+    stats_dict['dram_C_bytes'] = traffic['C_rd_bytes'] + traffic['C_wr_bytes']
+    stats_dict['dram_total_bytes'] = traffic['total_bytes']
+
     # Total tiles & sources of inefficiency
-    stats_dict['total_tiles'] = CONV_DICT['N_total_tiles']
+    stats_dict['total_tiles'] = N_images*CONV_DICT['N_total_tiles']
     stats_dict['total_accel_only_cycles'] = stats_dict['1tile_SAURIA_cycles']*stats_dict['total_tiles']
 
     stats_dict['total_accel_stalls'] = stats_dict['1tile_SAURIA_stalls']*stats_dict['total_tiles']
     stats_dict['accel_waiting_cycles'] = stats_dict['total_cycles'] - stats_dict['total_accel_only_cycles']
 
+    # Analytical cycle model vs. simulation
+    prediction = ex.predict_conv_cycles(CONV_DICT, HOPTS, loop_order_mode=loop_order_mode, coefs=cycle_coefs)
+    stats_dict['predicted_1tile_cycles'] = prediction['1tile_SAURIA_cycles']
+    stats_dict['predicted_1tile_stalls'] = prediction['1tile_SAURIA_stalls']
+    stats_dict['predicted_total_cycles'] = N_images*prediction['total_cycles']
+    stats_dict['cycle_prediction_error'] = (stats_dict['predicted_total_cycles'] - stats_dict['total_cycles'])/stats_dict['total_cycles']
+
+    # Batch: cycles amortized over the images and throughput in images/s (at 500 MHz)
+    stats_dict['batch'] = N_images
+    stats_dict['amortized_cycles'] = stats_dict['total_cycles']/N_images
+    stats_dict['images_per_second'] = N_images*500e6/stats_dict['total_cycles']
+
     if not silent:
         if n_test_errors==0:
             print("\n              TEST PASSED\n")
@@ -332,6 +618,12 @@ def Conv2d_SAURIA(A_tensor, B_tensor, C_preload, C_golden, CONV_DICT, HOPTS, gen
             print("Number of tiles:\t\t\t{}".format(stats_dict['total_tiles']))
             print("Core stall cycles:\t\t\t{} ({:.2f} %)".format(stats_dict['total_accel_stalls'], 100*stats_dict['total_accel_stalls']/stats_dict['total_cycles']))
             print("Memory/CGF stall cycles:\t\t{} ({:.2f} %)".format(stats_dict['accel_waiting_cycles'], 100*stats_dict['accel_waiting_cycles']/stats_dict['total_cycles']))
+            print("Predicted cycles (model):\t\t{:.0f} ({:+.2f} %)".format(stats_dict['predicted_total_cycles'], 100*stats_dict['cycle_prediction_error']))
+            if N_images > 1:
+                print("Batch:\t\t\t\t\t{} images | {:.0f} cycles/image | {:.1f} images/s".format(N_images, stats_dict['amortized_cycles'], stats_dict['images_per_second']))
+            print("")
+            print("Loop order:\t\t\t\t{} (keep {}) | Jobs: {}".format(loop_orders[0], traffic['tensor_kept'], len(loop_orders)))
+            print("DRAM traffic (A|B|C):\t\t\t{} | {} | {} [B]".format(stats_dict['dram_A_bytes'], stats_dict['dram_B_bytes'], stats_dict['dram_C_bytes']))
             print("")
             print("SAURIA memory capacity (A|B|C):\t\t{} | {} | {} [kB]".format(stats_dict['total_MEMA_kB'], stats_dict['total_MEMB_kB'], stats_dict['total_MEMC_kB']))
             print("Utilized memory:\t\t\t{} | {} | {} [kB] ({:.2f} | {:.2f} | {:.2f} [%])".format(stats_dict['used_MEMA_kB'], stats_dict['used_MEMB_kB'], stats_dict['used_MEMC_kB'], 100*stats_dict['MEMA_utilization'], 100*stats_dict['MEMB_utilization'], 100*stats_dict['MEMC_utilization']))
@@ -344,20 +636,442 @@ def Conv2d_SAURIA(A_tensor, B_tensor, C_preload, C_golden, CONV_DICT, HOPTS, gen
 # Full SAURIA test, including random tensor generation
 # -------------------------------------------------------
 
-def generate_and_run_test(tensor_shapes, tiling_dict, d, s, HOPTS, preload=True, compute_macs=False, generate_vcd=False, pzero_tensors=[0,0,0], insert_deadbeef=True, gauss_scale=1, ones_test=False, assert_no_errors=False, print_statistics=True, test_dir="../../test", silent=True):
+def generate_and_run_test(tensor_shapes, tiling_dict, d, s, HOPTS, preload=True, compute_macs=False, macs_workers=1, macs_trace_dir=None, loop_order_mode='heuristic', generate_vcd=False, pzero_tensors=[0,0,0], insert_deadbeef=True, gauss_scale=1, ones_test=False, assert_no_errors=False, print_statistics=True, golden_mode='mvm', golden_backend='numpy', golden_check='full', golden_check_samples=1024, golden_max_mem_MB=None, golden_sparse='auto', golden_sparse_threshold=0.2, golden_approx='exact', approx_table_dir=None, cycle_coefs=None, batch=None, thres=0, zero_skip_stats=False, pe_utilization=False, test_dir="../../test", silent=True):
 
     # Get convolution configuration
-    CONV_DICT = get_conv_dict(tensor_shapes, tiling_dict, HOPTS, d=d, s=s, preloads=preload)
+    CONV_DICT = get_conv_dict(tensor_shapes, tiling_dict, HOPTS, d=d, s=s, preloads=preload, thres=thres)
 
     # Generate A, B, C random tensors
-    A_tensor, B_tensor, C_preload = dh.generate_tensors(CONV_DICT, HOPTS, pzero=pzero_tensors, insert_deadbeef=insert_deadbeef, gauss_scale=gauss_scale, ones_test=ones_test)
+    A_tensor, B_tensor, C_preload = dh.generate_tensors(CONV_DICT, HOPTS, pzero=pzero_tensors, insert_deadbeef=insert_deadbeef, gauss_scale=gauss_scale, ones_test=ones_test, batch=batch)
     if not preload: C_preload[:]=0
 
     # Perform convolution with systolic array model
-    C_golden, partial_macs, _ = ex.get_ideal_results(A_tensor, B_tensor, C_preload, CONV_DICT, HOPTS, get_sa_dict(HOPTS), compute_macs=compute_macs)
+    SA_dict = get_sa_dict(HOPTS)
+    golden_args = dict(compute_macs=compute_macs, macs_workers=macs_workers, loop_order_mode=loop_order_mode, golden_mode=golden_mode, golden_backend=golden_backend, check_level=golden_check, check_samples=golden_check_samples, max_mem_MB=golden_max_mem_MB, sparse_mode=golden_sparse, sparse_threshold=golden_sparse_threshold, approx_mode=golden_approx, approx_table_dir=approx_table_dir)
+
+    if batch is None:
+        C_golden, partial_macs, _ = ex.get_ideal_results(A_tensor, B_tensor, C_preload, CONV_DICT, HOPTS, SA_dict, macs_trace_dir=macs_trace_dir, **golden_args)
+
+    # Batch: one golden per image (partial MACs as a list, traces in a subdirectory per image)
+    else:
+        C_golden, partial_macs = [], []
+        for n in range(batch):
+            image_trace_dir = None if (macs_trace_dir is None) else os.path.join(macs_trace_dir, "image_{}".format(n))
+            C_image, macs_image, _ = ex.get_ideal_results(A_tensor[n], B_tensor, C_preload[n], CONV_DICT, HOPTS, SA_dict, macs_trace_dir=image_trace_dir, **golden_args)
+            C_golden.append(C_image)
+            partial_macs.append(macs_image)
+        C_golden = np.stack(C_golden)
                  
     # Execute convolution
-    SAURIA_outputs, SAURIA_stats = Conv2d_SAURIA(A_tensor, B_tensor, C_preload, C_golden, CONV_DICT, HOPTS, generate_vcd=generate_vcd, assert_no_errors=assert_no_errors, print_statistics=print_statistics, test_dir=test_dir, silent=silent)
+    SAURIA_outputs, SAURIA_stats = Conv2d_SAURIA(A_tensor, B_tensor, C_preload, C_golden, CONV_DICT, HOPTS, loop_order_mode=loop_order_mode, cycle_coefs=cycle_coefs, generate_vcd=generate_vcd, assert_no_errors=assert_no_errors, print_statistics=print_statistics, test_dir=test_dir, silent=silent)
+
+    # Golden model verification depth (so that the run can be audited)
+    SAURIA_stats['golden_mode'] = golden_mode
+    SAURIA_stats['golden_approx'] = golden_approx if HOPTS['approx_comp'] else 'none'
+    SAURIA_stats['golden_check'] = SA_dict.get('check_level', 'none')
+    SAURIA_stats['golden_check_points'] = SA_dict.get('check_points', 0)
+
+    # Golden MVM backend (dense / sparse) and its gain in MACs w.r.t. the dense MVM
+    SAURIA_stats['golden_mvm'] = SA_dict.get('mvm_backend', 'none')
+    SAURIA_stats['golden_density_A'] = SA_dict.get('mvm_density_A', 1.0)
+    SAURIA_stats['golden_density_B'] = SA_dict.get('mvm_density_B', 1.0)
+    SAURIA_stats['golden_sparse_gain'] = SA_dict.get('mvm_sparse_gain', 1.0)
+
+    # MACs skipped by the zero detectors (negligence, and exact zeros with zero_skip_stats) and error of the negligence
+    if batch is None:
+        neglect_stats = ex.get_negligence_stats(A_tensor, B_tensor, C_golden, CONV_DICT, HOPTS, zero_stats=zero_skip_stats)
+    else:
+        image_stats = [ex.get_negligence_stats(A_tensor[n], B_tensor, C_golden[n], CONV_DICT, HOPTS, zero_stats=zero_skip_stats) for n in range(batch)]
+        neglect_stats = {key: np.sum([st[key] for st in image_stats]) for key in ['macs_total', 'macs_neglected', 'neglect_errors']}
+        neglect_stats.update({key: np.max([st[key] for st in image_stats]) for key in ['thres', 'neglect_max_error']})
+        neglect_stats.update({key: np.mean([st[key] for st in image_stats]) for key in ['neglect_mean_error', 'neglect_NMED']})
+        if zero_skip_stats:
+            neglect_stats['macs_zero_skipped'] = np.sum([st['macs_zero_skipped'] for st in image_stats])
+            neglect_stats['macs_skip_ratio'] = (neglect_stats['macs_zero_skipped'] + neglect_stats['macs_neglected'])/neglect_stats['macs_total']
+    SAURIA_stats.update(neglect_stats)
+
+    # Operand-toggle power proxy (from the cycle-accurate MAC trace)
+    if compute_macs:
+        ACT = ex.get_toggle_activity([partial_macs] if (batch is None) else partial_macs, CONV_DICT, HOPTS)
+        SAURIA_stats['toggle_activity_factor'] = ACT['activity_factor']
+        for reg in ex.TOGGLE_REGS:
+            SAURIA_stats['toggle_activity_'+reg] = ACT['activity_'+reg]
+        SAURIA_stats['toggles'] = ACT['toggles']
+        SAURIA_stats['trace_macs_computed'] = ACT['macs_computed']
+        SAURIA_stats['trace_macs_gated'] = ACT['macs_gated']
+        SAURIA_stats['pe_toggle_heatmap'] = ACT['heatmap']
+        SAURIA_stats['pe_macs_heatmap'] = ACT['heatmap_macs']
+
+    # PE utilization from the mapping: where the peak throughput is lost
+    if pe_utilization:
+        UTIL = ex.get_utilization_report(CONV_DICT, HOPTS, A_tensor, B_tensor)
+        SAURIA_stats['pe_util_effective'] = UTIL['util_effective']
+        for loss in ['spatial', 'edge', 'gated']:
+            SAURIA_stats['pe_loss_'+loss] = UTIL['loss_'+loss]
+        SAURIA_stats['pe_util_X'] = UTIL['util_X']
+        SAURIA_stats['pe_util_Y'] = UTIL['util_Y']
+        SAURIA_stats['pe_util_heatmap'] = UTIL['heatmap']
+    SAURIA_stats['golden_mvm_X_underuse'] = SA_dict.get('mvm_X_underuse', 0.0)
+    SAURIA_stats['golden_mvm_Y_underuse'] = SA_dict.get('mvm_Y_underuse', 0.0)
+
+    # Golden result cache: status of this test and hits/misses so far
+    cache_stats = ex.get_golden_cache_stats()
+    SAURIA_stats['golden_cache'] = SA_dict.get('golden_cache', 'off')
+    SAURIA_stats['golden_cache_hits'] = cache_stats['hits_mem'] + cache_stats['hits_disk']
+    SAURIA_stats['golden_cache_misses'] = cache_stats['misses']
+
+    if not silent and print_statistics:
+        check_str = 'cached' if (SAURIA_stats['golden_check'] == 'cached') else "{} ({} points)".format(SAURIA_stats['golden_check'], SAURIA_stats['golden_check_points'])
+        print("Golden model check:\t\t\t{} | mode: {}".format(check_str, golden_mode))
+        print("Golden cache:\t\t\t\t{} | hits: {} (memory {}, disk {}), misses: {}".format(SAURIA_stats['golden_cache'], SAURIA_stats['golden_cache_hits'], cache_stats['hits_mem'], cache_stats['hits_disk'], cache_stats['misses']))
+        print("Golden MVM:\t\t\t\t{} (density A {:.3f}, B {:.3f}) | MAC reduction: {:.2f}x".format(SAURIA_stats['golden_mvm'], SAURIA_stats['golden_density_A'], SAURIA_stats['golden_density_B'], SAURIA_stats['golden_sparse_gain']))
+        if zero_skip_stats:
+            print("Skipped MACs:\t\t\t\t{:.2f} % | zeros: {} | neglected: {} (threshold {})".format(100*SAURIA_stats['macs_skip_ratio'], SAURIA_stats['macs_zero_skipped'], SAURIA_stats['macs_neglected'], SAURIA_stats['thres']))
+        else:
+            print("Neglected MACs:\t\t\t\t{} (threshold {})".format(SAURIA_stats['macs_neglected'], SAURIA_stats['thres']))
+        if pe_utilization:
+            print("PE utilization (compute steps):\t\t{:.2f} % | lost: spatial {:.2f} % | edge tiles {:.2f} % | zero-gated {:.2f} %".format(100*SAURIA_stats['pe_util_effective'], 100*SAURIA_stats['pe_loss_spatial'], 100*SAURIA_stats['pe_loss_edge'], 100*SAURIA_stats['pe_loss_gated']))
+        if compute_macs:
+            print("Toggle activity factor:\t\t\t{:.4f} (A {:.4f} | B {:.4f} | prop {:.4f} | acc {:.4f}) | gated MACs: {}".format(SAURIA_stats['toggle_activity_factor'], SAURIA_stats['toggle_activity_A'], SAURIA_stats['toggle_activity_B'], SAURIA_stats['toggle_activity_prop'], SAURIA_stats['toggle_activity_acc'], SAURIA_stats['trace_macs_gated']))
+        if SAURIA_stats['thres'] > 0:
+            print("Negligence error:\t\t\t{} outputs | max {:.4g} | mean {:.4g} | NMED {:.3e}".format(SAURIA_stats['neglect_errors'], SAURIA_stats['neglect_max_error'], SAURIA_stats['neglect_mean_error'], SAURIA_stats['neglect_NMED']))
            
     return SAURIA_outputs, SAURIA_stats, partial_macs
 
+# -------------------------------------------------------
+# GEMM / fully-connected layers lowered to a 1x1 convolution
+# -------------------------------------------------------
+
+# C[M,N] = A[M,K] @ B[K,N] (+ bias) as a 1x1 convolution with C_in = K. The output
+# channels are N (out_dim 'N': A is the activation tensor) or M (out_dim 'M': A holds the
+# weights), and the other dimension is folded into a [C_h, C_w] feature map. Every
+# orientation and folding is scored with the tiling optimizer, whose cycle model
+# includes the aligned-activation path of 1x1 layers (o_xlim = Y_used).
+def get_matmul_mapping(M, K, N, HOPTS, top_n=1, cycle_coefs=None):
+
+    MAPPINGS = []
+
+    for out_dim in ['N', 'M']:
+        C_c, spatial = (N, M) if (out_dim == 'N') else (M, N)
+
+        for C_h in get_divisors(spatial):
+            C_w = int(spatial//C_h)
+            tensor_shapes = [[K, int(C_h), C_w], [C_c, K, 1, 1], [C_c, int(C_h), C_w]]
+
+            try:
+                tiling = optimize_tiling(tensor_shapes, 1, 1, HOPTS, top_n=1, cycle_coefs=cycle_coefs)[0]
+            except AssertionError:
+                continue
+
+            MAPPINGS.append({
+                'M' :               M,
+                'K' :               K,
+                'N' :               N,
+                'out_dim' :         out_dim,
+                'tensor_shapes' :   tensor_shapes,
+                'tiling' :          tiling,
+                'aligned' :         (tiling['tile_cin']%HOPTS['MEMA_N'] == 0) and (tiling['Y_used']%HOPTS['MEMA_N'] == 0),
+                'predicted_cycles': tiling['predicted_cycles'],
+            })
+
+    assert len(MAPPINGS) > 0, "No legal 1x1 convolution mapping was found for this GEMM and hardware"
+
+    # Fewest predicted cycles, then the aligned activation path
+    MAPPINGS.sort(key=lambda m: (m['predicted_cycles'], not m['aligned']))
+
+    return MAPPINGS[:top_n]
+
+# Matrices => tensors of the 1x1 convolution. The bias is a vector of N values or a full
+# [M, N] matrix of preloads
+def matmul_to_conv(A_mat, B_mat, bias, MAPPING):
+
+    M, K, N = MAPPING['M'], MAPPING['K'], MAPPING['N']
+    _, C_h, C_w = MAPPING['tensor_shapes'][2]
+
+    if bias is None:
+        bias_mat = np.zeros((M, N), dtype=np.asarray(A_mat).dtype)
+    else:
+        bias_mat = np.broadcast_to(np.asarray(bias), (M, N))
+
+    if MAPPING['out_dim'] == 'N':
+        A_tensor = np.ascontiguousarray(np.asarray(A_mat).T).reshape(K, C_h, C_w)
+        B_tensor = np.ascontiguousarray(np.asarray(B_mat).T).reshape(N, K, 1, 1)
+        C_preload = np.ascontiguousarray(bias_mat.T).reshape(N, C_h, C_w)
+    else:
+        A_tensor = np.ascontiguousarray(B_mat).reshape(K, C_h, C_w)
+        B_tensor = np.ascontiguousarray(A_mat).reshape(M, K, 1, 1)
+        C_preload = np.ascontiguousarray(bias_mat).reshape(M, C_h, C_w)
+
+    return A_tensor, B_tensor, C_preload
+
+# Output tensor of the 1x1 convolution => C[M, N]
+def conv_to_matmul(C_tensor, MAPPING):
+
+    M, N = MAPPING['M'], MAPPING['N']
+
+    if MAPPING['out_dim'] == 'N':
+        return np.reshape(C_tensor, (N, M)).T
+
+    return np.reshape(C_tensor, (M, N))
+
+# Full SAURIA GEMM: golden model + RTL simulation of the lowered convolution. Returns the
+# SAURIA and golden results as [M, N] matrices and the statistics of the run
+def Matmul_SAURIA(A_mat, B_mat, HOPTS, bias=None, MAPPING=None, loop_order_mode='heuristic', golden_mode='mvm', thres=0, cycle_coefs=None, assert_no_errors=False, print_statistics=True, test_dir="../../test", silent=True):
+
+    M, K = np.shape(A_mat)
+    assert np.shape(B_mat)[0] == K, "Matrix dimensions must fit for GeMM"
+    N = np.shape(B_mat)[1]
+
+    if MAPPING is None:
+        MAPPING = get_matmul_mapping(M, K, N, HOPTS, top_n=1, cycle_coefs=cycle_coefs)[0]
+
+    A_tensor, B_tensor, C_preload = matmul_to_conv(A_mat, B_mat, bias, MAPPING)
+    A_tensor = A_tensor.astype(HOPTS['intyp'])
+    B_tensor = B_tensor.astype(HOPTS['intyp'])
+    C_preload = C_preload.astype(HOPTS['intyp'])
+
+    CONV_DICT = get_conv_dict(MAPPING['tensor_shapes'], MAPPING['tiling'], HOPTS, d=1, s=1, preloads=(bias is not None), thres=thres)
+
+    SA_dict = get_sa_dict(HOPTS)
+    C_golden, _, _ = ex.get_ideal_results(A_tensor, B_tensor, C_preload, CONV_DICT, HOPTS, SA_dict, loop_order_mode=loop_order_mode, golden_mode=golden_mode)
+
+    SAURIA_outputs, SAURIA_stats = Conv2d_SAURIA(A_tensor, B_tensor, C_preload, C_golden, CONV_DICT, HOPTS, loop_order_mode=loop_order_mode, cycle_coefs=cycle_coefs, assert_no_errors=assert_no_errors, print_statistics=print_statistics, test_dir=test_dir, silent=silent)
+
+    # GEMM view of the run
+    SAURIA_stats['matmul_shape'] = [M, K, N]
+    SAURIA_stats['matmul_out_dim'] = MAPPING['out_dim']
+    SAURIA_stats['matmul_fold'] = MAPPING['tensor_shapes'][2][1:]
+    SAURIA_stats['matmul_aligned'] = MAPPING['aligned']
+    SAURIA_stats['matmul_macs'] = M*K*N
+
+    if not silent and print_statistics:
+        print("GEMM [M,K,N]:\t\t\t\t{} | output channels: {} | {} folded as {} | aligned activations: {}".format(SAURIA_stats['matmul_shape'], MAPPING['out_dim'], 'M' if (MAPPING['out_dim'] == 'N') else 'N', SAURIA_stats['matmul_fold'], MAPPING['aligned']))
+
+    return conv_to_matmul(SAURIA_outputs, MAPPING), conv_to_matmul(C_golden, MAPPING), SAURIA_stats
+
+# GEMM test with random matrices
+def generate_and_run_matmul(M, K, N, HOPTS, bias=True, loop_order_mode='heuristic', golden_mode='mvm', thres=0, pzero_tensors=[0,0,0], gauss_scale=1, ones_test=False, assert_no_errors=False, print_statistics=True, cycle_coefs=None, test_dir="../../test", silent=True):
+
+    distribution = 'gauss' if (HOPTS['OP_TYPE']==1) else 'unif'
+
+    A_mat = dh.gen_random_tensor([M, K], pzero_tensors[0], HOPTS['IA_W'], HOPTS['OP_TYPE'], distribution, gauss_scale=gauss_scale, ones_test=ones_test)
+    B_mat = dh.gen_random_tensor([K, N], pzero_tensors[1], HOPTS['IB_W'], HOPTS['OP_TYPE'], distribution, gauss_scale=gauss_scale, ones_test=ones_test)
+    bias_vec = dh.gen_random_tensor([N], pzero_tensors[2], HOPTS['OC_W'], HOPTS['OP_TYPE'], distribution, gauss_scale=gauss_scale, ones_test=ones_test) if bias else None
+
+    return Matmul_SAURIA(A_mat, B_mat, HOPTS, bias=bias_vec, loop_order_mode=loop_order_mode, golden_mode=golden_mode, thres=thres, cycle_coefs=cycle_coefs, assert_no_errors=assert_no_errors, print_statistics=print_statistics, test_dir=test_dir, silent=silent)
+
+# -------------------------------------------------------
+# Grouped and depthwise convolutions
+# -------------------------------------------------------
+
+# C_in and C_out are split in G groups, and output channel k only sees the C_in/G inputs of
+# its group. Weights are [C_out, C_in/G, B_h, B_w] (as in PyTorch), so the tensor shapes are
+# [[C_in, A_h, A_w], [C_out, C_in/G, B_h, B_w], [C_out, C_h, C_w]].
+# Groups are packed P at a time into a dense convolution with block-diagonal weights, so
+# that a single SAURIA job fills P*C_out/G output channels of the array (the zero blocks
+# are wasted MACs). The G/P packs run as the images of a batch, each one with its own
+# weights, in a single simulation. P = 1 is the naive mapping (one group per job).
+def get_group_pack_shapes(tensor_shapes, groups, pack):
+
+    C_in, A_h, A_w = tensor_shapes[0]
+    C_out, cin_g, B_h, B_w = tensor_shapes[1]
+    cout_g = C_out//groups
+
+    return [[pack*cin_g, A_h, A_w], [pack*cout_g, pack*cin_g, B_h, B_w], [pack*cout_g, tensor_shapes[2][1], tensor_shapes[2][2]]]
+
+# Every group packing that has a legal tiling, best first (predicted cycles of all packs)
+def get_grouped_mapping(tensor_shapes, groups, d, s, HOPTS, packs=None, cycle_coefs=None):
+
+    C_in = tensor_shapes[0][0]
+    C_out, cin_g, B_h, B_w = tensor_shapes[1]
+
+    assert (C_in%groups == 0) and (C_out%groups == 0), "Input and output channels must be divisible by the number of groups"
+    assert cin_g == C_in//groups, "Weights of a grouped convolution must be [C_out, C_in/groups, B_h, B_w]"
+
+    useful_ops = 2*C_out*cin_g*B_h*B_w*tensor_shapes[2][1]*tensor_shapes[2][2]
+
+    if packs is None:
+        packs = get_divisors(groups)
+
+    MAPPINGS = []
+    for pack in packs:
+        pack_shapes = get_group_pack_shapes(tensor_shapes, groups, pack)
+
+        try:
+            tiling = optimize_tiling(pack_shapes, d, s, HOPTS, top_n=1, cycle_coefs=cycle_coefs)[0]
+        except AssertionError:
+            continue
+
+        N_packs = groups//pack
+        predicted_cycles = N_packs*tiling['predicted_cycles']
+
+        MAPPINGS.append({
+            'groups' :                  groups,
+            'pack' :                    int(pack),
+            'N_packs' :                 int(N_packs),
+            'tensor_shapes' :           pack_shapes,
+            'tiling' :                  tiling,
+            'useful_ops' :              useful_ops,
+            'predicted_cycles' :        predicted_cycles,
+            'predicted_utilization' :   useful_ops/(predicted_cycles*2*HOPTS['X']*HOPTS['Y']),
+        })
+
+    assert len(MAPPINGS) > 0, "No legal group packing was found for this grouped convolution and hardware"
+
+    MAPPINGS.sort(key=lambda m: m['predicted_cycles'])
+
+    return MAPPINGS
+
+# Grouped tensors => [N_packs, ...] tensors of the packed dense convolutions
+def pack_grouped_tensors(A_tensor, B_tensor, C_tensor, MAPPING):
+
+    P, N_packs = MAPPING['pack'], MAPPING['N_packs']
+    C_out, cin_g = np.shape(B_tensor)[:2]
+    cout_g = C_out//MAPPING['groups']
+
+    A_packs = np.reshape(A_tensor, [N_packs, P*cin_g] + list(np.shape(A_tensor)[1:]))
+    C_packs = np.reshape(C_tensor, [N_packs, P*cout_g] + list(np.shape(C_tensor)[1:]))
+
+    # Block-diagonal weights
+    B_packs = np.zeros([N_packs, P*cout_g, P*cin_g] + list(np.shape(B_tensor)[2:]), dtype=B_tensor.dtype)
+    for g in range(MAPPING['groups']):
+        p, j = divmod(g, P)
+        B_packs[p, j*cout_g:(j+1)*cout_g, j*cin_g:(j+1)*cin_g] = B_tensor[g*cout_g:(g+1)*cout_g]
+
+    return A_packs, B_packs, C_packs
+
+# Full SAURIA grouped convolution: golden model + RTL simulation of the packed layer.
+# Utilization is reported on the useful operations only (without the zero blocks), and
+# compared with the naive mapping: predicted by the cycle model, and simulated as well
+# if compare_naive is set.
+def Conv2d_grouped_SAURIA(A_tensor, B_tensor, C_preload, groups, HOPTS, d=1, s=1, MAPPING=None, preload=True, loop_order_mode='heuristic', golden_mode='mvm', thres=0, cycle_coefs=None, compare_naive=False, assert_no_errors=False, print_statistics=True, test_dir="../../test", silent=True):
+
+    tensor_shapes = [list(np.shape(A_tensor)), list(np.shape(B_tensor)), list(np.shape(C_preload))]
+
+    if MAPPING is None:
+        MAPPING = get_grouped_mapping(tensor_shapes, groups, d, s, HOPTS, cycle_coefs=cycle_coefs)[0]
+
+    # Packed dense convolutions
+    A_packs, B_packs, C_packs = pack_grouped_tensors(A_tensor, B_tensor, C_preload, MAPPING)
+    CONV_DICT = get_conv_dict(MAPPING['tensor_shapes'], MAPPING['tiling'], HOPTS, d=d, s=s, preloads=preload, thres=thres)
+
+    SA_dict = get_sa_dict(HOPTS)
+    C_golden = np.stack([ex.get_ideal_results(A_packs[p], B_packs[p], C_packs[p], CONV_DICT, HOPTS, SA_dict, loop_order_mode=loop_order_mode, golden_mode=golden_mode)[0] for p in range(MAPPING['N_packs'])])
+
+    SAURIA_outputs, SAURIA_stats = Conv2d_SAURIA(A_packs, B_packs, C_packs, C_golden, CONV_DICT, HOPTS, loop_order_mode=loop_order_mode, cycle_coefs=cycle_coefs, assert_no_errors=assert_no_errors, print_statistics=print_statistics, test_dir=test_dir, silent=silent)
+
+    # Packs are not images: the whole layer is one image
+    SAURIA_stats['batch'] = 1
+    SAURIA_stats['amortized_cycles'] = SAURIA_stats['total_cycles']
+    SAURIA_stats['images_per_second'] = 500e6/SAURIA_stats['total_cycles']
+
+    # Useful work (without the zero blocks of the packed weights)
+    SAURIA_stats['groups'] = groups
+    SAURIA_stats['group_pack'] = MAPPING['pack']
+    SAURIA_stats['group_N_packs'] = MAPPING['N_packs']
+    SAURIA_stats['useful_ops'] = MAPPING['useful_ops']
+    SAURIA_stats['useful_utilization'] = MAPPING['useful_ops']/(SAURIA_stats['total_cycles']*SAURIA_stats['ideal_throughput'])
+
+    # Naive mapping: one group per job
+    naive = get_grouped_mapping(tensor_shapes, groups, d, s, HOPTS, packs=[1], cycle_coefs=cycle_coefs)[0]
+    SAURIA_stats['naive_predicted_cycles'] = naive['predicted_cycles']
+    SAURIA_stats['naive_predicted_utilization'] = naive['predicted_utilization']
+
+    if compare_naive:
+        if MAPPING['pack'] == 1:
+            naive_stats = SAURIA_stats
+        else:
+            _, _, naive_stats = Conv2d_grouped_SAURIA(A_tensor, B_tensor, C_preload, groups, HOPTS, d=d, s=s, MAPPING=naive, preload=preload, loop_order_mode=loop_order_mode, golden_mode=golden_mode, thres=thres, cycle_coefs=cycle_coefs, assert_no_errors=assert_no_errors, print_statistics=False, test_dir=test_dir, silent=True)
+        SAURIA_stats['naive_total_cycles'] = naive_stats['total_cycles']
+        SAURIA_stats['naive_utilization'] = naive_stats['useful_utilization']
+        SAURIA_stats['naive_speedup'] = naive_stats['total_cycles']/SAURIA_stats['total_cycles']
+
+    if not silent and print_statistics:
+        print("Groups:\t\t\t\t\t{} | packed {} per job ({} packs)".format(groups, MAPPING['pack'], MAPPING['N_packs']))
+        print("Useful utilization:\t\t\t{:.2f} % | naive mapping (predicted): {:.2f} %".format(100*SAURIA_stats['useful_utilization'], 100*SAURIA_stats['naive_predicted_utilization']))
+        if compare_naive:
+            print("Naive mapping (simulated):\t\t{} cycles ({:.2f} %) | speedup: {:.2f}x".format(SAURIA_stats['naive_total_cycles'], 100*SAURIA_stats['naive_utilization'], SAURIA_stats['naive_speedup']))
+
+    output_tensor = np.reshape(SAURIA_outputs, np.shape(C_preload))
+    C_golden = np.reshape(C_golden, np.shape(C_preload))
+
+    return output_tensor, C_golden, SAURIA_stats
+
+# Grouped convolution test with random tensors (groups = C_in for a depthwise layer)
+def generate_and_run_grouped_test(tensor_shapes, groups, d, s, HOPTS, preload=True, loop_order_mode='heuristic', golden_mode='mvm', thres=0, pzero_tensors=[0,0,0], gauss_scale=1, ones_test=False, compare_naive=False, assert_no_errors=False, print_statistics=True, cycle_coefs=None, test_dir="../../test", silent=True):
+
+    distribution = 'gauss' if (HOPTS['OP_TYPE']==1) else 'unif'
+
+    A_tensor = dh.gen_random_tensor(tensor_shapes[0], pzero_tensors[0], HOPTS['IA_W'], HOPTS['OP_TYPE'], distribution, gauss_scale=gauss_scale, ones_test=ones_test)
+    B_tensor = dh.gen_random_tensor(tensor_shapes[1], pzero_tensors[1], HOPTS['IB_W'], HOPTS['OP_TYPE'], distribution, gauss_scale=gauss_scale, ones_test=ones_test)
+    C_preload = dh.gen_random_tensor(tensor_shapes[2], pzero_tensors[2], HOPTS['OC_W'], HOPTS['OP_TYPE'], distribution, gauss_scale=gauss_scale, ones_test=ones_test)
+    if not preload: C_preload[:]=0
+
+    return Conv2d_grouped_SAURIA(A_tensor, B_tensor, C_preload, groups, HOPTS, d=d, s=s, preload=preload, loop_order_mode=loop_order_mode, golden_mode=golden_mode, thres=thres, cycle_coefs=cycle_coefs, compare_naive=compare_naive, assert_no_errors=assert_no_errors, print_statistics=print_statistics, test_dir=test_dir, silent=silent)
+
+# -------------------------------------------------------
+# Accuracy of approximate arithmetic (sampled, no RTL simulation)
+# -------------------------------------------------------
+
+def generate_and_evaluate_approx(tensor_shapes, tiling_dict, d, s, HOPTS, preload=True, n_samples=1024, confidence=0.95, surrogate=False, approx_table_dir=None, thres=0, pzero_tensors=[0,0,0], gauss_scale=1, ones_test=False, print_statistics=True, seed=None, silent=True):
+
+    assert HOPTS['approx_comp'], "The sampled evaluation is meant for approximate arithmetic (approx_comp=True)"
+
+    # Get convolution configuration
+    CONV_DICT = get_conv_dict(tensor_shapes, tiling_dict, HOPTS, d=d, s=s, preloads=preload, thres=thres)
+
+    # Generate A, B, C random tensors
+    A_tensor, B_tensor, C_preload = dh.generate_tensors(CONV_DICT, HOPTS, pzero=pzero_tensors, insert_deadbeef=False, gauss_scale=gauss_scale, ones_test=ones_test)
+    if not preload: C_preload[:]=0
+
+    # Bit-accurate approximate results at a random sample of outputs
+    ERROR = ex.evaluate_approx_sampled(A_tensor, B_tensor, C_preload, CONV_DICT, HOPTS, n_samples=n_samples, confidence=confidence, seed=seed)
+
+    # Statistical surrogate at the same outputs, to validate it against the bit-accurate model
+    if surrogate:
+        TABLE = ex.get_approx_table(HOPTS, table_dir=approx_table_dir)
+        C_surrogate = ex.conv2d_approx_surrogate(A_tensor, B_tensor, C_preload, TABLE, s=s, d=d, seed=seed).astype(HOPTS['intyp'])
+        C_surrogate = ex.remove_neglected_products(C_surrogate, A_tensor, B_tensor, CONV_DICT, HOPTS)
+
+        k_idx, y_idx, x_idx = ERROR['positions']
+        abs_error = np.abs(C_surrogate[k_idx, y_idx, x_idx].astype(np.float64) - ERROR['exact'])
+        nonzero = ERROR['exact'] != 0
+
+        ERROR['surrogate_MRED'] = float(np.mean(abs_error[nonzero]/np.abs(ERROR['exact'][nonzero])))
+        ERROR['surrogate_NMED'] = float(np.mean(abs_error)/ERROR['max_exact']) if (ERROR['max_exact'] > 0) else 0.0
+
+    if not silent and print_statistics:
+        print("Approximate arithmetic:\t\t\t{} of {} outputs sampled ({:.0f} % confidence) | negligence threshold: {}".format(ERROR['N_samples'], ERROR['N_outputs'], 100*confidence, thres))
+        print("MRED:\t\t\t\t\t{:.3e} [{:.3e}, {:.3e}]".format(ERROR['MRED'], ERROR['MRED_CI'][0], ERROR['MRED_CI'][1]))
+        print("NMED:\t\t\t\t\t{:.3e} [{:.3e}, {:.3e}]".format(ERROR['NMED'], ERROR['NMED_CI'][0], ERROR['NMED_CI'][1]))
+        print("Max error:\t\t\t\t{:.3e} (exceeded by < {:.2f} % of outputs)".format(ERROR['max_error'], 100*ERROR['max_error_exceed']))
+        if surrogate:
+            print("Surrogate MRED | NMED:\t\t\t{:.3e} | {:.3e}".format(ERROR['surrogate_MRED'], ERROR['surrogate_NMED']))
+
+    return ERROR
+
+# -------------------------------------------------------
+# PE utilization report (no RTL simulation)
+# -------------------------------------------------------
+
+# Per-PE / per-row / per-column utilization of a layer from its mapping, with the loss
+# split into spatial underuse, edge tiles and zero-gated MACs (see get_utilization_report)
+def generate_and_report_utilization(tensor_shapes, tiling_dict, d, s, HOPTS, preload=True, thres=0, pzero_tensors=[0,0,0], gauss_scale=1, ones_test=False, print_statistics=True, silent=True):
+
+    # Get convolution configuration
+    CONV_DICT = get_conv_dict(tensor_shapes, tiling_dict, HOPTS, d=d, s=s, preloads=preload, thres=thres)
+
+    # Generate A, B random tensors (the preloads do not change the MACs)
+    A_tensor, B_tensor, _ = dh.generate_tensors(CONV_DICT, HOPTS, pzero=pzero_tensors, insert_deadbeef=False, gauss_scale=gauss_scale, ones_test=ones_test)
+
+    UTIL = ex.get_utilization_report(CONV_DICT, HOPTS, A_tensor, B_tensor)
+
+    if not silent and print_statistics:
+        print("PE utilization (compute steps):\t\t{:.2f} % of {} MAC slots ({} steps)".format(100*UTIL['util_effective'], UTIL['peak_macs'], UTIL['steps']))
+        print("Lost to spatial underuse:\t\t{:.2f} % (X_used {} of {}, Y_used {} of {})".format(100*UTIL['loss_spatial'], CONV_DICT['X_used'], HOPTS['X'], CONV_DICT['Y_used'], HOPTS['Y']))
+        print("Lost to edge tiles:\t\t\t{:.2f} % | Jobs: {}".format(100*UTIL['loss_edge'], len(ex.get_conv_jobs(CONV_DICT))))
+        print("Lost to zero-gated MACs:\t\t{:.2f} %".format(100*UTIL['loss_gated']))
+        print("Column utilization (X):\t\t\t" + " ".join("{:.2f}".format(u) for u in UTIL['util_X']))
+        print("Row utilization (Y):\t\t\t" + " ".join("{:.2f}".format(u) for u in UTIL['util_Y']))
+
+    return UTIL
@@ -0,0 +1,62 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import src.sauria_lib as slib
+import src.hw_versions as hwv
+import src.data_helper as dh
+import src.execution_model as ex
+
+# Layers [C_in, C_out, C_h, C_w, B_h, B_w, d, s] and tilings [c_til, k_til, h_til, w_til, X_used, Y_used]
+# Each one exercises a different part of the mapping: a full array, array underuse with
+# dilation, stride with a single output column, and a 1x1 layer
+LAYERS = [
+    ([8, 16, 4, 16, 3, 3, 1, 1], [4, 16, 2, 8, 16, 8]),
+    ([6, 8, 3, 8, 3, 3, 2, 1], [3, 8, 3, 8, 4, 4]),
+    ([5, 12, 2, 6, 2, 3, 1, 2], [5, 12, 1, 6, 12, 6]),
+    ([16, 16, 4, 8, 1, 1, 1, 1], [8, 16, 4, 8, 16, 8]),
+]
+
+def get_layer(layer, HOPTS, preload=True, thres=0):
+
+    (c, k, C_h, C_w, B_h, B_w, d, s), (c_til, k_til, h_til, w_til, X_used, Y_used) = layer
+
+    A_h = (1 + s*(C_h-1)) + (1 + d*(B_h-1)) - 1
+    A_w = (1 + s*(C_w-1)) + (1 + d*(B_w-1)) - 1
+
+    tensor_shapes = [[c, A_h, A_w], [k, c, B_h, B_w], [k, C_h, C_w]]
+    tiling_dict = {'C_tile_shape': [k_til, h_til, w_til], 'tile_cin': c_til, 'X_used': X_used, 'Y_used': Y_used}
+
+    return slib.get_conv_dict(tensor_shapes, tiling_dict, HOPTS, preloads=preload, d=d, s=s, thres=thres)
+
+def get_tensors(CONV, HOPTS, seed, pzero=[0,0,0]):
+    np.random.seed(seed)
+    return dh.generate_tensors(CONV, HOPTS, pzero=pzero)
+
+# Brute-force convolution (one kernel offset at a time, FP64) plus the preloads
+def conv_reference(A_tensor, B_tensor, C_tensor, s=1, d=1):
+
+    C_c, C_h, C_w = np.shape(C_tensor)
+    B_h, B_w = np.shape(B_tensor)[2:]
+    C_ref = np.asarray(C_tensor, dtype=np.float64).copy()
+
+    for ky in range(B_h):
+        for kx in range(B_w):
+            window = np.asarray(A_tensor, dtype=np.float64)[:, d*ky : d*ky + s*(C_h-1) + 1 : s, d*kx : d*kx + s*(C_w-1) + 1 : s]
+            C_ref += np.tensordot(np.asarray(B_tensor, dtype=np.float64)[:, :, ky, kx], window, axes=([1],[0]))
+
+    return C_ref
+
+@pytest.fixture(autouse=True)
+def no_golden_cache():
+    ex.configure_golden_cache(enabled=False, clear=True)
+    yield
+    ex.configure_golden_cache(enabled=False, clear=True)
+
+@pytest.fixture(params=['int8_8x16', 'FP16_8x16'])
+def HOPTS(request):
+    return hwv.get_params(request.param)
@@ -0,0 +1,655 @@
+import copy
+
+import numpy as np
+import pytest
+
+import src.sauria_lib as slib
+import src.hw_versions as hwv
+import src.execution_model as ex
+import src.config_helper as cfg
+import src.data_helper as dh
+from src.approx_comp.fp import FP_Madd
+
+from conftest import LAYERS, get_layer, get_tensors, conv_reference
+
+def get_mvm_dict(CONV, HOPTS):
+
+    SA_dict = slib.get_sa_dict(HOPTS)
+    for key in ['AB_c', 'B_w', 'B_h', 'C_w', 'C_h', 'C_c', 'A_w', 'A_h', 'd', 's', 'X_used', 'Y_used']:
+        SA_dict[key] = CONV[key]
+    SA_dict['B_k'] = CONV['C_c']
+    SA_dict['approx_comp'] = False
+
+    return SA_dict
+
+def run_golden(A_tensor, B_tensor, C_tensor, CONV, HOPTS, **kwargs):
+    return ex.get_ideal_results(A_tensor, B_tensor, C_tensor, CONV, HOPTS, slib.get_sa_dict(HOPTS), **kwargs)
+
+# ------------------------------------------------------
+# im2col: vectorized mapping vs. the scalar loops
+# ------------------------------------------------------
+
+@pytest.mark.parametrize('layer', LAYERS[:3])
+def test_im2col_strided_matches_reference(layer, HOPTS):
+
+    CONV = get_layer(layer, HOPTS)
+    A_tensor, B_tensor, C_tensor = get_tensors(CONV, HOPTS, seed=1)
+    data_type = 'FP' if (HOPTS['OP_TYPE']==1) else 'int'
+
+    SA_dict = get_mvm_dict(CONV, HOPTS)
+    results = {}
+    for mapping in ['reference', 'strided']:
+        results[mapping] = ex.map_conv_to_MVM(SA_dict, random_tensors=False, A_tensor=A_tensor, B_conv=B_tensor, preloads=C_tensor, data_type=data_type, mapping=mapping, sparse_mode='dense', silent=True)
+
+    # Per input vector underuse flags
+    _, _, X_flags_ref, Y_flags_ref = ex.im2col_reference(A_tensor, B_tensor, SA_dict)
+    _, _, X_flags_str, Y_flags_str = ex.im2col_strided(A_tensor, B_tensor, SA_dict)
+    assert np.array_equal(X_flags_ref, X_flags_str) and np.array_equal(Y_flags_ref, Y_flags_str)
+
+    N_ref, _, X_ref, Y_ref, C_ref, _, A_ref, B_ref = results['reference']
+    N_str, _, X_str, Y_str, C_str, _, A_str, B_str = results['strided']
+
+    assert N_ref == N_str
+    assert np.array_equal(A_ref, A_str.astype(A_ref.dtype))
+    assert np.array_equal(B_ref, B_str.astype(B_ref.dtype))
+    assert np.array_equal(X_ref, X_str) and np.array_equal(Y_ref, Y_str)
+    assert np.array_equal(C_ref, C_str)
+
+# ------------------------------------------------------
+# Bounded-memory MVM: chunks of iterations
+# ------------------------------------------------------
+
+@pytest.mark.parametrize('layer', LAYERS[:3])
+def test_chunked_mvm_matches_whole_layer(layer, HOPTS):
+
+    CONV = get_layer(layer, HOPTS)
+    A_tensor, B_tensor, C_tensor = get_tensors(CONV, HOPTS, seed=5)
+    data_type = 'FP' if (HOPTS['OP_TYPE']==1) else 'int'
+
+    results = {}
+    for max_mem_MB in [None, 0.001]:
+        SA_dict = get_mvm_dict(CONV, HOPTS)
+        results[max_mem_MB] = ex.map_conv_to_MVM(SA_dict, random_tensors=False, A_tensor=A_tensor, B_conv=B_tensor, preloads=C_tensor, data_type=data_type, max_mem_MB=max_mem_MB, sparse_mode='dense', silent=True)
+
+    _, _, X_whole, Y_whole, C_whole, _, _, _ = results[None]
+    _, N_iter, X_chunks, Y_chunks, C_chunks, C_ref, _, _ = results[0.001]
+
+    assert SA_dict['N_iter_chunk'] < N_iter
+    assert len(X_chunks) == int(np.ceil(N_iter/SA_dict['N_iter_chunk']))
+    assert (C_ref is None) and (SA_dict['check_points'] == C_chunks.size)
+    assert np.array_equal(C_whole, C_chunks)
+    assert (np.sum(X_whole) == np.sum(X_chunks)) and (np.sum(Y_whole) == np.sum(Y_chunks))
+
+def test_mvm_layout_range_round_trip(HOPTS):
+
+    SA_dict = get_mvm_dict(get_layer(LAYERS[1], HOPTS), HOPTS)
+    tensor = np.random.default_rng(6).standard_normal((SA_dict['C_c'], SA_dict['C_h'], SA_dict['C_w']))
+
+    Mat_mvm = ex.tensor_to_mvm(tensor, SA_dict)
+    N_iter = len(Mat_mvm)
+
+    tensor_out = np.zeros(tensor.shape)
+    for it_start in range(0, N_iter, 5):
+        it_stop = min(it_start+5, N_iter)
+        Mat_range = ex.tensor_to_mvm(tensor, SA_dict, iter_start=it_start, iter_stop=it_stop)
+        assert np.array_equal(Mat_range, Mat_mvm[it_start:it_stop])
+        ex.mvm_to_tensor(Mat_range, SA_dict, iter_start=it_start, tensor=tensor_out)
+
+    assert np.array_equal(tensor_out, tensor)
+
+# ------------------------------------------------------
+# Exact integer MVM
+# ------------------------------------------------------
+
+def test_int_operand_dtype_holds_range():
+
+    op_dtype, _ = ex.get_int_mvm_dtypes(np.array([128, -3]), np.array([-128, 5]), 1)
+    assert np.iinfo(op_dtype).max >= 128
+
+    op_dtype, _ = ex.get_int_mvm_dtypes(np.array([127, -128]), np.array([0, 1]), 1)
+    assert op_dtype == np.int8
+
+@pytest.mark.parametrize('max_value', [128, 2**26])
+def test_int_mvm_is_exact(max_value):
+
+    HOPTS = hwv.get_params('int8_8x16')
+    CONV = get_layer(LAYERS[0], HOPTS)
+    SA_dict = get_mvm_dict(CONV, HOPTS)
+
+    rng = np.random.default_rng(7)
+    A_tensor = rng.integers(-max_value, max_value+1, size=(CONV['AB_c'], CONV['A_h'], CONV['A_w']))
+    B_tensor = rng.integers(-max_value, max_value+1, size=(CONV['C_c'], CONV['AB_c'], CONV['B_h'], CONV['B_w']))
+    C_tensor = rng.integers(-max_value, max_value+1, size=(CONV['C_c'], CONV['C_h'], CONV['C_w']))
+    A_tensor.flat[0] = max_value
+
+    _, _, _, _, C_mvm, _, _, _ = ex.map_conv_to_MVM(SA_dict, random_tensors=False, A_tensor=A_tensor, B_conv=B_tensor, preloads=C_tensor, data_type='int', sparse_mode='dense', check_level='none', silent=True)
+
+    # int64 reference (no overflow for these ranges)
+    C_ref = C_tensor.copy()
+    for ky in range(CONV['B_h']):
+        for kx in range(CONV['B_w']):
+            C_ref += np.tensordot(B_tensor[:, :, ky, kx], A_tensor[:, ky:ky+CONV['C_h'], kx:kx+CONV['C_w']], axes=([1],[0]))
+
+    assert SA_dict['mvm_dtype'] == ('int64' if (max_value > 2**20) else 'float32')
+    assert (C_mvm.dtype == np.int64) and np.array_equal(C_mvm, C_ref)
+
+# ------------------------------------------------------
+# Golden model vs. a brute-force convolution
+# ------------------------------------------------------
+
+@pytest.mark.parametrize('layer', LAYERS)
+def test_golden_matches_baseline(layer, HOPTS):
+
+    CONV = get_layer(layer, HOPTS)
+    A_tensor, B_tensor, C_tensor = get_tensors(CONV, HOPTS, seed=2)
+
+    C_golden, _, _ = run_golden(A_tensor, B_tensor, C_tensor, CONV, HOPTS, sparse_mode='dense')
+    C_ref = conv_reference(A_tensor, B_tensor, C_tensor, CONV['s'], CONV['d'])
+
+    # Integers are exact, FP16 results are FP32 MVM results cast to FP16
+    if HOPTS['OP_TYPE']==1:
+        assert np.allclose(C_golden.astype(np.float64), C_ref, rtol=2**-10, atol=1e-3)
+    else:
+        assert np.array_equal(C_golden, C_ref.astype(HOPTS['intyp']))
+
+@pytest.mark.parametrize('layer', LAYERS[:2])
+def test_sparse_auto_matches_dense(layer, HOPTS):
+
+    CONV = get_layer(layer, HOPTS)
+    A_tensor, B_tensor, C_tensor = get_tensors(CONV, HOPTS, seed=2, pzero=[0.9,0.9,0])
+
+    SA_auto = slib.get_sa_dict(HOPTS)
+    C_auto, _, _ = ex.get_ideal_results(A_tensor, B_tensor, C_tensor, CONV, HOPTS, SA_auto, sparse_mode='auto')
+    C_dense, _, _ = run_golden(A_tensor, B_tensor, C_tensor, CONV, HOPTS, sparse_mode='dense')
+
+    # Sparse goldens are exact for integers only, FP stays on the dense MVM
+    assert SA_auto['mvm_backend'].startswith('dense' if (HOPTS['OP_TYPE']==1) else 'sparse')
+    assert np.array_equal(C_auto, C_dense)
+
+# ------------------------------------------------------
+# Hardware-faithful FP16 golden vs. the per-element FMA
+# ------------------------------------------------------
+
+@pytest.mark.parametrize('layer', [LAYERS[0], LAYERS[2]])
+@pytest.mark.parametrize('thres', [0, 2])
+def test_fp_hw_golden_is_bit_exact(layer, thres):
+
+    HOPTS = hwv.get_params('FP16_8x16')
+    CONV = get_layer(layer, HOPTS, thres=thres)
+    A_tensor, B_tensor, C_tensor = get_tensors(CONV, HOPTS, seed=11, pzero=[0.2,0.2,0])
+
+    C_golden, _, _ = run_golden(A_tensor, B_tensor, C_tensor, CONV, HOPTS, golden_mode='hw')
+
+    # Sequential FP_Madd of the PE (exact multiplier and adder), in the global [C_in, B_h, B_w]
+    # order with zero gating, at a sample of output positions
+    s, d = CONV['s'], CONV['d']
+    rng = np.random.default_rng(0)
+    for k, y, x in zip(*[rng.integers(n, size=16) for n in np.shape(C_golden)]):
+        acc = C_tensor[k, y, x]
+        for c, ky, kx in np.ndindex(*np.shape(B_tensor)[1:]):
+            a, b = A_tensor[c, y*s + ky*d, x*s + kx*d], B_tensor[k, c, ky, kx]
+            if (a != 0) and (b != 0) and ex.get_mac_gate(a, b, thres, FP=True):
+                _, _, acc = FP_Madd(a, b, acc, MANT_bits=HOPTS['IA_MANT'], N_bits=16, rounding=HOPTS['rounding'])
+
+        assert np.float16(acc).view(np.uint16) == C_golden[k, y, x].view(np.uint16)
+
+# ------------------------------------------------------
+# Approximate arithmetic: surrogate vs. bit-accurate samples
+# ------------------------------------------------------
+
+@pytest.mark.parametrize('layer', [
+    ([8, 16, 4, 8, 3, 3, 1, 1], [8, 16, 4, 8, 16, 8]),
+    ([16, 4, 4, 8, 3, 3, 1, 1], [16, 4, 4, 8, 4, 8]),
+])
+def test_approx_surrogate_matches_sampled(layer):
+
+    HOPTS = hwv.get_params('FP16_8x16')
+    HOPTS['approx_comp'] = True
+
+    CONV = get_layer(layer, HOPTS)
+    A_tensor, B_tensor, C_tensor = get_tensors(CONV, HOPTS, seed=7)
+
+    ERROR = ex.evaluate_approx_sampled(A_tensor, B_tensor, C_tensor, CONV, HOPTS, n_samples=128, seed=1)
+    k_idx, y_idx, x_idx = ERROR['positions']
+    exact = ERROR['exact']
+    nonzero = exact != 0
+
+    # Mean relative error of the surrogate at the same positions (C_out != C_in: every input channel injects errors)
+    TABLE = ex.get_approx_table(HOPTS, n_per_bin=64)
+    mred = []
+    for seed in range(3):
+        C_surr = ex.conv2d_approx_surrogate(A_tensor, B_tensor, C_tensor, TABLE, s=CONV['s'], d=CONV['d'], seed=seed)
+        C_surr = C_surr.astype(HOPTS['intyp']).astype(np.float64)[k_idx, y_idx, x_idx]
+        mred.append(np.mean(np.abs(C_surr - exact)[nonzero]/np.abs(exact[nonzero])))
+
+    assert 0.5*ERROR['MRED'] < np.mean(mred) < 2*ERROR['MRED']
+
+@pytest.mark.parametrize('thres', [0, 3])
+def test_approx_sampled_matches_bit_accurate_golden(thres):
+
+    HOPTS = hwv.get_params('FP16_8x16')
+    HOPTS['approx_comp'] = True
+
+    CONV = get_layer(([4, 8, 2, 4, 3, 3, 1, 1], [4, 8, 2, 4, 8, 4]), HOPTS, thres=thres)
+    A_tensor, B_tensor, C_tensor = get_tensors(CONV, HOPTS, seed=8)
+
+    # Scaled down so that many operands are negligible (exponent field < 2^thres)
+    A_tensor = (A_tensor*2**-6).astype(HOPTS['intyp'])
+    B_tensor = (B_tensor*2**-6).astype(HOPTS['intyp'])
+
+    C_golden, _, _ = run_golden(A_tensor, B_tensor, C_tensor, CONV, HOPTS)
+    ERROR = ex.evaluate_approx_sampled(A_tensor, B_tensor, C_tensor, CONV, HOPTS, n_samples=32, seed=1)
+
+    # Same MACs gated by the zero detectors as the bit-accurate MVM
+    k_idx, y_idx, x_idx = ERROR['positions']
+    assert np.array_equal(ERROR['approx'], C_golden[k_idx, y_idx, x_idx].astype(np.float64))
+
+# ------------------------------------------------------
+# Cycle-accurate partial MACs
+# ------------------------------------------------------
+
+# Scalar loops of the PE accumulation (zero gating, preload at step 0)
+def partial_macs_reference(C_pre, A_Mats, B_Mats, intyp):
+
+    N_cswitch, N_values, Y_used = np.shape(A_Mats)
+    X_used = np.shape(B_Mats)[2]
+
+    macs = np.zeros((N_cswitch, N_values+1, X_used, Y_used), dtype=intyp)
+    macs[:,0] = C_pre
+    for ctx in range(N_cswitch):
+        for t in range(N_values):
+            for x in range(X_used):
+                for y in range(Y_used):
+                    a, b = A_Mats[ctx, t, y], B_Mats[ctx, t, x]
+                    macs[ctx, t+1, x, y] = macs[ctx, t, x, y] + a*b if (a != 0) and (b != 0) else macs[ctx, t, x, y]
+
+    return macs
+
+@pytest.mark.parametrize('layer', LAYERS[:2])
+def test_partial_macs_match_scalar_loops(layer, HOPTS):
+
+    CONV = get_layer(layer, HOPTS)
+    A_tensor, B_tensor, C_tensor = get_tensors(CONV, HOPTS, seed=3, pzero=[0.3,0.3,0])
+
+    C_macs, partial_macs, _ = run_golden(A_tensor, B_tensor, C_tensor, CONV, HOPTS, compute_macs=True)
+    C_golden, _, _ = run_golden(A_tensor, B_tensor, C_tensor, CONV, HOPTS, sparse_mode='dense')
+
+    macs, _, (A_Mats, B_Mats) = partial_macs
+    for n in range(len(macs)):
+        ref = partial_macs_reference(macs[n][:,0], A_Mats[n], B_Mats[n], HOPTS['intyp'])
+        assert np.array_equal(macs[n], ref)
+
+    if HOPTS['OP_TYPE']==1:
+        assert np.allclose(C_macs.astype(np.float64), C_golden.astype(np.float64), rtol=2**-8, atol=0.5)
+    else:
+        assert np.array_equal(C_macs, C_golden)
+
+def test_parallel_tile_chains_match_serial(HOPTS):
+
+    CONV = get_layer(LAYERS[0], HOPTS)
+    A_tensor, B_tensor, C_tensor = get_tensors(CONV, HOPTS, seed=4)
+
+    C_serial, macs_serial, _ = run_golden(A_tensor, B_tensor, C_tensor, CONV, HOPTS, compute_macs=True, macs_workers=1)
+    C_parallel, macs_parallel, _ = run_golden(A_tensor, B_tensor, C_tensor, CONV, HOPTS, compute_macs=True, macs_workers=3)
+
+    assert np.array_equal(C_serial, C_parallel)
+    for serial, parallel in zip(macs_serial[:2], macs_parallel[:2]):
+        assert len(serial) == len(parallel)
+        assert all(np.array_equal(a, b) for a, b in zip(serial, parallel))
+
+def test_tile_chains_bypass_golden_cache(HOPTS):
+
+    CONV = get_layer(LAYERS[0], HOPTS)
+    A_tensor, B_tensor, C_tensor = get_tensors(CONV, HOPTS, seed=5)
+
+    ex.configure_golden_cache(enabled=True, clear=True)
+    C_macs, _, _ = run_golden(A_tensor, B_tensor, C_tensor, CONV, HOPTS, compute_macs=True, golden_mode='hw')
+    assert ex.get_golden_cache_stats()['mem_entries'] == 0
+
+    C_golden, _, _ = run_golden(A_tensor, B_tensor, C_tensor, CONV, HOPTS, golden_mode='hw')
+    assert np.array_equal(C_macs, C_golden)
+
+def test_golden_cache_reports_cached_check(HOPTS):
+
+    CONV = get_layer(LAYERS[0], HOPTS)
+    A_tensor, B_tensor, C_tensor = get_tensors(CONV, HOPTS, seed=6)
+
+    ex.configure_golden_cache(enabled=True, clear=True)
+    run_golden(A_tensor, B_tensor, C_tensor, CONV, HOPTS, check_level='none')
+
+    SA_dict = slib.get_sa_dict(HOPTS)
+    ex.get_ideal_results(A_tensor, B_tensor, C_tensor, CONV, HOPTS, SA_dict, check_level='full')
+    assert SA_dict['golden_cache'] == 'miss'
+    assert (SA_dict['check_level'] == 'full') and (SA_dict['check_points'] > 0)
+
+    # A hit does not check the golden model again
+    SA_dict = slib.get_sa_dict(HOPTS)
+    ex.get_ideal_results(A_tensor, B_tensor, C_tensor, CONV, HOPTS, SA_dict, check_level='full')
+    assert SA_dict['golden_cache'] == 'mem'
+    assert (SA_dict['check_level'] == 'cached') and (SA_dict['check_points'] == 'cached')
+
+def test_golden_cache_key_follows_model_version(HOPTS, monkeypatch):
+
+    CONV = get_layer(LAYERS[0], HOPTS)
+    A_tensor, B_tensor, C_tensor = get_tensors(CONV, HOPTS, seed=6)
+
+    ex.configure_golden_cache(enabled=True, clear=True)
+    run_golden(A_tensor, B_tensor, C_tensor, CONV, HOPTS)
+
+    monkeypatch.setattr(ex, 'GOLDEN_MODEL_VERSION', ex.GOLDEN_MODEL_VERSION + 1)
+
+    SA_dict = slib.get_sa_dict(HOPTS)
+    ex.get_ideal_results(A_tensor, B_tensor, C_tensor, CONV, HOPTS, SA_dict)
+    assert SA_dict['golden_cache'] == 'miss'
+
+# ------------------------------------------------------
+# Tile iterator: DRAM offsets and weight packing
+# ------------------------------------------------------
+
+RAGGED_LAYERS = [
+    ([11, 13, 9, 10, 3, 3, 1, 1], [4, 8, 4, 4, 8, 4]),
+    ([10, 16, 8, 12, 3, 3, 1, 2], [4, 16, 8, 8, 16, 8]),
+]
+
+@pytest.mark.parametrize('layer', LAYERS + RAGGED_LAYERS)
+def test_tile_offsets_follow_controller_strides(layer, HOPTS):
+
+    CONV = get_layer(layer, HOPTS)
+    A_tensor, B_tensor, C_tensor = get_tensors(CONV, HOPTS, seed=8)
+
+    job_base = {}
+    for TILE in ex.iterate_tiles(CONV, tensors=[A_tensor, B_tensor, C_tensor], HYPER=HOPTS):
+        c, k, w, h = TILE['idx']
+        A_offs, B_offs, C_offs = TILE['dram_offsets']
+
+        # Controller address generation: first tile of the job + local tile index x tile strides
+        if 'CONV_job' in TILE:
+            job_base[TILE['job']] = (TILE['idx'], TILE['dram_offsets'], cfg.get_tile_strides(TILE['CONV_job'], WXfer_op=True, CONV_full=CONV))
+        (c0, k0, w0, h0), (A_base, B_base, C_base), STRIDES = job_base[TILE['job']]
+
+        assert A_offs == A_base + (c-c0)*STRIDES['tile_ifmaps_c_step'] + (h-h0)*STRIDES['tile_ifmaps_y_step'] + (w-w0)*STRIDES['tile_ifmaps_x_step']
+        assert B_offs == B_base + (k-k0)*STRIDES['tile_weights_k_step'] + (c-c0)*STRIDES['tile_weights_c_step']
+        assert C_offs == C_base + (k-k0)*STRIDES['tile_psums_k_step'] + (h-h0)*STRIDES['tile_psums_y_step'] + (w-w0)*STRIDES['tile_psums_x_step']
+
+        # The views start at the offsets
+        assert A_tensor.ravel()[A_offs] == TILE['A'][0,0,0]
+        assert C_tensor.ravel()[C_offs] == TILE['C'][0,0,0]
+
+    assert len(job_base) == len(ex.get_conv_jobs(CONV))
+
+@pytest.mark.parametrize('layer', LAYERS + RAGGED_LAYERS)
+def test_weight_packer_matches_layout(layer, HOPTS):
+
+    CONV = get_layer(layer, HOPTS)
+    _, B_tensor, _ = get_tensors(CONV, HOPTS, seed=9)
+
+    if CONV['jobs'] is None:
+        B_layout = dh.optimize_weight_tensor_shape(B_tensor, CONV).flatten()
+    else:
+        B_layout = dh.optimize_ragged_weight_tensor_shape(B_tensor, CONV)
+
+    assert np.array_equal(ex.pack_weight_tiles(B_tensor, CONV), B_layout)
+
+# ------------------------------------------------------
+# DRAM traffic: loop-order model vs. the controller nest
+# ------------------------------------------------------
+
+TRAFFIC_LAYERS = [
+    ([8, 32, 8, 16, 3, 3, 1, 1], [4, 16, 4, 8, 16, 8]),
+    ([8, 32, 4, 8, 3, 3, 1, 1], [4, 16, 4, 8, 16, 8]),
+    ([8, 32, 8, 16, 1, 1, 1, 1], [8, 16, 4, 8, 16, 8]),
+]
+
+# Tile loads of the df_controller (sauria_dma_pointer_generator.sv): the level conditions
+# of each loop order and the change flags of the tensors indexed by the advancing levels.
+# Psums are read on a load unless it is the first visit of the tile without preloads
+def rtl_tile_loads(CONV, loop_order):
+
+    lim = {'x' : CONV['C_w']//CONV['w_til'] - 1, 'y' : CONV['C_h']//CONV['h_til'] - 1,
+           'c' : CONV['AB_c']//CONV['c_til'] - 1, 'k' : CONV['C_c']//CONV['k_til'] - 1}
+    cnt = {key : 0 for key in lim}
+
+    loads = {'A' : 1, 'B' : 1, 'C' : 1}
+    C_reads = 1 if CONV['preload_en'] else 0
+    visited = {(0, 0, 0)}
+
+    for _ in range(int(np.prod([l+1 for l in lim.values()])) - 1):
+        ovf = {key : cnt[key] == lim[key] for key in lim}
+
+        if loop_order == 0:
+            spatial_cond, c_cond = True, ovf['x'] and ovf['y']
+            k_cond = c_cond and ovf['c']
+        elif loop_order == 1:
+            c_cond, k_cond = True, ovf['c']
+            spatial_cond = k_cond and ovf['k']
+        else:
+            k_cond, c_cond = True, ovf['k']
+            spatial_cond = c_cond and ovf['c']
+
+        change = set()
+        if spatial_cond:
+            if lim['x'] or lim['y']: change |= {'A', 'C'}
+            if ovf['x']: cnt['y'] = 0 if ovf['y'] else cnt['y'] + 1
+            cnt['x'] = 0 if ovf['x'] else cnt['x'] + 1
+        if c_cond:
+            if lim['c']: change |= {'A', 'B'}
+            cnt['c'] = 0 if ovf['c'] else cnt['c'] + 1
+        if k_cond:
+            if lim['k']: change |= {'B', 'C'}
+            cnt['k'] = 0 if ovf['k'] else cnt['k'] + 1
+
+        for tensor in change:
+            loads[tensor] += 1
+
+        tile = (cnt['x'], cnt['y'], cnt['k'])
+        if ('C' in change) and (CONV['preload_en'] or (tile in visited)):
+            C_reads += 1
+        visited.add(tile)
+
+    return loads, C_reads
+
+@pytest.mark.parametrize('preload', [True, False])
+@pytest.mark.parametrize('loop_order', list(ex.LOOP_ORDER_NESTS))
+@pytest.mark.parametrize('layer', TRAFFIC_LAYERS)
+def test_loop_order_traffic_matches_controller(layer, loop_order, preload, HOPTS):
+
+    CONV = get_layer(layer, HOPTS, preload=preload)
+    TRAFFIC = ex.get_loop_order_traffic(CONV, HOPTS, loop_order)
+    loads, C_reads = rtl_tile_loads(CONV, loop_order)
+
+    assert [TRAFFIC['A_loads'], TRAFFIC['B_loads'], TRAFFIC['C_loads']] == [loads['A'], loads['B'], loads['C']]
+    assert TRAFFIC['C_rd_bytes']*loads['C'] == TRAFFIC['C_wr_bytes']*C_reads
+
+# ------------------------------------------------------
+# Zero detectors: skipped MACs and negligence error
+# ------------------------------------------------------
+
+@pytest.mark.parametrize('thres', [0, 2])
+def test_negligence_stats_count_skipped_macs(thres, HOPTS):
+
+    CONV = get_layer(LAYERS[0], HOPTS, thres=thres)
+    A_tensor, B_tensor, C_tensor = get_tensors(CONV, HOPTS, seed=7, pzero=[0.3, 0.3, 0])
+    C_golden, _, _ = run_golden(A_tensor, B_tensor, C_tensor, CONV, HOPTS)
+
+    STATS = ex.get_negligence_stats(A_tensor, B_tensor, C_golden, CONV, HOPTS, zero_stats=True)
+
+    # MACs with a zero operand / both operands negligible, counted one output at a time
+    FP = (HOPTS['OP_TYPE'] == 1)
+    A_nz = (A_tensor != 0)
+    B_nz = (B_tensor != 0)
+    A_neg = ex.get_negligible_mask(A_tensor, thres, FP) & A_nz
+    B_neg = ex.get_negligible_mask(B_tensor, thres, FP) & B_nz
+    count_macs = lambda A_mask, B_mask: np.sum(conv_reference(A_mask.astype(np.float64), B_mask.astype(np.float64), np.zeros(np.shape(C_golden)), CONV['s'], CONV['d']))
+
+    assert STATS['macs_total'] == C_golden.size*B_tensor[0].size
+    assert STATS['macs_zero_skipped'] == STATS['macs_total'] - count_macs(A_nz, B_nz)
+    assert STATS['macs_neglected'] == (count_macs(A_neg, B_neg) if (thres > 0) else 0)
+
+def test_negligence_stats_without_threshold_skip_convolutions(HOPTS, monkeypatch):
+
+    CONV = get_layer(LAYERS[0], HOPTS, thres=0)
+    A_tensor, B_tensor, C_tensor = get_tensors(CONV, HOPTS, seed=7)
+    C_golden, _, _ = run_golden(A_tensor, B_tensor, C_tensor, CONV, HOPTS)
+
+    def no_convolution(*args, **kwargs):
+        raise AssertionError("No convolution expected without threshold or zero stats")
+    monkeypatch.setattr(ex, 'conv2d_numpy', no_convolution)
+    monkeypatch.setattr(ex, 'get_neglected_products', no_convolution)
+
+    STATS = ex.get_negligence_stats(A_tensor, B_tensor, C_golden, CONV, HOPTS)
+
+    assert (STATS['macs_neglected'] == 0) and (STATS['neglect_errors'] == 0) and (STATS['neglect_max_error'] == 0)
+    assert 'macs_zero_skipped' not in STATS
+
+# ------------------------------------------------------
+# Cycle model: vectorized prediction and calibration
+# ------------------------------------------------------
+
+def test_vectorized_cycle_prediction_matches_layers(HOPTS):
+
+    CONVS = [get_layer(layer, HOPTS) for layer in LAYERS]
+    keys = ['A_w', 'A_h', 'C_w', 'C_h', 'C_c', 'AB_c', 'B_w', 'B_h', 'd', 's', 'w_til', 'h_til', 'c_til', 'k_til', 'A_w_til', 'A_h_til', 'X_used', 'Y_used']
+    CONV_vec = {key : np.array([CONV[key] for CONV in CONVS]) for key in keys}
+
+    for loop_order in ex.LOOP_ORDER_NESTS:
+        predicted = ex.predict_cycles(CONV_vec, HOPTS, loop_order)['total_cycles']
+        assert np.allclose(predicted, [ex.predict_cycles(CONV, HOPTS, loop_order)['total_cycles'] for CONV in CONVS])
+
+def test_calibration_recovers_cycle_model(HOPTS):
+
+    # Simulations replaced by the model itself with other coefficients
+    TRUE_COEFS = {
+        'stalls' :  {'act' : 0.5, 'wei' : 2.0, 'cswitch' : 1.5, 'const' : 3.0},
+        'tile' :    {'compute' : 1.0, 'contexts' : 3.0, 'fill' : 0.5, 'act' : 1.5, 'wei' : 0.5, 'cswitch' : 2.0, 'const' : 4.0},
+        'total' :   {'tiles' : 1.0, 'dma' : 0.25, 'dma_exposed' : 1.0, 'dma_cmds' : 5.0, 'tile_overhead' : 12.0, 'const' : 300.0},
+    }
+    samples = []
+    for layer in LAYERS:
+        for preload in [True, False]:
+            CONV = get_layer(layer, HOPTS, preload=preload)
+            samples.append((CONV, HOPTS, ex.predict_conv_cycles(CONV, HOPTS, coefs=TRUE_COEFS)))
+
+    coefs, REPORT = ex.calibrate_cycle_model(samples)
+
+    assert REPORT['N_samples'] == len(samples)
+    for stats_key in ex.CYCLE_MODEL_TARGETS.values():
+        assert REPORT[stats_key]['before']['max_rel_error'] > 1e-3
+        assert REPORT[stats_key]['after']['max_rel_error'] < 1e-9
+
+    # Coefficients of the total time are identifiable from these layers
+    assert all(coefs['total'][key] == pytest.approx(val) for key, val in TRUE_COEFS['total'].items())
+
+# ------------------------------------------------------
+# Operand-toggle power proxy
+# ------------------------------------------------------
+
+# Scalar loops of the PE registers: operands are loaded only by computed MACs, the
+# propagation registers see every value, and the accumulator every partial sum
+def tile_toggles_reference(macs, A_Mats, B_Mats, thres, HOPTS):
+
+    N_cswitch, N_values, Y_used = np.shape(A_Mats)
+    X_used = np.shape(B_Mats)[2]
+    FP = (HOPTS['OP_TYPE'] == 1)
+
+    bits = lambda v, w: int(np.float16(v).view(np.uint16)) if FP else (int(v) & ((1 << w) - 1))
+    toggles = lambda old, new: bin(old ^ new).count('1')
+
+    REF = {reg : np.zeros((X_used, Y_used), dtype=np.int64) for reg in ex.TOGGLE_REGS + ['macs']}
+    acc_seq = np.reshape(macs, (-1, X_used, Y_used))
+
+    for x in range(X_used):
+        for y in range(Y_used):
+            A_reg, B_reg, A_prop, B_prop, acc = 0, 0, 0, 0, 0
+
+            for ctx in range(N_cswitch):
+                for t in range(N_values):
+                    a, b = A_Mats[ctx, t, y], B_Mats[ctx, t, x]
+                    A_bits, B_bits = bits(a, HOPTS['IA_W']), bits(b, HOPTS['IB_W'])
+
+                    REF['prop'][x, y] += toggles(A_prop, A_bits) + toggles(B_prop, B_bits)
+                    A_prop, B_prop = A_bits, B_bits
+
+                    if ex.get_mac_gate(a, b, thres, FP):
+                        REF['A'][x, y] += toggles(A_reg, A_bits)
+                        REF['B'][x, y] += toggles(B_reg, B_bits)
+                        REF['macs'][x, y] += 1
+                        A_reg, B_reg = A_bits, B_bits
+
+            for value in acc_seq[:, x, y]:
+                REF['acc'][x, y] += toggles(acc, bits(value, HOPTS['OC_W']))
+                acc = bits(value, HOPTS['OC_W'])
+
+    return REF
+
+@pytest.mark.parametrize('thres', [0, 2])
+def test_toggle_counts_match_scalar_loops(thres, HOPTS):
+
+    CONV = get_layer(LAYERS[1], HOPTS, thres=thres)
+    A_tensor, B_tensor, C_tensor = get_tensors(CONV, HOPTS, seed=14, pzero=[0.3,0.3,0])
+
+    _, partial_macs, _ = run_golden(A_tensor, B_tensor, C_tensor, CONV, HOPTS, compute_macs=True)
+    macs, _, (A_Mats, B_Mats) = partial_macs
+
+    for n in range(len(macs)):
+        TOGGLES = ex.get_tile_toggles(macs[n], [A_Mats[n], B_Mats[n]], CONV, HOPTS)
+        REF = tile_toggles_reference(macs[n], A_Mats[n], B_Mats[n], thres, HOPTS)
+
+        for reg in ex.TOGGLE_REGS + ['macs']:
+            assert np.array_equal(TOGGLES[reg], REF[reg])
+
+    # Layer activity: every step of a used PE is a computed or a zero-gated MAC
+    ACT = ex.get_toggle_activity([partial_macs], CONV, HOPTS)
+    steps = sum(np.size(A_Mats[n][:, :, 0]) for n in range(len(macs)))
+
+    assert ACT['steps'] == steps
+    assert ACT['macs_computed'] + ACT['macs_gated'] == steps*CONV['X_used']*CONV['Y_used']
+    assert np.all(ACT['heatmap'][CONV['X_used']:] == 0) and np.all(ACT['heatmap'][:, CONV['Y_used']:] == 0)
+    assert 0 < ACT['activity_factor'] < 1
+
+# ------------------------------------------------------
+# PE utilization: where the peak throughput is lost
+# ------------------------------------------------------
+
+def test_utilization_split_of_known_layers():
+
+    HOPTS = hwv.get_params('int8_8x16')
+    X, Y = HOPTS['X'], HOPTS['Y']
+
+    # 4x4 block of the 16x8 array: 2 c tiles x 12 contexts x 27 reduction steps
+    CONV = get_layer(LAYERS[1], HOPTS)
+    REPORT = ex.get_utilization_report(CONV, HOPTS)
+
+    assert REPORT['steps'] == 2*12*27
+    assert REPORT['util_mapped'] == REPORT['util_effective'] == pytest.approx(16/128)
+    assert REPORT['loss_spatial'] == pytest.approx(112/128)
+    assert REPORT['loss_edge'] == REPORT['loss_gated'] == 0
+
+    # Ragged layer: main tiles use a 10x4 block, the edge job (3 output columns) a 10x3
+    # block. Each job has 7 contexts of 63 steps
+    CONV = get_layer(([7, 10, 7, 7, 3, 3, 1, 1], [7, 10, 7, 7, 10, 4]), HOPTS)
+    REPORT = ex.get_utilization_report(CONV, HOPTS)
+
+    assert REPORT['steps'] == 2*7*63
+    assert REPORT['util_mapped'] == pytest.approx(70/256)
+    assert REPORT['loss_edge'] == pytest.approx(10/256)
+    assert REPORT['loss_spatial'] == pytest.approx(176/256)
+
+    mapped = np.zeros((X, Y), dtype=np.int64)
+    mapped[:10, :3] = 2*7*63
+    mapped[:10, 3] = 7*63
+    assert np.array_equal(REPORT['heatmap_mapped'], mapped)
+
+@pytest.mark.parametrize('thres', [0, 2])
+def test_utilization_counts_gated_macs(thres, HOPTS):
+
+    CONV = get_layer(([7, 10, 7, 7, 3, 3, 1, 1], [7, 10, 7, 7, 10, 4]), HOPTS, thres=thres)
+    A_tensor, B_tensor, C_tensor = get_tensors(CONV, HOPTS, seed=15, pzero=[0.3,0.3,0])
+    C_golden, _, _ = run_golden(A_tensor, B_tensor, C_tensor, CONV, HOPTS)
+
+    REPORT = ex.get_utilization_report(CONV, HOPTS, A_tensor, B_tensor)
+    STATS = ex.get_negligence_stats(A_tensor, B_tensor, C_golden, CONV, HOPTS, zero_stats=True)
+
+    # Every mapped slot is a MAC of the layer, computed or skipped by the zero detectors
+    assert np.sum(REPORT['heatmap_mapped']) == STATS['macs_total']
+    assert np.sum(REPORT['heatmap_macs']) == STATS['macs_total'] - STATS['macs_zero_skipped'] - STATS['macs_neglected']
+    assert REPORT['util_effective'] + REPORT['loss_spatial'] + REPORT['loss_edge'] + REPORT['loss_gated'] == pytest.approx(1)
@@ -0,0 +1,241 @@
+import itertools
+
+import numpy as np
+import pytest
+
+import src.sauria_lib as slib
+import src.execution_model as ex
+import src.data_helper as dh
+
+from conftest import LAYERS, get_layer, get_tensors, conv_reference
+
+# ------------------------------------------------------
+# Edge tiles: array use that does not divide the tiles
+# ------------------------------------------------------
+
+# Tiles cut to a multiple of the array use: [layer, tiling], main [k_til, w_til]
+CUT_LAYERS = [
+    (([7, 10, 7, 7, 3, 3, 1, 1], [7, 10, 7, 7, 10, 4]), [10, 4]),
+    (([7, 10, 7, 7, 3, 3, 1, 1], [7, 10, 7, 7, 4, 4]), [8, 4]),
+    (([6, 24, 4, 14, 3, 3, 1, 1], [6, 12, 4, 7, 8, 2]), [8, 6]),
+]
+
+@pytest.mark.parametrize('layer, main_tiles', CUT_LAYERS)
+def test_edge_tiles_keep_requested_array_use(layer, main_tiles, HOPTS):
+
+    CONV = get_layer(layer, HOPTS)
+    X_used, Y_used = layer[1][4:]
+
+    # Main tiles (and the layer) use the requested columns / rows of the array
+    assert [CONV['X_used'], CONV['Y_used']] == [X_used, Y_used]
+    assert [CONV['k_til'], CONV['w_til']] == main_tiles
+    assert [CONV['jobs'][0]['CONV']['X_used'], CONV['jobs'][0]['CONV']['Y_used']] == [X_used, Y_used]
+
+    # Every job divides its tiles, and only edge jobs use less of the array
+    for JOB in CONV['jobs']:
+        CONV_job = JOB['CONV']
+        assert (CONV_job['k_til']%CONV_job['X_used'] == 0) and (CONV_job['w_til']%CONV_job['Y_used'] == 0)
+        assert (CONV_job['X_used'] == X_used) or (CONV_job['k_til'] < main_tiles[0])
+        assert (CONV_job['Y_used'] == Y_used) or (CONV_job['w_til'] < main_tiles[1])
+
+    A_tensor, B_tensor, C_tensor = get_tensors(CONV, HOPTS, seed=10)
+    C_golden, _, _ = ex.get_ideal_results(A_tensor, B_tensor, C_tensor, CONV, HOPTS, slib.get_sa_dict(HOPTS), compute_macs=True)
+    C_ref = conv_reference(A_tensor, B_tensor, C_tensor, CONV['s'], CONV['d'])
+
+    assert np.allclose(C_golden.astype(np.float64), C_ref, rtol=2**-8, atol=0.5)
+
+def test_array_use_larger_than_tile_raises(HOPTS):
+
+    with pytest.raises(AssertionError):
+        get_layer(([8, 16, 4, 16, 3, 3, 1, 1], [8, 16, 4, 4, 16, 8]), HOPTS)
+
+# ------------------------------------------------------
+# Automatic tiling: legality and ranking
+# ------------------------------------------------------
+
+# [A, B, C] tensor shapes whose tiles all divide the tensors (no ragged candidates)
+OPT_SHAPES = [[8, 10, 10], [16, 8, 3, 3], [16, 8, 8]]
+
+# Every tiling that get_conv_dict accepts: (tile_cin, k_til, h_til, w_til, X_used, Y_used)
+def get_legal_tilings(tensor_shapes, HOPTS):
+
+    TILINGS = []
+    for c_til, k_til, h_til, w_til in itertools.product(*[slib.get_divisors(n) for n in [tensor_shapes[1][1]] + tensor_shapes[2]]):
+        for X_used, Y_used in itertools.product(range(1, HOPTS['X']+1), range(1, HOPTS['Y']+1)):
+            tiling = {'C_tile_shape': [int(k_til), int(h_til), int(w_til)], 'tile_cin': int(c_til), 'X_used': X_used, 'Y_used': Y_used}
+            if (k_til%X_used != 0) or (w_til%Y_used != 0):
+                continue
+            try:
+                CONV = slib.get_conv_dict(tensor_shapes, tiling, HOPTS, preloads=1, d=1, s=1)
+            except AssertionError:
+                continue
+            TILINGS.append((tiling, CONV))
+
+    return TILINGS
+
+def tiling_key(tiling):
+    return (tiling['tile_cin'], *tiling['C_tile_shape'], tiling['X_used'], tiling['Y_used'])
+
+def test_optimizer_finds_all_legal_tilings(HOPTS):
+
+    # Small memories, so that many tilings do not fit
+    HOPTS = dict(HOPTS, MEMA_size=300, MEMB_size=400, MEMC_size=256)
+
+    TILINGS = slib.optimize_tiling(OPT_SHAPES, 1, 1, HOPTS, top_n=None)
+    LEGAL = get_legal_tilings(OPT_SHAPES, HOPTS)
+
+    assert set(tiling_key(t) for t in TILINGS) == set(tiling_key(t) for t, _ in LEGAL)
+
+    # Ranked by predicted cycles, then DRAM traffic; the best one is the fastest legal tiling
+    ranks = [(t['predicted_cycles'], t['dram_bytes']) for t in TILINGS]
+    assert ranks == sorted(ranks)
+    assert TILINGS[0]['predicted_cycles'] == pytest.approx(min(ex.predict_conv_cycles(CONV, HOPTS)['total_cycles'] for _, CONV in LEGAL))
+
+def test_optimizer_respects_register_widths(HOPTS):
+
+    # Output index field too narrow for the whole output tensor
+    HOPTS = dict(HOPTS, PSM_IDX_W=8)
+
+    TILINGS = slib.optimize_tiling(OPT_SHAPES, 1, 1, HOPTS, top_n=None)
+
+    assert len(TILINGS) > 0
+    assert all(np.prod(t['C_tile_shape']) < 2**8 for t in TILINGS)
+
+def test_optimizer_without_legal_tiling_raises(HOPTS):
+
+    with pytest.raises(AssertionError):
+        slib.optimize_tiling(OPT_SHAPES, 1, 1, dict(HOPTS, MEMB_size=8), top_n=1)
+
+# ------------------------------------------------------
+# Automatic tiling: ragged candidates
+# ------------------------------------------------------
+
+# [A, B, C] tensor shapes whose output channels are not a multiple of the array columns
+RAGGED_SHAPES = [
+    [[64, 30, 30], [28, 64, 3, 3], [28, 28, 28]],
+    [[3, 34, 34], [20, 3, 3, 3], [20, 32, 32]],
+]
+
+@pytest.mark.parametrize('tensor_shapes', RAGGED_SHAPES)
+def test_optimizer_scores_ragged_tilings_with_edge_jobs(tensor_shapes, HOPTS):
+
+    TILINGS = slib.optimize_tiling(tensor_shapes, 1, 1, HOPTS, top_n=5)
+
+    # Full array columns on the main tiles + an edge job beats the divisor tilings
+    assert TILINGS[0]['jobs'] > 1
+    assert TILINGS[0]['X_used'] == HOPTS['X']
+
+    # The score of every tiling is the cost of the jobs it is executed as
+    for TILING in TILINGS:
+        CONV = slib.get_conv_dict(tensor_shapes, TILING, HOPTS, preloads=1, d=1, s=1)
+        assert len(ex.get_conv_jobs(CONV)) == TILING['jobs']
+        assert TILING['predicted_cycles'] == pytest.approx(ex.predict_conv_cycles(CONV, HOPTS)['total_cycles'])
+
+# ------------------------------------------------------
+# GEMM lowered to a 1x1 convolution
+# ------------------------------------------------------
+
+# [M, K, N], with and without bias
+MATMUL_SHAPES = [([12, 16, 24], True), ([5, 8, 32], False), ([32, 6, 3], True)]
+
+@pytest.mark.parametrize('shape, bias', MATMUL_SHAPES)
+def test_matmul_mappings_match_reference(shape, bias, HOPTS):
+
+    M, K, N = shape
+    rng = np.random.default_rng(12)
+    A_mat = rng.integers(-8, 8, size=(M, K)).astype(HOPTS['intyp'])
+    B_mat = rng.integers(-8, 8, size=(K, N)).astype(HOPTS['intyp'])
+    bias_vec = rng.integers(-8, 8, size=N).astype(HOPTS['intyp']) if bias else None
+
+    C_ref = A_mat.astype(np.float64) @ B_mat.astype(np.float64) + (0 if (bias_vec is None) else bias_vec)
+
+    MAPPINGS = slib.get_matmul_mapping(M, K, N, HOPTS, top_n=None)
+    assert set(m['out_dim'] for m in MAPPINGS) == {'N', 'M'}
+
+    # Every orientation and folding of the GEMM computes the same matrix
+    for MAPPING in MAPPINGS:
+        A_tensor, B_tensor, C_preload = slib.matmul_to_conv(A_mat, B_mat, bias_vec, MAPPING)
+        CONV = slib.get_conv_dict(MAPPING['tensor_shapes'], MAPPING['tiling'], HOPTS, preloads=bias, d=1, s=1)
+
+        C_golden, _, _ = ex.get_ideal_results(A_tensor, B_tensor, C_preload.astype(HOPTS['intyp']), CONV, HOPTS, slib.get_sa_dict(HOPTS))
+        assert np.array_equal(slib.conv_to_matmul(C_golden, MAPPING).astype(np.float64), C_ref)
+
+    # Fewest predicted cycles first, and the aligned flag follows the feeder alignment
+    assert [m['predicted_cycles'] for m in MAPPINGS] == sorted(m['predicted_cycles'] for m in MAPPINGS)
+    for MAPPING in MAPPINGS:
+        CONV = slib.get_conv_dict(MAPPING['tensor_shapes'], MAPPING['tiling'], HOPTS, preloads=bias, d=1, s=1)
+        assert MAPPING['aligned'] == ((CONV['c_til']%HOPTS['MEMA_N'] == 0) and (CONV['Y_used']%HOPTS['MEMA_N'] == 0))
+
+# ------------------------------------------------------
+# Batch: DRAM layout of the images
+# ------------------------------------------------------
+
+@pytest.mark.parametrize('layer', [LAYERS[0], LAYERS[2]])
+def test_batch_dram_holds_images_back_to_back(layer, HOPTS):
+
+    batch = 3
+    CONV = get_layer(layer, HOPTS)
+    A_tensor, B_tensor, C_preload = dh.generate_tensors(CONV, HOPTS, pzero=[0.1,0.1,0], batch=batch)
+
+    assert (np.shape(A_tensor)[0] == batch) and (np.shape(C_preload)[0] == batch) and (np.ndim(B_tensor) == 4)
+
+    C_golden = np.stack([ex.get_ideal_results(A_tensor[n], B_tensor, C_preload[n], CONV, HOPTS, slib.get_sa_dict(HOPTS))[0] for n in range(batch)])
+    B_tensor_opt = ex.pack_weight_tiles(B_tensor, CONV)
+
+    DRAM_mem, DRAM_mem_gold, offsets = dh.assign_dram_values(A_tensor, B_tensor_opt, C_preload, C_golden, 0, CONV, HOPTS)
+
+    # Every image is where a single-image run would have it, and the weights are staged once
+    for n in range(batch):
+        DRAM_image, DRAM_image_gold, image_offsets = dh.assign_dram_values(A_tensor[n], B_tensor_opt, C_preload[n], C_golden[n], 0, CONV, HOPTS)
+        A_bytes = image_offsets[1] - image_offsets[0]
+        B_bytes = image_offsets[2] - image_offsets[1]
+        C_bytes = image_offsets[3] - image_offsets[2]
+
+        assert offsets[2] - offsets[1] == B_bytes
+        assert np.array_equal(DRAM_mem[offsets[0] + n*A_bytes : offsets[0] + (n+1)*A_bytes], DRAM_image[:A_bytes])
+        assert np.array_equal(DRAM_mem[offsets[1] : offsets[2]], DRAM_image[A_bytes : A_bytes + B_bytes])
+        for mem, image_mem in [(DRAM_mem, DRAM_image), (DRAM_mem_gold, DRAM_image_gold)]:
+            assert np.array_equal(mem[offsets[2] + n*C_bytes : offsets[2] + (n+1)*C_bytes], image_mem[image_offsets[2]:])
+
+# ------------------------------------------------------
+# Grouped and depthwise convolutions: group packing
+# ------------------------------------------------------
+
+# [C_in, C_out, C_h, C_w, B_h, B_w, d, s], groups
+GROUPED_LAYERS = [
+    ([8, 16, 4, 8, 3, 3, 1, 1], 4),
+    ([8, 8, 4, 6, 3, 3, 1, 1], 8),
+    ([6, 12, 3, 4, 2, 2, 2, 1], 3),
+]
+
+@pytest.mark.parametrize('layer, groups', GROUPED_LAYERS)
+def test_group_packs_match_grouped_reference(layer, groups, HOPTS):
+
+    C_in, C_out, C_h, C_w, B_h, B_w, d, s = layer
+    A_h = (C_h - 1)*s + (B_h - 1)*d + 1
+    A_w = (C_w - 1)*s + (B_w - 1)*d + 1
+    cin_g, cout_g = C_in//groups, C_out//groups
+
+    # Small integers, exact in every data type
+    rng = np.random.default_rng(13)
+    A_tensor = rng.integers(-4, 4, size=(C_in, A_h, A_w)).astype(HOPTS['intyp'])
+    B_tensor = rng.integers(-4, 4, size=(C_out, cin_g, B_h, B_w)).astype(HOPTS['intyp'])
+    C_preload = rng.integers(-4, 4, size=(C_out, C_h, C_w)).astype(HOPTS['intyp'])
+
+    # Each group of output channels only sees the inputs of its group
+    C_ref = np.concatenate([conv_reference(A_tensor[g*cin_g:(g+1)*cin_g], B_tensor[g*cout_g:(g+1)*cout_g], C_preload[g*cout_g:(g+1)*cout_g], s, d) for g in range(groups)])
+
+    tensor_shapes = [[C_in, A_h, A_w], [C_out, cin_g, B_h, B_w], [C_out, C_h, C_w]]
+    MAPPINGS = slib.get_grouped_mapping(tensor_shapes, groups, d, s, HOPTS)
+
+    assert [m['predicted_cycles'] for m in MAPPINGS] == sorted(m['predicted_cycles'] for m in MAPPINGS)
+    assert 1 in [m['pack'] for m in MAPPINGS]
+
+    for MAPPING in MAPPINGS:
+        assert MAPPING['pack']*MAPPING['N_packs'] == groups
+
+        A_packs, B_packs, C_packs = slib.pack_grouped_tensors(A_tensor, B_tensor, C_preload, MAPPING)
+        CONV = slib.get_conv_dict(MAPPING['tensor_shapes'], MAPPING['tiling'], HOPTS, preloads=1, d=d, s=s)
+
+        C_golden = np.stack([ex.get_ideal_results(A_packs[p], B_packs[p], C_packs[p], CONV, HOPTS, slib.get_sa_dict(HOPTS))[0] for p in range(MAPPING['N_packs'])])
+        assert np.array_equal(C_golden.reshape(C_ref.shape).astype(np.float64), C_ref)